@@ -1,11 +1,29 @@
+import atexit
 import os
-import requests
-from flask import Flask, render_template, flash, send_from_directory
-import pandas as pd
+import json
+import threading
+import time
+from flask import Flask, Response, render_template, flash, jsonify, redirect, request, send_from_directory, url_for
 from urllib.parse import urlparse
+from werkzeug.utils import secure_filename
 
 # Import the processing functions
 import process_logic
+import pipeline
+import preprocess
+from vision_batch import BatchingVisionClient
+from rate_limit import AdaptiveRateLimiter
+from ocr_cache import get_default_cache
+from downloader import get_default_downloader
+from sheet_reader import iter_sheet_rows
+from jobs import RESULT_FILTERS, JobManager, JobStore
+from run_journal import RunJournal
+from ocr_engines import build_engine
+from image_hash import ImageHashIndex
+from cpu_pool import CpuPool
+from result_sink import open_sink, tee
+import id_registry
+import metrics
 
 # --- Configuration ---
 # ‼️ IMPORTANT: CONFIGURE THESE PATHS ‼️
@@ -15,103 +33,335 @@ KEY_PATH = r"D:\National Id Scan\Key.json"
 # 2. Hardcoded path for the Excel file
 EXCEL_FILE_PATH = r"D:\National Id Scan\nettinghub users ids.xlsx"
 
-# Folder to store downloaded images temporarily
+# Folder to store downloaded images temporarily, one subfolder per job
 DOWNLOAD_FOLDER = 'static/downloaded_images'
 
+# Images are processed in memory; set to False to skip writing the <job_id>/row_N.jpg copies shown in the UI
+SAVE_THUMBNAILS = True
+
+# The results page shows downscaled previews of those copies, generated on first view and cached here
+# (also per job)
+THUMBNAIL_FOLDER = 'static/thumbnails'
+THUMBNAIL_MAX_SIDE = 320
+THUMBNAIL_MAX_AGE = 86400  # seconds browsers may reuse a preview without asking again
+
+# Concurrency per pipeline stage (download -> preprocess -> rotation -> OCR -> extract/compare)
+# preprocess: 'card' crops and deskews the card before upload, 'band' keeps only the ID-number
+# band, 'resize' only downscales and 'none' uploads the original image
+# cpu_workers: processes for image decoding, hashing, preprocessing and rotation (None: one per
+# core, 0: run them in the stage threads)
+PIPELINE_CONFIG = pipeline.PipelineConfig(
+    download_workers=8,
+    preprocess_workers=4,
+    rotation_workers=4,
+    ocr_workers=32,
+    extract_workers=2,
+    queue_size=32,
+    preprocess='card',
+    cpu_workers=None,
+)
+
+# OCR engine: 'vision' (Google Vision only), 'local' (OpenCV + Tesseract, no network) or
+# 'cascade' (local first, escalating to Vision only when no valid National ID is found)
+OCR_ENGINE = 'cascade'
+
+# Vision calls from the OCR workers are grouped into batch_annotate_images requests
+VISION_BATCH_SIZE = 16
+VISION_BATCH_MAX_WAIT = 0.05  # seconds
+
+# Vision calls are paced by an adaptive rate limiter shared by all jobs: it starts at
+# VISION_RATE_LIMIT images/s, creeps up while calls succeed and backs off on quota errors
+# (HTTP 429 / RESOURCE_EXHAUSTED), retrying throttled images instead of failing their rows
+VISION_RATE_LIMIT = 25
+VISION_MAX_RATE_LIMIT = 1800  # the default project quota is 1800 requests per minute per image feature
+VISION_MAX_RETRIES = 8
+
+# Verification runs execute as background jobs; status and results are stored here
+JOBS_DB_PATH = 'jobs.sqlite3'
+JOB_WORKERS = 1
+
+# Uploaded sheets submitted through POST /jobs are saved here
+UPLOAD_FOLDER = 'uploads'
+
+# Per-row progress of every job, so an interrupted job resumes instead of restarting at row 0
+RUN_JOURNAL_PATH = 'run_journal.sqlite3'
+
+# Perceptual hashes of verified cards; re-uploaded copies of a card reuse its result instead
+# of being OCR'd again, and copies registered to another nationality_id are flagged. Card
+# backs share one layout, so distinct cards can hash a few bits apart: the distance is kept
+# to the band of rescaled/re-compressed copies and every hit is re-verified on a thumbnail
+# (see image_hash.py). Off by default; enable it for sheets with many re-uploaded cards.
+DEDUPLICATE_IMAGES = False
+IMAGE_HASH_INDEX_PATH = 'image_hashes.npz'
+IMAGE_HASH_MAX_DISTANCE = 5  # bits, out of 64, on both dHash and pHash
+
+# Index of every nationality_id in the sheet, so a card carrying another row's ID (a swapped
+# upload) is traced to that row; one registry per sheet is kept in ID_REGISTRY_FOLDER and
+# memory-mapped by later runs. With ID_REGISTRY_NEAR_MISS, IDs one digit off count as well.
+CROSS_CHECK_IDS = True
+ID_REGISTRY_FOLDER = 'id_registries'
+ID_REGISTRY_NEAR_MISS = True
+
+# Every job's results are also streamed to this file as they come in, for reconciliation
+# outside the app ('{job_id}' is replaced; .sqlite3, .parquet or .csv, see result_sink.py).
+# None keeps them in the job store only.
+RESULTS_EXPORT = os.environ.get('RESULTS_EXPORT') or None
+
 # --- Flask App Setup ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'a_very_secret_key'
 
-# --- Helper Function ---
-def download_image(url, output_path):
-    """Downloads a single image from a URL and saves it."""
-    if not isinstance(url, str) or not url.strip() or url.lower() == 'null':
-        return False, "Invalid or empty URL"
-    
+# --- Verification Job ---
+def run_verification(job_id, sheet_path):
+    """
+    Job body: streams the sheet's rows through the verification pipeline and yields
+    one result dict per row as soon as it is ready. The job id doubles as the run id
+    of the journal, so resuming a job skips the rows it already completed.
+    """
+    # Each job keeps its own row_N.jpg copies, so later jobs never overwrite its images.
+    image_folder = os.path.join(DOWNLOAD_FOLDER, job_id)
+    os.makedirs(image_folder, exist_ok=True)
+
+    # Streams the three required columns row by row; the header is checked up front.
+    sheet_rows = iter_sheet_rows(sheet_path)
+    registry = id_registry.load_or_build(sheet_path, ID_REGISTRY_FOLDER) if CROSS_CHECK_IDS else None
+    export = open_sink(RESULTS_EXPORT.format(job_id=job_id), pipeline.RESULT_COLUMNS, key=('row_number',)) \
+        if RESULTS_EXPORT else None
+
     try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, stream=True, headers=headers, timeout=15)
-        response.raise_for_status()
-
-        content_type = response.headers.get('content-type', '').lower()
-        if not content_type.startswith('image/'):
-            return False, f"URL is not an image (Content-Type: {content_type})"
-
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        return True, "Success"
-    except requests.exceptions.RequestException as e:
-        return False, f"Download error: {e}"
-    except IOError as e:
-        return False, f"File save error: {e}"
+        if OCR_ENGINE == 'local':
+            engine = build_engine('local')
+            yield from tee(pipeline.verify_rows(
+                job_rows(sheet_rows), None, get_default_downloader().fetch, PIPELINE_CONFIG,
+                thumbnail_folder=image_folder if SAVE_THUMBNAILS else None,
+                journal=run_journal, run_id=job_id, engine=engine, hash_index=image_index,
+                registry=registry, near_miss=ID_REGISTRY_NEAR_MISS, cpu_pool=shared_cpu_pool(),
+            ), export)
+            return
+
+        vision_client = process_logic.setup_vision_client(KEY_PATH)
+        if not vision_client:
+            raise RuntimeError('Could not initialize Google Vision client. Check API key path.')
+
+        with BatchingVisionClient(vision_client, VISION_BATCH_SIZE, VISION_BATCH_MAX_WAIT,
+                                  rate_limiter=vision_limiter, max_retries=VISION_MAX_RETRIES) as batching_client:
+            yield from tee(pipeline.verify_rows(
+                job_rows(sheet_rows), batching_client, get_default_downloader().fetch, PIPELINE_CONFIG,
+                thumbnail_folder=image_folder if SAVE_THUMBNAILS else None,
+                journal=run_journal, run_id=job_id,
+                engine=None if OCR_ENGINE == 'vision' else build_engine(OCR_ENGINE, batching_client),
+                hash_index=image_index, registry=registry, near_miss=ID_REGISTRY_NEAR_MISS,
+                cpu_pool=shared_cpu_pool(),
+            ), export)
+    finally:
+        if image_index is not None:
+            image_index.save(IMAGE_HASH_INDEX_PATH)
+
+def job_rows(sheet_rows):
+    """
+    Maps streamed sheet rows to pipeline items. Rows are fed lazily; the pipeline's
+    bounded queues keep only a window in flight.
+    """
+    for row in sheet_rows:
+        yield {
+            'row_number': row.row_number,
+            'excel_row_id': row.id,
+            'excel_nationality_id': row.nationality_id,
+            'image_url': row.back_link,
+        }
+
+# The CPU pool's worker processes import this script as __mp_main__ (see cpu_pool.py); they
+# only need its functions, not a second job store, journal and index.
+if __name__ != '__mp_main__':
+    run_journal = RunJournal(RUN_JOURNAL_PATH)
+    vision_limiter = AdaptiveRateLimiter(rate=VISION_RATE_LIMIT, max_rate=VISION_MAX_RATE_LIMIT)
+    image_index = ImageHashIndex.load(IMAGE_HASH_INDEX_PATH, IMAGE_HASH_MAX_DISTANCE) if DEDUPLICATE_IMAGES else None
+    job_store = JobStore(JOBS_DB_PATH)
+    # Rows are journaled as done only once their results are in the job store.
+    job_manager = JobManager(job_store, run_verification, max_workers=JOB_WORKERS,
+                             on_persisted=lambda job_id, results: pipeline.journal_persisted(run_journal, job_id, results))
+
+    metrics.REGISTRY.gauge('vision_rate_limit', 'Current adaptive Vision rate limit (images/s).', lambda: vision_limiter.rate)
+    metrics.REGISTRY.gauge('vision_rate_limit_waiting', 'Images waiting for Vision rate-limit tokens.', lambda: vision_limiter.waiting)
+    metrics.REGISTRY.gauge('image_hash_index_cards', 'Cards in the near-duplicate image index.',
+                           lambda: len(image_index) if image_index is not None else None)
+
+# One CPU pool for the image steps of every job, started with the first job
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+
+def shared_cpu_pool() -> CpuPool:
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = CpuPool(PIPELINE_CONFIG.cpu_workers)
+            atexit.register(_cpu_pool.close)
+        return _cpu_pool
+
+def allowed_sheet_path(path: str) -> str | None:
+    """
+    Resolves a client-supplied sheet path. Only sheets uploaded to UPLOAD_FOLDER and the
+    configured EXCEL_FILE_PATH may be opened; anything else returns None.
+    """
+    sheet_path = os.path.realpath(path)
+    upload_folder = os.path.realpath(UPLOAD_FOLDER)
+    if sheet_path == os.path.realpath(EXCEL_FILE_PATH) or sheet_path.startswith(upload_folder + os.sep):
+        return sheet_path
+    return None
+
+def job_status(job: dict) -> dict:
+    """Job row plus the OCR cache counters and Vision rate-limit state, as returned by the JSON endpoints."""
+    cache = get_default_cache()
+    return dict(job, cache_hits=cache.hits if cache else None, cache_misses=cache.misses if cache else None,
+                vision_rate_limit=vision_limiter.stats())
 
 # --- Main Application Route ---
 @app.route('/')
 def process_from_excel_links():
     """
-    Reads an Excel file, downloads images from a 'back link' for each row,
-    processes them, and displays the comparison.
+    Shows the progress and results of a verification run. Opening the page starts a run
+    over the Excel file when none exists yet; results load while the job is running.
     """
-    if not os.path.exists(DOWNLOAD_FOLDER):
-        os.makedirs(DOWNLOAD_FOLDER)
+    job_id = request.args.get('job_id')
+    job = job_store.get_job(job_id) if job_id else job_store.latest_job()
+    if job is None:
+        if not os.path.exists(EXCEL_FILE_PATH):
+            flash(f"Error: Excel file not found at {EXCEL_FILE_PATH}", 'danger')
+            return render_template('index.html', job=None)
+        job = job_store.get_job(job_manager.submit(EXCEL_FILE_PATH))
+    return render_template('index.html', job=job)
 
-    if not os.path.exists(EXCEL_FILE_PATH):
-        flash(f"Error: Excel file not found at {EXCEL_FILE_PATH}", 'danger')
-        return render_template('index.html', results=None)
-    try:
-        df_full = pd.read_excel(EXCEL_FILE_PATH)
-        df = df_full.head(10)
-        
-        # Check for all required columns
-        required_columns = ['id', 'nationality_id', 'back link']
-        if not all(col in df.columns for col in required_columns):
-            flash(f"Error: One or more required columns ('id', 'nationality_id', 'back link') not found.", 'danger')
-            return render_template('index.html', results=None)
-    except Exception as e:
-        flash(f"Error reading Excel file: {e}", 'danger')
-        return render_template('index.html', results=None)
-
-    results = []
-    vision_client = process_logic.setup_vision_client(KEY_PATH)
-    if not vision_client:
-        flash('Could not initialize Google Vision client. Check API key path.', 'danger')
-        return render_template('index.html', results=None)
-
-    for index, row in df.iterrows():
-        # ‼️ CHANGE: Get the 'id' from the Excel row
-        excel_row_id = str(row['id'])
-        excel_nationality_id = str(row['nationality_id'])
-        image_url = row['back link']
-        
-        local_filename = f"row_{index + 2}.jpg"
-        local_filepath = os.path.join(DOWNLOAD_FOLDER, local_filename)
-
-        success, message = download_image(image_url, local_filepath)
-        
-        extracted_id = "N/A"
-        is_match = False
-
-        if success:
-            print(f"Processing downloaded image for row {index + 2}...")
-            original_text = process_logic.detect_text_from_image(vision_client, local_filepath)
-            extracted_id = process_logic.extract_national_id(original_text) if original_text else "Extraction Failed"
-            
-            if extracted_id == excel_nationality_id:
-                is_match = True
-        else:
-            extracted_id = f"Download Failed: {message}"
-
-        results.append({
-            'excel_row_id': excel_row_id, # Pass the new ID to the template
-            'excel_nationality_id': excel_nationality_id,
-            'extracted_id': extracted_id,
-            'is_match': is_match,
-            'image_path': local_filename if success else None
-        })
-
-    flash(f"Successfully processed the first {len(df)} rows from the Excel file.", 'success')
-    return render_template('index.html', results=results)
+# --- Job API ---
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Submits a verification run. Accepts an uploaded 'sheet' file, a 'sheet_path' form/JSON
+    field naming an earlier upload or the configured Excel file (no other paths), or
+    defaults to the configured Excel file. Returns 202 with the job id for API callers and
+    redirects browsers to the progress page.
+    """
+    payload = request.get_json(silent=True) or request.form
+    upload = request.files.get('sheet')
+    if upload and upload.filename:
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        sheet_path = os.path.join(UPLOAD_FOLDER, f"{int(time.time())}_{secure_filename(upload.filename)}")
+        upload.save(sheet_path)
+    elif payload.get('sheet_path'):
+        sheet_path = allowed_sheet_path(payload['sheet_path'])
+        if sheet_path is None:
+            message = f"sheet_path must be a sheet in {UPLOAD_FOLDER} or the configured Excel file; upload other sheets"
+            if request.is_json:
+                return jsonify({'error': message}), 400
+            flash(f"Error: {message}", 'danger')
+            return redirect(url_for('process_from_excel_links'))
+    else:
+        sheet_path = EXCEL_FILE_PATH
+
+    if not os.path.exists(sheet_path):
+        if request.is_json:
+            return jsonify({'error': f"Sheet not found at {sheet_path}"}), 400
+        flash(f"Error: Excel file not found at {sheet_path}", 'danger')
+        return redirect(url_for('process_from_excel_links'))
+
+    job_id = job_manager.submit(sheet_path)
+    if request.is_json:
+        return jsonify({'job_id': job_id, 'status_url': url_for('get_job', job_id=job_id)}), 202
+    return redirect(url_for('process_from_excel_links', job_id=job_id))
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """Continues an interrupted or failed job; completed rows are skipped and failed rows retried."""
+    if not job_manager.resume(job_id):
+        if request.is_json:
+            return jsonify({'error': 'Job not found or still running'}), 409
+        flash('Job not found or still running.', 'danger')
+    elif request.is_json:
+        return jsonify({'job_id': job_id, 'status_url': url_for('get_job', job_id=job_id)}), 202
+    return redirect(url_for('process_from_excel_links', job_id=job_id))
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_store.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<job_id>/results')
+def get_job_results(job_id):
+    """
+    Pages through a job's results. With ?since=<seq> returns rows written after that
+    sequence number (for incremental loading); otherwise ?page=&per_page= by row number,
+    optionally narrowed with ?filter= to one of RESULT_FILTERS (e.g. mismatch or
+    download_failed). Page responses include the row count of every filter.
+    """
+    if job_store.get_job(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if 'since' in request.args:
+        rows = job_store.get_results_since(job_id, request.args.get('since', 0, type=int),
+                                           min(request.args.get('limit', 500, type=int), 1000))
+        return jsonify({'results': rows})
+    result_filter = request.args.get('filter', 'all')
+    if result_filter not in RESULT_FILTERS:
+        return jsonify({'error': f"Unknown filter '{result_filter}'", 'filters': list(RESULT_FILTERS)}), 400
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+    counts = job_store.count_results(job_id)
+    return jsonify({
+        'page': page,
+        'per_page': per_page,
+        'filter': result_filter,
+        'total': counts[result_filter],
+        'counts': counts,
+        'results': job_store.get_results(job_id, page, per_page, result_filter),
+    })
+
+@app.route('/jobs/<job_id>/thumbnails/<filename>')
+def thumbnail(job_id, filename):
+    """
+    A downscaled preview of a job's downloaded card image (row_N.jpg). It is made on first
+    request, kept in THUMBNAIL_FOLDER/<job_id> and remade when the image is downloaded again,
+    so the page never loads the full-size photos.
+    """
+    job_id, filename = secure_filename(job_id), secure_filename(filename)
+    source = os.path.join(DOWNLOAD_FOLDER, job_id, filename)
+    if not job_id or not filename or not os.path.isfile(source):
+        return jsonify({'error': 'Image not found'}), 404
+    thumbnail_folder = os.path.join(THUMBNAIL_FOLDER, job_id)
+    cached = os.path.join(thumbnail_folder, filename)
+    if not os.path.exists(cached) or os.path.getmtime(cached) < os.path.getmtime(source):
+        with open(source, 'rb') as image_file:
+            preview = preprocess.make_thumbnail(image_file.read(), THUMBNAIL_MAX_SIDE)
+        if preview is None:
+            return jsonify({'error': 'Image could not be decoded'}), 404
+        os.makedirs(thumbnail_folder, exist_ok=True)
+        # Concurrent first requests each write their own file; the last rename wins.
+        partial_path = f"{cached}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(partial_path, 'wb') as preview_file:
+            preview_file.write(preview)
+        os.replace(partial_path, cached)
+    return send_from_directory(os.path.abspath(thumbnail_folder), filename, mimetype='image/jpeg', max_age=THUMBNAIL_MAX_AGE)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events stream of the job's progress until it finishes."""
+    if job_store.get_job(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def stream():
+        while True:
+            job = job_store.get_job(job_id)
+            yield f"data: {json.dumps(job_status(job))}\n\n"
+            if job['status'] not in ('queued', 'running'):
+                return
+            time.sleep(1)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+# --- Metrics ---
+@app.route('/metrics')
+def metrics_endpoint():
+    """Per-stage timings, Vision/download latencies and counters in the Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,320 @@
+import contextlib
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# End-to-end benchmark of the three ways rows flow through the project, against local
+# stand-ins only: a synthetic card corpus (see synthetic_cards.py) served by a local HTTP
+# server, and fake_vision.py answering OCR with the corpus' ground-truth texts after a
+# configurable latency and error rate.
+#
+#   python benchmarks/bench_e2e.py
+#
+# For each path it reports rows/sec, per-row p50/p99 latency and accuracy:
+#   app       - app.run_verification, the job body behind the web UI (pipeline.py)
+#   process   - process.py's folder scan (batched Vision client, CPU pool, thread pool)
+#   download  - download_images.py's sheet download
+# Accuracy is the share of rows whose extracted ID equals the card's true ID (for
+# 'download', the share of images saved byte-identical). The app path always runs with the
+# near-duplicate index on: every synthetic card is a distinct card, so a row reported as a
+# copy of another is a false merge and fails the benchmark. Every path runs in its own
+# temporary working directory with the OCR cache off, so runs never warm each other up.
+#
+# Settings (environment variables):
+#   BENCH_CORPUS (benchmarks/corpus), BENCH_ROWS (200), BENCH_SEED (0), BENCH_IMAGE_SIDE (1600)
+#   BENCH_PATHS (app,process,download), BENCH_OCR_ENGINE (vision)
+#   BENCH_VISION_LATENCY (0.15 s per RPC), BENCH_VISION_JITTER (0.1 s),
+#   BENCH_VISION_ERROR_RATE (0.01 of images), BENCH_VISION_RPC_ERROR_RATE (0.01 of RPCs)
+#   BENCH_IMAGE_LATENCY (0.02 s per image request)
+#   BENCH_OUTPUT: write the results as JSON to this file
+#   BENCH_BASELINE: compare with a previous BENCH_OUTPUT file and exit with status 1 when
+#   rows/sec or p99 latency is worse by more than BENCH_TOLERANCE (0.2), or accuracy drops.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import metrics
+import ocr_cache
+import process_logic
+from fake_vision import FakeVisionServer
+from preprocess import PREPROCESS_MODE, prepare_for_ocr
+from synthetic_cards import load_corpus
+
+CORPUS_FOLDER = os.path.abspath(os.environ.get('BENCH_CORPUS', os.path.join(BENCH_DIR, 'corpus')))
+ROWS = int(os.environ.get('BENCH_ROWS', '200'))
+SEED = int(os.environ.get('BENCH_SEED', '0'))
+IMAGE_SIDE = int(os.environ.get('BENCH_IMAGE_SIDE', '1600'))
+PATHS = os.environ.get('BENCH_PATHS', 'app,process,download').split(',')
+OCR_ENGINE = os.environ.get('BENCH_OCR_ENGINE', 'vision')
+VISION_LATENCY = float(os.environ.get('BENCH_VISION_LATENCY', '0.15'))
+VISION_JITTER = float(os.environ.get('BENCH_VISION_JITTER', '0.1'))
+VISION_ERROR_RATE = float(os.environ.get('BENCH_VISION_ERROR_RATE', '0.01'))
+VISION_RPC_ERROR_RATE = float(os.environ.get('BENCH_VISION_RPC_ERROR_RATE', '0.01'))
+IMAGE_LATENCY = float(os.environ.get('BENCH_IMAGE_LATENCY', '0.02'))
+OUTPUT_PATH = os.path.abspath(os.environ['BENCH_OUTPUT']) if os.environ.get('BENCH_OUTPUT') else None
+BASELINE_PATH = os.path.abspath(os.environ['BENCH_BASELINE']) if os.environ.get('BENCH_BASELINE') else None
+TOLERANCE = float(os.environ.get('BENCH_TOLERANCE', '0.2'))
+
+def start_image_server(folder: str, latency: float) -> ThreadingHTTPServer:
+    """Serves the corpus images over HTTP, each request delayed by `latency` seconds."""
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=folder))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='bench-images', daemon=True).start()
+    return server
+
+def start_fake_vision(cards) -> FakeVisionServer:
+    """
+    Starts fake Vision with each card's ground-truth text registered under every byte
+    variant a path may upload: the original photo and its preprocessed versions.
+    """
+    import app
+    modes = {'none', PREPROCESS_MODE, app.PIPELINE_CONFIG.preprocess or PREPROCESS_MODE}
+    fake = FakeVisionServer(latency=VISION_LATENCY, latency_jitter=VISION_JITTER, error_rate=VISION_ERROR_RATE,
+                            rpc_error_rate=VISION_RPC_ERROR_RATE, seed=SEED)
+    for card in cards:
+        with open(os.path.join(CORPUS_FOLDER, card.filename), 'rb') as image_file:
+            content = image_file.read()
+        for mode in modes:
+            fake.register(prepare_for_ocr(content, mode, app.PIPELINE_CONFIG.preprocess_max_side), card.text)
+    fake.start()
+    return fake
+
+def write_sheet(path: str, cards, image_base_url: str):
+    """Writes the CSV sheet (id, nationality_id, back link) the app and download paths read."""
+    with open(path, 'w', encoding='utf-8', newline='') as sheet:
+        sheet.write('id,nationality_id,back link\n')
+        for card in cards:
+            sheet.write(f"{card.row_id},{card.sheet_nationality_id},{image_base_url}/{card.filename}\n")
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))] if ordered else 0.0
+
+@contextlib.contextmanager
+def isolated_run():
+    """A fresh working directory, download pool and metrics registry per path; the scripts' prints are silenced."""
+    import downloader
+    previous = os.getcwd()
+    folder = tempfile.mkdtemp(prefix='bench-')
+    os.chdir(folder)
+    downloader._default_downloader = None
+    metrics.REGISTRY.reset()
+    try:
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+            yield folder
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(folder, ignore_errors=True)
+        downloader._default_downloader = None
+
+# --- Paths ---
+def bench_app(cards, sheet_path: str) -> dict:
+    """app.run_verification over the sheet; latency is from the row entering the pipeline to its result."""
+    import app
+    from image_hash import ImageHashIndex
+    from run_journal import RunJournal
+
+    truth = {card.row_id: card.national_id for card in cards}
+    app.OCR_ENGINE = OCR_ENGINE
+    entered = {}
+    job_rows = app.job_rows
+
+    def timed_rows(sheet_rows):
+        for item in job_rows(sheet_rows):
+            entered[item['row_number']] = time.perf_counter()
+            yield item
+
+    app.job_rows = timed_rows
+    try:
+        with isolated_run():
+            # Journal and near-duplicate index start empty, as for a first upload of the sheet.
+            app.run_journal = RunJournal(app.RUN_JOURNAL_PATH)
+            app.image_index = ImageHashIndex(app.IMAGE_HASH_MAX_DISTANCE)
+            latencies, correct, merged = [], 0, 0
+            start = time.perf_counter()
+            for result in app.run_verification('bench', sheet_path):
+                latencies.append(time.perf_counter() - entered[result['row_number']])
+                correct += result['extracted_id'] == truth[str(result['excel_row_id'])]
+                merged += result['duplicate_of'] is not None
+            elapsed = time.perf_counter() - start
+            app.run_journal.close()
+    finally:
+        app.job_rows = job_rows
+    return {**summarize(latencies, elapsed, correct), 'merged': merged}
+
+def bench_process(cards) -> dict:
+    """process.py's main loop over the corpus folder; latency is the OCR call of one image."""
+    import process
+    from cpu_pool import CpuPool
+    from rate_limit import AdaptiveRateLimiter
+    from vision_batch import BatchingVisionClient
+
+    truth = {card.filename: card.national_id for card in cards}
+    files = sorted(truth)
+    with isolated_run():
+        vision_client = process_logic.setup_vision_client(None)
+        latencies, correct = [], 0
+
+        def timed_ocr(client, cpu_pool, filename):
+            started = time.perf_counter()
+            text = process.detect_text_from_image(client, os.path.join(CORPUS_FOLDER, filename), PREPROCESS_MODE, cpu_pool)
+            return text, time.perf_counter() - started
+
+        start = time.perf_counter()
+        limiter = AdaptiveRateLimiter(rate=25)
+        with CpuPool(None) as cpu_pool, BatchingVisionClient(vision_client, rate_limiter=limiter) as batching_client, \
+                ThreadPoolExecutor(max_workers=max(16, cpu_pool.workers)) as executor:
+            results = executor.map(lambda f: timed_ocr(batching_client, cpu_pool, f), files)
+            for filename, (text, latency) in zip(files, results):
+                latencies.append(latency)
+                correct += bool(text) and process.extract_national_id(text) == truth[filename]
+        elapsed = time.perf_counter() - start
+    return summarize(latencies, elapsed, correct)
+
+def bench_download(cards, sheet_path: str) -> dict:
+    """download_images.py over the sheet; latency is one image fetch."""
+    import download_images
+    from downloader import get_default_downloader
+
+    with isolated_run() as folder:
+        downloader = get_default_downloader()
+        latencies = []
+        fetch = downloader.fetch
+
+        def timed_fetch(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fetch(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+        downloader.fetch = timed_fetch
+        start = time.perf_counter()
+        download_images.download_images_from_excel(sheet_path, 'national_id_images')
+        elapsed = time.perf_counter() - start
+
+        correct = 0
+        for index, card in enumerate(cards):
+            saved = os.path.join(folder, 'national_id_images', f"image_{index + 1}.jpg")
+            if os.path.exists(saved):
+                with open(saved, 'rb') as saved_file, open(os.path.join(CORPUS_FOLDER, card.filename), 'rb') as original:
+                    correct += saved_file.read() == original.read()
+    return summarize(latencies, elapsed, correct)
+
+def summarize(latencies: list, elapsed: float, correct: int) -> dict:
+    rows = len(latencies)
+    return {
+        'rows': rows,
+        'elapsed_s': round(elapsed, 2),
+        'rows_per_sec': round(rows / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'accuracy': round(correct / rows, 4) if rows else 0.0,
+    }
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    """Regressions of `results` against `baseline`, as printable lines."""
+    regressions = []
+    for path, result in results.items():
+        before = baseline.get('results', {}).get(path)
+        if not before:
+            continue
+        if result['rows_per_sec'] < before['rows_per_sec'] * (1 - TOLERANCE):
+            regressions.append(f"{path}: rows/sec {before['rows_per_sec']} -> {result['rows_per_sec']}")
+        if result['p99_ms'] > before['p99_ms'] * (1 + TOLERANCE):
+            regressions.append(f"{path}: p99 {before['p99_ms']} ms -> {result['p99_ms']} ms")
+        if result['accuracy'] < before['accuracy'] - 0.005:
+            regressions.append(f"{path}: accuracy {before['accuracy']} -> {result['accuracy']}")
+    return regressions
+
+def main() -> int:
+    # Importing app opens its job store, journal and hash index in the working directory;
+    # keep those, and everything the paths write, out of the checkout.
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    previous = os.getcwd()
+    os.chdir(scratch)
+    try:
+        return run()
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def run() -> int:
+    import app
+    print(f"🪪 Corpus: {ROWS} synthetic cards in {CORPUS_FOLDER} (seed {SEED}, {IMAGE_SIDE}px)")
+    cards = load_corpus(CORPUS_FOLDER, ROWS, SEED, IMAGE_SIDE)
+    ocr_cache.CACHE_ENABLED = False
+    image_server = start_image_server(CORPUS_FOLDER, IMAGE_LATENCY)
+    fake = start_fake_vision(cards)
+    process_logic.VISION_API_ENDPOINT = fake.endpoint
+    print(f"🧪 Fake Vision at {fake.endpoint}: {VISION_LATENCY * 1000:.0f} ms + up to {VISION_JITTER * 1000:.0f} ms per RPC, "
+          f"{VISION_ERROR_RATE:.1%} image errors, {VISION_RPC_ERROR_RATE:.1%} RPC errors")
+
+    sheet_path = os.path.abspath('sheet.csv')
+    host, port = image_server.server_address[:2]
+    write_sheet(sheet_path, cards, f"http://{host}:{port}")
+
+    runners = {
+        'app': lambda: bench_app(cards, sheet_path),
+        'process': lambda: bench_process(cards),
+        'download': lambda: bench_download(cards, sheet_path),
+    }
+    results = {}
+    print(f"\n{'path':<10}{'rows':>6}{'time s':>9}{'rows/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'accuracy':>10}")
+    for path in PATHS:
+        result = results[path] = runners[path]()
+        print(f"{path:<10}{result['rows']:>6}{result['elapsed_s']:>9.1f}{result['rows_per_sec']:>9.1f}"
+              f"{result['p50_ms']:>9.0f}{result['p99_ms']:>9.0f}{result['accuracy']:>10.1%}")
+
+    fake.stop()
+    image_server.shutdown()
+
+    failed = False
+    if results.get('app', {}).get('merged'):
+        print(f"\n🚨 {results['app']['merged']} distinct cards were merged as near-duplicates "
+              f"(app.IMAGE_HASH_MAX_DISTANCE = {app.IMAGE_HASH_MAX_DISTANCE}).")
+        failed = True
+
+    report = {
+        'settings': {'rows': ROWS, 'seed': SEED, 'image_side': IMAGE_SIDE, 'ocr_engine': OCR_ENGINE,
+                     'image_hash_max_distance': app.IMAGE_HASH_MAX_DISTANCE,
+                     'vision_latency': VISION_LATENCY, 'vision_jitter': VISION_JITTER,
+                     'vision_error_rate': VISION_ERROR_RATE, 'vision_rpc_error_rate': VISION_RPC_ERROR_RATE,
+                     'image_latency': IMAGE_LATENCY, 'cpu_count': os.cpu_count()},
+        'results': results,
+    }
+    if OUTPUT_PATH:
+        with open(OUTPUT_PATH, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+        print(f"\n💾 Results written to {OUTPUT_PATH}")
+    if BASELINE_PATH:
+        with open(BASELINE_PATH, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        if regressions:
+            print(f"\n🚨 Regressions against {BASELINE_PATH} (tolerance {TOLERANCE:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\n✅ No regressions against {BASELINE_PATH}.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import statistics
+
+# Benchmarks the pre-upload preprocessing modes (see preprocess.py) on the images in
+# static/downloaded_images: upload size, preprocessing time, OCR latency and whether
+# the extracted National ID still matches the one read from the original image.
+#
+#   python benchmarks/bench_preprocess.py
+#
+# OCR columns need Vision access: set VISION_KEY_PATH to a service-account key, or
+# VISION_API_ENDPOINT to a local fake (see fake_vision.py). Without either, only
+# size and preprocessing time are reported. OCR calls bypass the response cache.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr_cache
+import process_logic
+from national_id import is_valid_national_id
+from preprocess import PREPROCESS_MODES, prepare_for_ocr
+
+IMAGE_FOLDER = os.environ.get('BENCH_IMAGE_FOLDER', 'static/downloaded_images')
+MODES = os.environ.get('BENCH_MODES', ','.join(PREPROCESS_MODES)).split(',')
+MAX_SIDE = int(os.environ.get('BENCH_MAX_SIDE', '1600'))
+KEY_PATH = os.environ.get('VISION_KEY_PATH')
+
+def ocr_national_id(client, content: bytes, label: str):
+    """Returns (extracted ID or None, latency in ms) for one uncached Vision call."""
+    start = time.perf_counter()
+    text = process_logic.detect_text_from_bytes(client, content, label)
+    latency = (time.perf_counter() - start) * 1000
+    return (process_logic.extract_national_id(text) if text else None), latency
+
+def main():
+    files = sorted(f for f in os.listdir(IMAGE_FOLDER) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    client = None
+    if KEY_PATH or process_logic.VISION_API_ENDPOINT:
+        client = process_logic.setup_vision_client(KEY_PATH)
+    if client is not None:
+        # Latency and accuracy are only meaningful against fresh API calls.
+        ocr_cache.CACHE_ENABLED = False
+    else:
+        print("ℹ️ No Vision access configured; reporting size and preprocessing time only.\n")
+
+    stats = {mode: {'bytes': [], 'prep_ms': [], 'ocr_ms': [], 'same': 0, 'valid': 0} for mode in MODES}
+    for filename in files:
+        with open(os.path.join(IMAGE_FOLDER, filename), 'rb') as image_file:
+            original = image_file.read()
+        reference = None
+        for mode in MODES:
+            start = time.perf_counter()
+            content = prepare_for_ocr(original, mode, MAX_SIDE)
+            prep_ms = (time.perf_counter() - start) * 1000
+            row = stats[mode]
+            row['bytes'].append(len(content))
+            row['prep_ms'].append(prep_ms)
+            line = f"{filename:<16} {mode:<7} {len(original) / 1024:>8.0f} KB -> {len(content) / 1024:>7.0f} KB  prep {prep_ms:>6.0f} ms"
+            if client is not None:
+                national_id, ocr_ms = ocr_national_id(client, content, f"{filename} ({mode})")
+                if mode == MODES[0]:
+                    reference = national_id
+                row['ocr_ms'].append(ocr_ms)
+                row['same'] += national_id == reference
+                row['valid'] += bool(national_id and is_valid_national_id(national_id))
+                line += f"  ocr {ocr_ms:>6.0f} ms  id {national_id or 'Not Found'}"
+            print(line)
+
+    print(f"\n--- Summary over {len(files)} images (reference mode: {MODES[0]}) ---")
+    for mode, row in stats.items():
+        if not row['bytes']:
+            continue
+        line = (f"{mode:<7} total {sum(row['bytes']) / 1024:>8.0f} KB"
+                f"  median prep {statistics.median(row['prep_ms']):>6.0f} ms")
+        if row['ocr_ms']:
+            line += (f"  median ocr {statistics.median(row['ocr_ms']):>6.0f} ms"
+                     f"  same ID as reference {row['same']}/{len(files)}"
+                     f"  valid IDs {row['valid']}/{len(files)}")
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import datetime
+import json
+import math
+import os
+import random
+import sys
+from dataclasses import asdict, dataclass
+
+import cv2
+import numpy as np
+
+# Generates a synthetic corpus of Egyptian ID card back-side photos with known National IDs
+# for benchmarks/bench_e2e.py.
+#
+# Every card carries a structurally valid 14-digit ID and its dates in Arabic-Indic digits
+# (drawn as strokes, so no Arabic font is needed), placeholder text lines and a barcode,
+# photographed at a random rotation and skew on a textured background with sensor noise,
+# blur and JPEG compression. Next to each image the manifest records the text a Vision call
+# would return for it, with OCR-style noise (digit groups split by spaces, Western digits,
+# a date on the ID line, the odd misread digit), and the ground-truth ID.
+#
+#   python benchmarks/synthetic_cards.py benchmarks/corpus 500
+#
+# Images are written as card_N.jpg next to manifest.json. Generation is seeded, so the
+# same arguments always produce the same corpus.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from national_id import GOVERNORATES, check_digit
+
+ARABIC_DIGITS = '٠١٢٣٤٥٦٧٨٩'
+
+# Stroke glyphs for the Arabic-Indic digits: polylines in a unit box (x right, y down).
+DIGIT_STROKES = {
+    '0': [[(0.5, 0.45), (0.6, 0.55), (0.5, 0.65), (0.4, 0.55), (0.5, 0.45)]],
+    '1': [[(0.55, 0.1), (0.5, 0.9)]],
+    '2': [[(0.8, 0.1), (0.75, 0.28), (0.6, 0.32), (0.45, 0.2), (0.45, 0.9)]],
+    '3': [[(0.85, 0.1), (0.8, 0.25), (0.7, 0.25), (0.65, 0.1), (0.6, 0.25), (0.45, 0.25), (0.4, 0.1), (0.4, 0.9)]],
+    '4': [[(0.75, 0.1), (0.45, 0.25), (0.7, 0.45), (0.4, 0.6), (0.5, 0.8), (0.8, 0.9)]],
+    '5': [[(0.5, 0.3), (0.3, 0.6), (0.4, 0.85), (0.6, 0.85), (0.7, 0.6), (0.5, 0.3)]],
+    '6': [[(0.3, 0.1), (0.7, 0.25), (0.7, 0.9)]],
+    '7': [[(0.25, 0.1), (0.5, 0.9), (0.75, 0.1)]],
+    '8': [[(0.25, 0.9), (0.5, 0.1), (0.75, 0.9)]],
+    '9': [[(0.62, 0.45), (0.38, 0.4), (0.38, 0.15), (0.62, 0.15), (0.62, 0.9)]],
+    '/': [[(0.7, 0.1), (0.3, 0.9)]],
+}
+
+OCCUPATIONS = ('طالب', 'مهندس', 'محاسب', 'طبيب بشرى', 'مدرس', 'بدون عمل', 'موظف بالقطاع الخاص')
+RELIGIONS = ('مسلم', 'مسيحى')
+MARITAL = ('أعزب', 'متزوج', 'مطلق', 'أرمل')
+
+# Digits OCR tends to confuse, as observed in bulk_extract.py's confusion matrices
+CONFUSIONS = {'1': '7', '7': '1', '0': '8', '8': '0', '6': '0', '9': '4', '4': '9', '3': '2', '2': '3', '5': '6'}
+
+@dataclass
+class Card:
+    """One corpus entry. `sheet_nationality_id` is what the sheet claims; `national_id` is the truth."""
+    row_id: str
+    filename: str
+    national_id: str
+    sheet_nationality_id: str
+    rotation: int
+    text: str
+
+def random_national_id(rng: random.Random, today: datetime.date) -> str:
+    """A structurally valid ID: century, real birth date (16 to 70 years ago), governorate, check digit."""
+    born = today - datetime.timedelta(days=rng.randint(16 * 365, 70 * 365))
+    century = '2' if born.year < 2000 else '3'
+    first13 = (f"{century}{born.year % 100:02d}{born.month:02d}{born.day:02d}"
+               f"{rng.choice(sorted(GOVERNORATES))}{rng.randrange(10000):04d}")
+    return first13 + str(check_digit(first13))
+
+def to_arabic(text: str) -> str:
+    return text.translate(str.maketrans('0123456789', ARABIC_DIGITS))
+
+def ocr_text(national_id: str, expiry: str, rng: random.Random, misread_rate: float,
+             unreadable_rate: float) -> str:
+    """The text Vision would return for the card, with OCR-style noise."""
+    read = national_id
+    if rng.random() < misread_rate:
+        position = rng.randrange(14)
+        read = read[:position] + CONFUSIONS[read[position]] + read[position + 1:]
+    if rng.random() < 0.3:
+        read = ' '.join((read[:4], read[4:8], read[8:12], read[12:]))
+    number = read if rng.random() < 0.1 else to_arabic(read)
+    if rng.random() < unreadable_rate:
+        number = to_arabic(read[:6]) + ' ' + '؟' * 4
+    date = to_arabic(expiry)
+    number_line = f"{number} {date}" if rng.random() < 0.15 else number
+    lines = [
+        rng.choice(OCCUPATIONS),
+        f"{'ذكر' if int(national_id[12]) % 2 else 'أنثى'} {rng.choice(RELIGIONS)}",
+        rng.choice(MARITAL),
+        number_line,
+        f"البطاقة سارية حتى {date}",
+        f"{rng.choice('ABCDEFGHJK')}{rng.choice('ABCDEFGHJK')}{rng.randrange(10 ** 7):07d}",
+    ]
+    return '\n'.join(lines)
+
+def draw_digits(image, digits: str, x: float, y: float, height: float, color, thickness: int):
+    """Draws `digits` (Western digits, '/' and spaces) as Arabic-Indic stroke glyphs from (x, y), left to right."""
+    width = height * 0.6
+    for char in digits:
+        for stroke in DIGIT_STROKES.get(char, []):
+            points = np.array([(x + px * width, y + py * height) for px, py in stroke], dtype=np.int32)
+            cv2.polylines(image, [points], False, color, thickness, cv2.LINE_AA)
+        x += width * (0.6 if char == ' ' else 1.15)
+
+def render_card(national_id: str, expiry: str, rng: random.Random, width: int = 856):
+    """The card back as a flat BGR image in ID-1 proportions."""
+    height = int(width * 53.98 / 85.60)
+    base = np.array([rng.randint(205, 235), rng.randint(215, 240), rng.randint(200, 230)], dtype=np.uint8)
+    card = np.empty((height, width, 3), dtype=np.uint8)
+    card[:] = base
+    # Guilloche background
+    xs = np.arange(0, width, 4)
+    for i in range(12):
+        amplitude, period, phase = rng.uniform(8, 30), rng.uniform(60, 200), rng.uniform(0, 2 * math.pi)
+        ys = height * (i + 0.5) / 12 + amplitude * np.sin(xs / period + phase)
+        cv2.polylines(card, [np.stack([xs, ys], axis=1).astype(np.int32)], False,
+                      tuple(int(c) - 25 for c in base), 1, cv2.LINE_AA)
+    ink = (rng.randint(20, 60),) * 3
+    # The ID number along the top edge, inside preprocess.ID_BAND
+    draw_digits(card, national_id, width * 0.2, height * 0.08, height * 0.12, ink, max(2, width // 280))
+    # Right-aligned placeholder text lines (occupation, gender/religion, marital status)
+    for row in range(3):
+        right = width * 0.93
+        y = height * (0.32 + row * 0.12)
+        for _ in range(rng.randint(1, 3)):
+            word = rng.uniform(0.06, 0.16) * width
+            cv2.rectangle(card, (int(right - word), int(y)), (int(right), int(y + height * 0.05)), ink, -1)
+            right -= word + width * 0.02
+    draw_digits(card, expiry, width * 0.08, height * 0.66, height * 0.07, ink, max(1, width // 400))
+    # Barcode
+    x = width * 0.1
+    while x < width * 0.9:
+        bar = rng.choice((2, 3, 5))
+        if rng.random() < 0.6:
+            cv2.rectangle(card, (int(x), int(height * 0.8)), (int(x + bar), int(height * 0.94)), (0, 0, 0), -1)
+        x += bar + rng.choice((2, 3))
+    return card
+
+def photograph(card, rng: random.Random, side: int, rotation: int, jpeg_quality: int) -> bytes:
+    """Places the card on a textured background with skew, perspective, rotation, noise and blur; returns JPEG bytes."""
+    photo_h, photo_w = int(side * 0.75), side
+    background = np.empty((photo_h, photo_w, 3), dtype=np.uint8)
+    background[:] = (rng.randint(40, 160), rng.randint(40, 160), rng.randint(40, 160))
+    np_rng = np.random.default_rng(rng.randrange(2 ** 32))
+    background = cv2.add(background, np_rng.integers(0, 40, background.shape, dtype=np.uint8))
+    background = cv2.GaussianBlur(background, (0, 0), 3)
+
+    card_h, card_w = card.shape[:2]
+    scale = rng.uniform(0.55, 0.8) * photo_w / card_w
+    angle = math.radians(rng.uniform(-8, 8))
+    cx, cy = photo_w / 2 + rng.uniform(-0.05, 0.05) * photo_w, photo_h / 2 + rng.uniform(-0.05, 0.05) * photo_h
+    corners = []
+    for x, y in ((0, 0), (card_w, 0), (card_w, card_h), (0, card_h)):
+        dx, dy = (x - card_w / 2) * scale, (y - card_h / 2) * scale
+        dx += rng.uniform(-0.02, 0.02) * card_w * scale
+        dy += rng.uniform(-0.02, 0.02) * card_h * scale
+        corners.append((cx + dx * math.cos(angle) - dy * math.sin(angle), cy + dx * math.sin(angle) + dy * math.cos(angle)))
+    source = np.float32([(0, 0), (card_w, 0), (card_w, card_h), (0, card_h)])
+    matrix = cv2.getPerspectiveTransform(source, np.float32(corners))
+    warped = cv2.warpPerspective(card, matrix, (photo_w, photo_h))
+    mask = cv2.warpPerspective(np.full((card_h, card_w), 255, np.uint8), matrix, (photo_w, photo_h))
+    photo = np.where(mask[..., None] > 0, warped, background)
+
+    if rotation:
+        photo = cv2.rotate(photo, {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180,
+                                   270: cv2.ROTATE_90_COUNTERCLOCKWISE}[rotation])
+    noise = np_rng.normal(0, rng.uniform(2, 8), photo.shape)
+    photo = np.clip(photo + noise, 0, 255).astype(np.uint8)
+    if rng.random() < 0.3:
+        photo = cv2.GaussianBlur(photo, (0, 0), rng.uniform(0.8, 1.8))
+    ok, encoded = cv2.imencode('.jpg', photo, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    return encoded.tobytes()
+
+def generate_corpus(folder: str, count: int, seed: int = 0, side: int = 1600, mismatch_rate: float = 0.05,
+                    misread_rate: float = 0.03, unreadable_rate: float = 0.02, rotation_rate: float = 0.2,
+                    today: datetime.date | None = None) -> list[Card]:
+    """
+    Writes `count` card photos and manifest.json to `folder` and returns the cards.
+    `mismatch_rate` of the rows claim another person's ID in the sheet, `misread_rate` of
+    the OCR texts have one confused digit, `unreadable_rate` have no readable ID, and
+    `rotation_rate` of the photos are taken at 90, 180 or 270 degrees.
+    """
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    os.makedirs(folder, exist_ok=True)
+    cards = []
+    for index in range(count):
+        national_id = random_national_id(rng, today)
+        sheet_id = random_national_id(rng, today) if rng.random() < mismatch_rate else national_id
+        issued = today - datetime.timedelta(days=rng.randint(30, 6 * 365))
+        expiry = f"{issued.year + 7}/{issued.month:02d}/{min(issued.day, 28):02d}"
+        rotation = rng.choice((90, 180, 270)) if rng.random() < rotation_rate else 0
+        filename = f"card_{index + 1}.jpg"
+        content = photograph(render_card(national_id, expiry, rng), rng, side, rotation, rng.randint(60, 92))
+        with open(os.path.join(folder, filename), 'wb') as image_file:
+            image_file.write(content)
+        cards.append(Card(str(100000 + index), filename, national_id, sheet_id, rotation,
+                          ocr_text(national_id, expiry, rng, misread_rate, unreadable_rate)))
+
+    manifest = {'count': count, 'seed': seed, 'side': side, 'cards': [asdict(card) for card in cards]}
+    with open(os.path.join(folder, 'manifest.json'), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=1)
+    return cards
+
+def load_corpus(folder: str, count: int, seed: int = 0, side: int = 1600) -> list[Card]:
+    """Returns the corpus in `folder`, generating it first if it is missing or was made with other settings."""
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        if (manifest['count'], manifest['seed'], manifest['side']) == (count, seed, side):
+            return [Card(**card) for card in manifest['cards']]
+    return generate_corpus(folder, count, seed, side)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python benchmarks/synthetic_cards.py <output_folder> <count> [seed] [side_px]")
+        sys.exit(1)
+    cards = generate_corpus(sys.argv[1], int(sys.argv[2]), *(int(arg) for arg in sys.argv[3:5]))
+    print(f"🪪 Wrote {len(cards)} synthetic cards to {sys.argv[1]}")
@@ -0,0 +1,269 @@
+import sys
+import datetime
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from sheet_reader import SheetRow, iter_sheet_rows
+from national_id import (CENTURIES, CHECK_WEIGHTS, DIGIT_TABLE, GOVERNORATES, RULE_PENALTIES, STRATEGY_WEIGHTS,
+                         find_national_id)
+
+# This file contains the bulk (vectorized) counterpart of national_id.find_national_id.
+# It re-extracts National IDs from a whole column of stored OCR texts with columnar string
+# kernels and NumPy digit arithmetic instead of one Python call per row, joins the result
+# against the sheet's 'nationality_id' column in one go, and summarises the mismatches
+# (digit-level Hamming distance and which digits OCR confuses, e.g. 1 read as 7).
+#
+#   python bulk_extract.py ocr_texts.parquet "nettinghub users ids.xlsx"
+#
+# The texts file (CSV or Parquet) needs an 'id' column matching the sheet and a 'text' column.
+
+# Text work runs in pyarrow's compute kernels (RE2), which process a whole column natively
+# and are an order of magnitude faster than per-row Python regexes. RE2 has no look-arounds,
+# so digit boundaries are written as (^|[^0-9]) ... ([^0-9]|$).
+_DATE_PATTERN = r'(^|[^0-9])[0-9]{4}/[0-9]{1,2}(/[0-9]{1,2})?([^0-9]|$)'
+
+# Candidates are enumerated like the scalar extractor's: the digit runs of every text are
+# found in one pass over the column's byte buffer, and every run of 14 digits (contiguous),
+# every line whose runs add up to 14 digits (line), every pair of adjacent 7-digit runs
+# (split) and every 14-digit window of a longer run (embedded) becomes a candidate. Each
+# candidate keeps the position at which find_national_id would yield it, so ties go to the
+# same candidate.
+_ID_STARTS = (ord('2'), ord('3'))
+
+# Texts re-extracted with the scalar extractor too, to check the two agree.
+PARITY_SAMPLE = 1000
+
+_GOVERNORATE_CODES = np.array([int(code) for code in GOVERNORATES])
+_CENTURY_DIGITS = np.array([int(digit) for digit in CENTURIES])
+_WEIGHTS = np.array(CHECK_WEIGHTS)
+
+def normalize_column(texts) -> pa.Array:
+    """Vectorized national_id.normalize_digits over a column of texts (nulls become '')."""
+    column = pc.fill_null(pa.array(texts, type=pa.string(), from_pandas=True), '')
+    for code, digit in DIGIT_TABLE.items():
+        column = pc.replace_substring(column, chr(code), chr(digit))
+    return column
+
+def digit_matrix(ids) -> np.ndarray:
+    """
+    Converts a column of 14-digit strings to an (n, 14) uint8 digit matrix.
+    Entries that are not 14 ASCII digits become a row of 255s.
+    """
+    ids = pa.array(ids, type=pa.string(), from_pandas=True)
+    ok = pc.fill_null(pc.match_substring_regex(ids, r'^[0-9]{14}$'), False)
+    # Every value is now exactly 14 bytes, so the string data buffer is the digit matrix.
+    filled = pc.if_else(ok, ids, '0' * 14)
+    data = np.frombuffer(filled.buffers()[2], dtype=np.uint8, count=len(filled) * 14)
+    digits = data.reshape(-1, 14) - ord('0')
+    ok = ok.to_numpy(zero_copy_only=False)
+    digits[~ok] = 255
+    return digits
+
+def structural_penalty(ids, today: datetime.date | None = None) -> np.ndarray:
+    """Vectorized national_id.validation_errors: the summed RULE_PENALTIES per ID (1.0 when missing)."""
+    digits = digit_matrix(ids)
+    present = digits[:, 0] != 255
+    century = np.isin(digits[:, 0], _CENTURY_DIGITS)
+
+    year = np.where(digits[:, 0] == 3, 2000, 1900) + digits[:, 1] * 10 + digits[:, 2]
+    month = digits[:, 3].astype(int) * 10 + digits[:, 4]
+    day = digits[:, 5].astype(int) * 10 + digits[:, 6]
+    born = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': day}), errors='coerce')
+    birth_date = (born.notna() & (born <= pd.Timestamp(today or datetime.date.today()))).to_numpy()
+
+    governorate = np.isin(digits[:, 7].astype(int) * 10 + digits[:, 8], _GOVERNORATE_CODES)
+    check = (11 - (digits[:, :13].astype(int) @ _WEIGHTS) % 11) % 10 == digits[:, 13]
+
+    penalty = (RULE_PENALTIES['century'] * ~century + RULE_PENALTIES['birth_date'] * ~birth_date
+               + RULE_PENALTIES['governorate'] * ~governorate + RULE_PENALTIES['check_digit'] * ~check)
+    return np.where(present, penalty, 1.0)
+
+def _buffers(column: pa.Array) -> tuple[np.ndarray, np.ndarray]:
+    """The (n + 1) value offsets and the UTF-8 data of a string column, as NumPy arrays."""
+    _, offsets, data = column.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int32, count=column.offset + len(column) + 1)[column.offset:]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.zeros(0, dtype=np.uint8)
+    return offsets.astype(np.int64) - offsets[0], data[offsets[0]:offsets[-1]]
+
+def _candidates(column: pa.Array) -> pd.DataFrame:
+    """
+    Every ID candidate of every text in a cleaned column (Western digits, dates removed).
+    Returns one row per candidate: 'row', 'position' (where the scalar extractor yields it),
+    'strategy' and 'candidate'.
+    """
+    offsets, data = _buffers(column)
+    rows_count = len(offsets) - 1
+    is_digit = (data >= ord('0')) & (data <= ord('9'))
+    row_start = np.zeros(len(data), dtype=bool)
+    row_start[offsets[:-1][offsets[:-1] < len(data)]] = True
+
+    # Digit runs never span two texts.
+    starts = np.flatnonzero(is_digit & (row_start | ~np.concatenate(([False], is_digit[:-1]))))
+    ends = np.flatnonzero(is_digit & (np.concatenate((row_start[1:], [True])) | ~np.concatenate((is_digit[1:], [False])))) + 1
+    lengths = ends - starts
+    run_rows = np.searchsorted(offsets, starts, side='right') - 1
+    first = data[starts] if len(starts) else np.zeros(0, dtype=np.uint8)
+    id_start = np.isin(first, _ID_STARTS)
+
+    found = []  # (rows, positions, strategy, start byte of the candidate's first digit)
+
+    contiguous = (lengths == 14) & id_start
+    found.append((run_rows[contiguous], starts[contiguous], 'contiguous', starts[contiguous]))
+
+    # A run of 7 right after another run of 7 in the same text.
+    pairs = np.flatnonzero((lengths[1:] == 7) & (lengths[:-1] == 7) & id_start[:-1] & (run_rows[1:] == run_rows[:-1])) + 1
+    found.append((run_rows[pairs], starts[pairs], 'split', starts[pairs - 1]))
+
+    # Every window of a longer run that starts with a century digit.
+    long_runs = np.flatnonzero(lengths > 14)
+    windows = lengths[long_runs] - 13
+    window_runs = np.repeat(long_runs, windows)
+    window_starts = starts[window_runs] + np.arange(windows.sum()) - np.repeat(np.cumsum(windows) - windows, windows)
+    keep = np.isin(data[window_starts], _ID_STARTS)
+    found.append((run_rows[window_runs][keep], window_starts[keep], 'embedded', window_starts[keep]))
+
+    # Lines of two or more runs adding up to 14 digits; yielded at the line break (or the end of the text).
+    newlines = np.flatnonzero(data == ord('\n'))
+    line_keys = np.searchsorted(newlines, starts)  # Lines never span texts: a text boundary is a line boundary too.
+    line_keys = line_keys + run_rows * (len(newlines) + 1)
+    boundaries = np.flatnonzero(np.diff(line_keys, prepend=-1))
+    line_runs = np.diff(np.append(boundaries, len(starts)))
+    line_lengths = np.add.reduceat(lengths, boundaries) if len(boundaries) else np.zeros(0, dtype=np.int64)
+    lines = boundaries[(line_runs > 1) & (line_lengths == 14) & id_start[boundaries]]
+    line_rows = run_rows[lines]
+    line_ends = np.minimum(np.append(newlines, len(data))[np.searchsorted(newlines, starts[lines])], offsets[line_rows + 1])
+    found.append((line_rows, line_ends, 'line', starts[lines]))
+
+    # The 14 digits of a candidate are the 14 digits that follow its first one in the buffer.
+    digit_positions = np.flatnonzero(is_digit)
+    first_digits = np.concatenate([f[3] for f in found])
+    indices = np.searchsorted(digit_positions, first_digits)[:, None] + np.arange(14)
+    digits = data[digit_positions[indices]] if len(first_digits) else np.zeros((0, 14), dtype=np.uint8)
+    return pd.DataFrame({
+        'row': np.concatenate([f[0] for f in found]).astype(np.int64),
+        'position': np.concatenate([f[1] for f in found]).astype(np.int64),
+        'strategy': np.concatenate([np.full(len(f[0]), f[2], dtype=object) for f in found]),
+        'candidate': np.ascontiguousarray(digits).view('S14').ravel().astype(str).astype(object),
+    }) if rows_count else pd.DataFrame(columns=['row', 'position', 'strategy', 'candidate'])
+
+def bulk_extract(texts: pd.Series, today: datetime.date | None = None) -> pd.DataFrame:
+    """
+    Extracts the best National ID candidate from every text. Returns a frame aligned with
+    `texts` with 'extracted_id', 'strategy', 'confidence' and 'valid' columns. Scoring matches
+    the scalar extractor (strategy weight x structural rules); ties go to the candidate
+    found first in the text, the order in which find_national_id yields them.
+    """
+    cleaned = normalize_column(texts)
+    # Twice, because a match consumes the separator the next adjacent date needs.
+    for _ in range(2):
+        cleaned = pc.replace_substring_regex(cleaned, _DATE_PATTERN, r'\1\3')
+
+    candidates = _candidates(cleaned)
+    weights = candidates['strategy'].map(STRATEGY_WEIGHTS).to_numpy(dtype=float)
+    raw = weights * (1 - structural_penalty(candidates['candidate'].to_numpy(), today))
+    # Python's round, not np.round: the two disagree on halves such as 0.2975 and the scores must match.
+    candidates['confidence'] = np.fromiter(map(round, raw.tolist(), repeat(3)), dtype=float, count=len(raw))
+    candidates['valid'] = candidates['confidence'] == weights
+    # Highest score first, then text order, as in find_national_id.
+    best = (candidates.sort_values(['row', 'confidence', 'position'], ascending=[True, False, True], kind='stable')
+            .drop_duplicates('row').set_index('row')
+            .reindex(np.arange(len(texts))))
+    found = best['confidence'].fillna(0).to_numpy() > 0
+    return pd.DataFrame({
+        'extracted_id': np.where(found, best['candidate'].to_numpy(dtype=object), None),
+        'strategy': np.where(found, best['strategy'].to_numpy(dtype=object), None),
+        'confidence': best['confidence'].fillna(0).to_numpy(dtype=float),
+        'valid': best['valid'].fillna(False).to_numpy(dtype=bool),
+    }, index=texts.index)
+
+def parity_mismatches(texts: pd.Series, today: datetime.date | None = None) -> pd.DataFrame:
+    """
+    Rows where bulk_extract and national_id.find_national_id disagree on the extracted ID
+    or its confidence (empty when the two extractors agree), for checking a sample of texts.
+    """
+    today = today or datetime.date.today()
+    bulk = bulk_extract(texts, today)
+    scalar = [find_national_id(text, today) if isinstance(text, str) else None for text in texts]
+    scalar_ids = pd.Series([match.national_id if match else None for match in scalar], index=texts.index, dtype=object)
+    scalar_confidence = pd.Series([match.confidence if match else 0.0 for match in scalar], index=texts.index)
+    differs = ((bulk['extracted_id'].fillna('') != scalar_ids.fillna(''))
+               | ((bulk['confidence'] - scalar_confidence).abs() > 1e-9))
+    return pd.DataFrame({'text': texts, 'bulk': bulk['extracted_id'], 'scalar': scalar_ids})[differs]
+
+def match_extracted(extracted: pd.Series, expected: pd.Series) -> pd.DataFrame:
+    """Compares extracted IDs with expected ones: 'is_match' and the digit-level 'hamming' distance."""
+    extracted_digits, expected_digits = digit_matrix(extracted), digit_matrix(expected)
+    comparable = (extracted_digits[:, 0] != 255) & (expected_digits[:, 0] != 255)
+    hamming = pd.Series((extracted_digits != expected_digits).sum(axis=1), index=extracted.index, dtype='Int64')
+    return pd.DataFrame({
+        'is_match': extracted.notna() & (extracted == expected),
+        'hamming': hamming.mask(~comparable),
+    }, index=extracted.index)
+
+def rescore(texts: pd.DataFrame, sheet: pd.DataFrame, key: str = 'id', text_column: str = 'text',
+            expected_column: str = 'nationality_id', today: datetime.date | None = None) -> pd.DataFrame:
+    """
+    Re-extracts IDs from `texts[text_column]` and joins them to `sheet[expected_column]` on `key`.
+    Returns one row per text with the extraction columns plus 'is_match' and 'hamming'.
+    """
+    frame = texts[[key, text_column]].merge(sheet[[key, expected_column]], on=key, how='left')
+    frame = frame.join(bulk_extract(frame[text_column], today))
+    return frame.join(match_extracted(frame['extracted_id'], frame[expected_column].astype(object)))
+
+def confusion_stats(frame: pd.DataFrame, expected_column: str = 'nationality_id', max_distance: int = 2) -> dict:
+    """
+    Summarises the mismatches of a rescored frame. Near misses (Hamming distance 1..max_distance)
+    are broken down into digit confusions (expected digit -> read digit) and the positions they hit.
+    """
+    near = frame[frame['hamming'].between(1, max_distance)]
+    expected_digits = digit_matrix(near[expected_column].astype(object))
+    extracted_digits = digit_matrix(near['extracted_id'])
+    rows, positions = np.nonzero(expected_digits != extracted_digits)
+    pairs = pd.DataFrame({'expected': expected_digits[rows, positions], 'read': extracted_digits[rows, positions]})
+    return {
+        'rows': len(frame),
+        'matched': int(frame['is_match'].sum()),
+        'not_found': int(frame['extracted_id'].isna().sum()),
+        'invalid_structure': int((frame['extracted_id'].notna() & ~frame['valid']).sum()),
+        'hamming': {int(k): int(v) for k, v in frame['hamming'].value_counts().sort_index().items()},
+        'by_strategy': frame['strategy'].value_counts().to_dict(),
+        'confusions': pd.crosstab(pairs['expected'], pairs['read']),
+        'positions': {int(k): int(v) for k, v in pd.Series(positions + 1).value_counts().sort_index().items()},
+    }
+
+def read_texts(path: str) -> pd.DataFrame:
+    """Reads the stored OCR texts (CSV or Parquet) with 'id' as a string key."""
+    texts = pd.read_parquet(path) if path.lower().endswith('.parquet') else pd.read_csv(path, dtype=str, keep_default_na=False)
+    return texts.astype({'id': str})
+
+def read_sheet(path: str) -> pd.DataFrame:
+    """Reads the sheet through sheet_reader so IDs are normalized exactly like the app does."""
+    return pd.DataFrame(iter_sheet_rows(path), columns=SheetRow._fields)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python bulk_extract.py <ocr_texts.csv|parquet> <sheet.xlsx|csv|parquet>")
+        sys.exit(1)
+    import time
+
+    texts, sheet = read_texts(sys.argv[1]), read_sheet(sys.argv[2])
+    start = time.perf_counter()
+    result = rescore(texts, sheet)
+    stats = confusion_stats(result)
+    elapsed = time.perf_counter() - start
+    mismatches = parity_mismatches(texts['text'].head(PARITY_SAMPLE))
+
+    print(f"📊 Rescored {stats['rows']} rows in {elapsed:.1f}s: {stats['matched']} matched, "
+          f"{stats['not_found']} without an ID, {stats['invalid_structure']} structurally invalid.")
+    print(f"Strategies: {stats['by_strategy']}")
+    print(f"Hamming distance to nationality_id: {stats['hamming']}")
+    print(f"Near-miss positions (1-14): {stats['positions']}")
+    print("Digit confusions (rows = expected, columns = read):")
+    print(stats['confusions'])
+    if len(mismatches):
+        print(f"⚠️ {len(mismatches)} of the first {PARITY_SAMPLE} texts extract differently with national_id.find_national_id:")
+        print(mismatches.head(10).to_string())
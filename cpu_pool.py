@@ -0,0 +1,191 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import image_hash
+import orientation
+import preprocess
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+
+# This file contains the process pool for the CPU-bound image steps: decoding, perceptual
+# hashing, card crop/deskew/downscale, local orientation and the rotation re-encode. Run in the pipeline's
+# threads these steps hold the GIL and compete with the network I/O of the download and
+# OCR stages; here they run in worker processes, one per core by default, so a many-core
+# machine can prepare images as fast as a highly concurrent OCR stage consumes them.
+#
+# Image bytes are not pickled into the task queue. The caller copies them once into a
+# shared-memory block, the worker decodes straight from that block and writes its result
+# back into it when it fits (prepared images never grow), and only small results such as
+# hashes travel back pickled. Blocks are reused from call to call and workers keep them
+# mapped, so a call costs one copy in and one copy out, without new mappings or page
+# faults. The pool owns every block until it is closed, which also keeps them alive on
+# Windows, where a block disappears once no process has it open.
+#
+# Workers are never forked from the caller: the app is multi-threaded, and a child forked
+# while another thread holds a lock (sqlite, logging, the requests pool) can deadlock. They
+# are started through a fork server on POSIX and spawned elsewhere, so, as with any spawned
+# process, they import the main script as __mp_main__ and its top level must stay side-effect
+# free outside the `__main__` guard. One pool is meant to be shared by every run of a process.
+# A worker that dies (killed for memory, or a crash in OpenCV) breaks the whole executor;
+# the pool then starts a fresh one and retries the calls it failed once, so only an image
+# that kills its worker again fails, and later images and runs keep working.
+
+# Blocks are allocated in multiples of this size
+BLOCK_SIZE_STEP = 1 << 20
+
+# Tags for how a worker hands its result back
+_UNCHANGED, _IN_BLOCK, _VALUE = 0, 1, 2
+
+# Worker side: blocks this process has attached to, by name
+_attached: dict[str, shared_memory.SharedMemory] = {}
+
+def _context():
+    """forkserver where available (POSIX), spawn elsewhere; never a plain fork of the caller."""
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                       else 'spawn')
+
+def _init_worker():
+    # One OpenCV thread per process; the pool already spreads the work over the cores.
+    cv2.setNumThreads(1)
+
+def _run_in_worker(fn, name: str, size: int, args: tuple) -> tuple:
+    """Worker side: calls fn(<view of the block>, *args) and reports the result as (tag, value)."""
+    block = _attached.get(name)
+    if block is None:
+        block = _attached[name] = shared_memory.SharedMemory(name)
+    view = block.buf[:size]
+    try:
+        result = fn(view, *args)
+        if result is view:
+            return _UNCHANGED, None
+        if isinstance(result, bytes) and len(result) <= block.size:
+            block.buf[:len(result)] = result
+            return _IN_BLOCK, len(result)
+        return _VALUE, result
+    finally:
+        result = None
+        view.release()
+
+class CpuPool:
+    """
+    Runs the image steps in `workers` processes (None: one per core). With workers=0 every
+    call runs inline in the calling thread, exactly as before the pool existed. Methods
+    block the calling thread until the result is ready, so a pipeline stage needs at least
+    `workers` threads to keep every process busy.
+    """
+
+    def __init__(self, workers: int | None = None):
+        self.workers = (os.cpu_count() or 1) if workers is None else max(workers, 0)
+        self._executor = None
+        self._blocks: list[shared_memory.SharedMemory] = []  # free blocks, smallest first
+        self._all_blocks: list[shared_memory.SharedMemory] = []
+        self._lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        self._retry_lock = threading.Lock()
+        self.restarts = 0
+        if self.workers:
+            if os.name == 'posix':
+                # Workers must share the parent's tracker; one of their own would "clean up"
+                # (and warn about) every block they attached to when they exit.
+                resource_tracker.ensure_running()
+            self._executor = self._start_executor()
+
+    def _start_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_context(), initializer=_init_worker)
+        # Start the fork server and a first worker now rather than on the first image.
+        executor.submit(int).result()
+        return executor
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        """Replaces `broken` with a new executor, unless another thread already did."""
+        with self._restart_lock:
+            if self._executor is not broken:
+                return
+            print(f"⚠️ An image worker process died; restarting the pool of {self.workers} workers.")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._start_executor()
+            self.restarts += 1
+
+    def _call(self, fn, content: bytes, *args):
+        if self._executor is None or not content:
+            return fn(content, *args)
+        block = self._take_block(len(content))
+        try:
+            try:
+                tag, value = self._submit(fn, block, content, args)
+            except BrokenProcessPool:
+                # Retried one call at a time, so an image that kills its worker again only fails itself.
+                with self._retry_lock:
+                    tag, value = self._submit(fn, block, content, args)
+            if tag == _UNCHANGED:
+                return content
+            if tag == _IN_BLOCK:
+                return bytes(block.buf[:value])
+            return value
+        finally:
+            self._give_block(block)
+
+    def _submit(self, fn, block: shared_memory.SharedMemory, content: bytes, args: tuple) -> tuple:
+        executor = self._executor
+        # Copied on every attempt: a worker that died mid-call may have written to the block.
+        block.buf[:len(content)] = content
+        try:
+            return executor.submit(_run_in_worker, fn, block.name, len(content), args).result()
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise
+
+    def _take_block(self, size: int) -> shared_memory.SharedMemory:
+        """The smallest free block that holds `size` bytes, or a new one."""
+        with self._lock:
+            for i, block in enumerate(self._blocks):
+                if block.size >= size:
+                    return self._blocks.pop(i)
+        block = shared_memory.SharedMemory(create=True, size=-(-size // BLOCK_SIZE_STEP) * BLOCK_SIZE_STEP)
+        with self._lock:
+            self._all_blocks.append(block)
+        return block
+
+    def _give_block(self, block: shared_memory.SharedMemory):
+        with self._lock:
+            self._blocks.append(block)
+            self._blocks.sort(key=lambda b: b.size)
+
+    def image_hashes(self, content: bytes) -> tuple[int, int, bytes] | None:
+        """image_hash.image_hashes in a worker process."""
+        return self._call(image_hash.image_hashes, content)
+
+    def prepare_for_ocr(self, content: bytes, mode: str = 'card', max_side: int = 1600) -> bytes:
+        """preprocess.prepare_for_ocr in a worker process."""
+        return self._call(preprocess.prepare_for_ocr, content, mode, max_side)
+
+    def rotate_upright(self, content: bytes, angle: float) -> bytes:
+        """preprocess.rotate_upright in a worker process."""
+        return self._call(preprocess.rotate_upright, content, angle)
+
+    def estimate_orientation(self, content: bytes) -> orientation.Orientation | None:
+        """orientation.estimate_orientation in a worker process."""
+        return self._call(orientation.estimate_orientation, content)
+
+    def apply_orientation(self, content: bytes, angle: int, skew: float = 0.0, exif: int = 1) -> bytes:
+        """orientation.apply_orientation in a worker process."""
+        return self._call(orientation.apply_orientation, content, angle, skew, exif)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for block in self._all_blocks:
+            block.close()
+            block.unlink()
+        self._blocks, self._all_blocks = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
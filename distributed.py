@@ -0,0 +1,225 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+
+import id_registry
+import metrics
+import pipeline
+import process_logic
+from cpu_pool import CpuPool
+from downloader import get_default_downloader
+from ocr_engines import build_engine
+from rate_limit import AdaptiveRateLimiter
+from result_sink import open_sink
+from sheet_reader import iter_sheet_rows
+from vision_batch import BatchingVisionClient
+from work_queue import open_queue, shard_rows
+
+# This file contains the sharded, multi-node mode of the verification run.
+# One machine is bounded by its share of the Vision quota and by its network link, so a
+# coordinator splits the sheet's rows into shards on a durable work queue (work_queue.py)
+# and any number of worker processes, on one machine or many, lease shards and run them
+# through the same download -> OCR -> extract pipeline as the web app (pipeline.py).
+# Workers renew their lease with heartbeats; a shard whose worker died is handed to the
+# next worker once its lease expires.
+#
+#   python distributed.py coordinator sheet.xlsx --wait --output results.parquet
+#   python distributed.py worker                       (on every node, as many as wanted)
+#   python distributed.py run sheet.xlsx --workers 4   (all of the above on one machine)
+#   python distributed.py status
+#
+# Every node must reach the queue: the default SQLite file works for the processes of one
+# machine, or for several machines through a shared folder (see work_queue.BACKENDS).
+
+# Queue URL (a SQLite file path, or backend://...)
+QUEUE_URL = os.environ.get('WORK_QUEUE', 'work_queue.sqlite3')
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', '200'))
+
+# A worker renews its lease every LEASE_SECONDS / 3; a shard is reassigned when a lease is
+# not renewed for LEASE_SECONDS. Shards that fail MAX_ATTEMPTS times are given up on.
+LEASE_SECONDS = float(os.environ.get('LEASE_SECONDS', '60'))
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', '3'))
+POLL_INTERVAL = 2.0  # seconds between queue checks of idle workers and of the coordinator
+
+# Worker settings, as in app.py
+KEY_PATH = os.environ.get('VISION_KEY_PATH', r"D:\National Id Scan\Key.json")
+OCR_ENGINE = os.environ.get('OCR_ENGINE', 'vision')
+VISION_RATE_LIMIT = 25
+VISION_MAX_RATE_LIMIT = 1800
+# Image-step processes per worker; worker processes already spread over the cores, so the
+# image steps run in each worker's own threads by default.
+WORKER_CPU_WORKERS = int(os.environ.get('WORKER_CPU_WORKERS', '0'))
+CROSS_CHECK_IDS = True
+ID_REGISTRY_FOLDER = 'id_registries'
+
+def sheet_items(sheet_path: str):
+    """The sheet's rows as pipeline items (see app.job_rows)."""
+    for row in iter_sheet_rows(sheet_path):
+        yield {
+            'row_number': row.row_number,
+            'excel_row_id': row.id,
+            'excel_nationality_id': row.nationality_id,
+            'image_url': row.back_link,
+        }
+
+# --- Coordinator ---
+def submit(queue, sheet_path: str, job_id: str | None = None, shard_size: int = SHARD_SIZE) -> str:
+    """Splits the sheet into shards on the queue. Submitting the same job id again changes nothing."""
+    job_id = job_id or uuid.uuid4().hex[:12]
+    sheet_path = os.path.abspath(sheet_path)
+    if CROSS_CHECK_IDS:
+        # Built once here, so the workers of this machine only memory-map it.
+        id_registry.load_or_build(sheet_path, ID_REGISTRY_FOLDER)
+    shards = queue.submit(job_id, shard_rows(sheet_items(sheet_path), shard_size), {'sheet_path': sheet_path})
+    print(f"📦 Job {job_id}: {shards} shards on the queue for {sheet_path}")
+    return job_id
+
+def wait(queue, job_id: str, processes: list | None = None) -> dict:
+    """Prints the job's progress until no shard is pending or leased (or every local worker has exited)."""
+    while True:
+        progress = queue.progress(job_id)
+        print(f"⏳ Job {job_id}: {progress['done']} done, {progress['leased']} leased, "
+              f"{progress['pending']} pending, {progress['failed']} failed")
+        if not progress['pending'] and not progress['leased']:
+            return progress
+        if processes and all(p.poll() is not None for p in processes):
+            print("❌ Every worker has exited with shards left.")
+            return progress
+        time.sleep(POLL_INTERVAL)
+
+def export(queue, job_id: str, output: str) -> int:
+    """Streams the job's results, in shard order, to `output` (.sqlite3, .parquet or .csv)."""
+    with open_sink(output, pipeline.RESULT_COLUMNS, key=('row_number',)) as sink:
+        for result in queue.results(job_id):
+            sink.write(result)
+    print(f"💾 {sink.written} results written to {sink.path}")
+    return sink.written
+
+# --- Worker ---
+def _keep_leased(queue, shard, stop: threading.Event, lost: threading.Event):
+    """Heartbeat loop: renews the lease until `stop`, flagging `lost` if the shard was reassigned."""
+    while not stop.wait(LEASE_SECONDS / 3):
+        if not queue.heartbeat(shard, LEASE_SECONDS):
+            lost.set()
+            return
+
+def run_worker(queue, worker_id: str, exit_when_idle: bool = False) -> int:
+    """Leases and processes shards until the queue is drained (with `exit_when_idle`) or forever."""
+    engine = build_engine('local') if OCR_ENGINE == 'local' else None
+    vision_client = None
+    if OCR_ENGINE != 'local':
+        vision_client = process_logic.setup_vision_client(KEY_PATH)
+        if not vision_client:
+            print("Could not start. Please check the Google Vision API key path.")
+            return 1
+
+    limiter = AdaptiveRateLimiter(rate=VISION_RATE_LIMIT, max_rate=VISION_MAX_RATE_LIMIT)
+    config = pipeline.PipelineConfig(cpu_workers=WORKER_CPU_WORKERS)
+    registries = {}
+    processed = 0
+    # One image pool for every shard this worker processes
+    with BatchingVisionClient(vision_client, rate_limiter=limiter) if vision_client else nullcontext() as client, \
+            CpuPool(config.cpu_workers) as cpu_pool:
+        if engine is None and OCR_ENGINE != 'vision':
+            engine = build_engine(OCR_ENGINE, client)
+        while True:
+            shard = queue.lease(worker_id, LEASE_SECONDS)
+            if shard is None:
+                progress = queue.progress()
+                if exit_when_idle and not progress['pending'] and not progress['leased']:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            if shard.job_id not in registries:
+                sheet_path = (queue.job(shard.job_id) or {}).get('sheet_path')
+                registries[shard.job_id] = id_registry.load_or_build(sheet_path, ID_REGISTRY_FOLDER) \
+                    if CROSS_CHECK_IDS and sheet_path and os.path.exists(sheet_path) else None
+            print(f"🧩 {worker_id}: shard {shard.number} of job {shard.job_id} "
+                  f"({len(shard.rows)} rows, attempt {shard.attempts})")
+            stop, lost = threading.Event(), threading.Event()
+            heartbeat = threading.Thread(target=_keep_leased, args=(queue, shard, stop, lost), daemon=True)
+            heartbeat.start()
+            try:
+                results = list(pipeline.verify_rows(
+                    shard.rows, client, get_default_downloader().fetch, config, engine=engine,
+                    registry=registries[shard.job_id], near_miss=True, cpu_pool=cpu_pool))
+            except Exception as e:
+                print(f"❌ Shard {shard.number} of job {shard.job_id} failed: {e}")
+                queue.fail(shard, str(e))
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+            if queue.complete(shard, sorted(results, key=lambda r: r['row_number'])):
+                processed += len(results)
+            else:
+                print(f"⚠️ Lost the lease on shard {shard.number} of job {shard.job_id}"
+                      f"{' (heartbeat failed)' if lost.is_set() else ''}; its results were dropped.")
+    print(f"✅ {worker_id}: {processed} rows processed.")
+    print(metrics.REGISTRY.summary())
+    return 0
+
+# --- Local launch ---
+def launch_workers(count: int, queue_url: str) -> list:
+    """Starts `count` worker processes on this machine that exit once the queue is drained."""
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--queue', queue_url, 'worker',
+                              '--worker-id', f"{socket.gethostname()}-{n}", '--exit-when-idle'])
+            for n in range(count)]
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Sharded verification run over a durable work queue.")
+    parser.add_argument('--queue', default=QUEUE_URL, help="queue URL or SQLite file (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    coordinator = commands.add_parser('coordinator', help="split a sheet into shards on the queue")
+    run = commands.add_parser('run', help="coordinator plus local worker processes")
+    for command in (coordinator, run):
+        command.add_argument('sheet')
+        command.add_argument('--job-id')
+        command.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+        command.add_argument('--output', help="write the results here once done (.sqlite3, .parquet or .csv)")
+    coordinator.add_argument('--wait', action='store_true', help="wait for the job to finish")
+    run.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+
+    worker = commands.add_parser('worker', help="lease and process shards")
+    worker.add_argument('--worker-id', default=f"{socket.gethostname()}-{os.getpid()}")
+    worker.add_argument('--exit-when-idle', action='store_true', help="exit once no shard is pending or leased")
+
+    status = commands.add_parser('status', help="shard counts per state")
+    status.add_argument('--job-id')
+
+    args = parser.parse_args(argv)
+    queue = open_queue(args.queue, max_attempts=MAX_ATTEMPTS)
+    try:
+        if args.command == 'worker':
+            return run_worker(queue, args.worker_id, args.exit_when_idle)
+        if args.command == 'status':
+            print(queue.progress(args.job_id))
+            return 0
+
+        job_id = submit(queue, args.sheet, args.job_id, args.shard_size)
+        processes = launch_workers(args.workers, args.queue) if args.command == 'run' else []
+        if processes or args.wait:
+            progress = wait(queue, job_id, processes)
+            for process in processes:
+                process.wait()
+            for number, error in queue.errors(job_id):
+                print(f"❌ Shard {number} failed: {error}")
+            if args.output:
+                export(queue, job_id, args.output)
+            return 0 if not progress['pending'] and not progress['leased'] and not progress['failed'] else 1
+        if args.output:
+            print("--output needs --wait: the results are only complete once the job is done.")
+        return 0
+    finally:
+        queue.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,8 @@
-import pandas as pd
-import requests
+from downloader import get_default_downloader
+from sheet_reader import iter_sheet_rows
+import metrics
 import os
+from itertools import chain, islice
 from urllib.parse import urlparse
 
 def download_images_from_excel(excel_path, output_folder='downloaded_images'):
@@ -12,12 +14,14 @@ def download_images_from_excel(excel_path, output_folder='downloaded_images'):
         output_folder (str): The name of the folder to save images in.
     """
     try:
-        # Read the entire Excel file into a pandas DataFrame
-        df = pd.read_excel(excel_path)
+        # Stream the 'back link' column row by row instead of loading the whole workbook
+        rows = iter_sheet_rows(excel_path, columns=('back link',))
 
-        # Print the first 50 rows of the DataFrame for preview
+        # Print the first 50 rows for preview
+        preview = list(islice(rows, 50))
         print("--- First 50 rows of your Excel file ---")
-        print(df.head(50))
+        for row in preview:
+            print(f"{row.row_number - 1:>6}  {row.back_link}")
         print("-----------------------------------------")
 
         # Create the output folder if it doesn't exist
@@ -25,28 +29,13 @@ def download_images_from_excel(excel_path, output_folder='downloaded_images'):
             os.makedirs(output_folder)
             print(f"Created folder: {output_folder}")
 
-        # Check if the 'back link' column exists
-        if 'back link' not in df.columns:
-            print("Error: 'back link' column not found in the Excel file.")
-            return
-
-        # Loop through each row in the DataFrame to download images
-        for index, row in df.iterrows():
-            image_url = row['back link']
-            if not isinstance(image_url, str) or not image_url.strip() or image_url.lower() == 'null':
-                print(f"Skipping row {index + 1}: 'back link' is empty, invalid, or NULL.")
-                continue
-
-            try:
-                # Get the image content with a timeout
-                headers = {'User-Agent': 'Mozilla/5.0'}  # Add user-agent to avoid server blocks
-                response = requests.get(image_url, stream=True, headers=headers, timeout=10)
-                response.raise_for_status()  # Raise an exception for bad status codes
-
-                # Check if the content type is an image
-                content_type = response.headers.get('content-type', '').lower()
-                if not content_type.startswith('image/'):
-                    print(f"Skipping row {index + 1}: URL {image_url} is not an image (Content-Type: {content_type}).")
+        def iter_jobs():
+            """Yields (url, filename) download jobs, skipping rows without a usable link."""
+            for row in chain(preview, rows):
+                index = row.row_number - 2
+                image_url = row.back_link
+                if not isinstance(image_url, str) or not image_url.strip() or image_url.lower() == 'null':
+                    print(f"Skipping row {index + 1}: 'back link' is empty, invalid, or NULL.")
                     continue
 
                 # Extract file extension from URL or default to .jpg
@@ -56,20 +45,19 @@ def download_images_from_excel(excel_path, output_folder='downloaded_images'):
                     file_ext = '.jpg'  # Default to .jpg if extension is unknown
 
                 # Create a filename for the image
-                filename = os.path.join(output_folder, f"image_{index + 1}{file_ext}")
-
-                # Save the image to the output folder
-                with open(filename, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
-                print(f"Successfully downloaded and saved {filename}")
-
-            except requests.exceptions.RequestException as e:
-                print(f"Error downloading {image_url}: {e}")
-            except IOError as e:
-                print(f"Error saving file {filename}: {e}")
-
+                yield image_url, os.path.join(output_folder, f"image_{index + 1}{file_ext}")
+
+        # Download concurrently over pooled keep-alive connections; images that have not
+        # changed since the last run are revalidated with ETag/Last-Modified and skipped.
+        for image_url, filename, success, message in get_default_downloader().download_many(iter_jobs()):
+            if success:
+                print(f"Successfully downloaded and saved {filename} ({message})")
+            else:
+                print(f"Error downloading {image_url}: {message}")
+        print(metrics.REGISTRY.summary())
+
+    except ValueError as e:
+        print(f"Error: {e}")
     except FileNotFoundError:
         print(f"Error: The file at {excel_path} was not found.")
     except Exception as e:
@@ -0,0 +1,265 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+# This file contains the shared image downloader used by app.py and download_images.py.
+# One requests.Session keeps a keep-alive connection pool per host, so images on the
+# same CDN reuse connections instead of paying a TLS handshake per row. 5xx answers and
+# timeouts are retried with exponential backoff, and ETag / Last-Modified validators are
+# remembered so an unchanged image is answered with 304 and not downloaded again. The
+# validated body is kept in the downloader's own cache folder under a hash of the URL,
+# together with its SHA-256, so a 304 never serves bytes some other caller wrote. The
+# folder is capped at `cache_max_bytes`; the least recently requested bodies are evicted.
+
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0'}
+DEFAULT_CACHE_MAX_BYTES = int(float(os.environ.get('DOWNLOAD_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+
+def error_category(error: Exception) -> str:
+    """Maps a download exception to an errors_total category (download_timeout, download_http_404, ...)."""
+    if isinstance(error, requests.exceptions.Timeout):
+        return 'download_timeout'
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return f'download_http_{error.response.status_code}'
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return 'download_connection'
+    if isinstance(error, requests.exceptions.RequestException):
+        return 'download_request'
+    return 'download_save'
+
+class Downloader:
+    """
+    Thread-safe pooled downloader. `max_concurrency` bounds the number of requests
+    in flight overall and the number of pooled connections kept per host.
+    """
+
+    def __init__(self, max_concurrency: int = 16, timeout: float = 15, retries: int = 3,
+                 backoff_factor: float = 0.5, validators_path: str | None = 'download_validators.sqlite3',
+                 cache_dir: str = 'download_cache', cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+                 session: requests.Session | None = None):
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=max_concurrency, pool_block=True, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+
+        self._lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_bytes = 0
+        self._validators = None
+        if validators_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._validators = sqlite3.connect(validators_path, check_same_thread=False)
+            columns = {row[1] for row in self._validators.execute('PRAGMA table_info(cached_bodies)')}
+            if columns and 'size' not in columns:
+                # Written before the cache had a size cap; start it over.
+                for (url,) in self._validators.execute('SELECT url FROM cached_bodies').fetchall():
+                    self._remove_body(url)
+                self._validators.execute('DROP TABLE cached_bodies')
+            self._validators.execute(
+                'CREATE TABLE IF NOT EXISTS cached_bodies ('
+                ' url TEXT PRIMARY KEY, sha256 TEXT NOT NULL, etag TEXT, last_modified TEXT,'
+                ' size INTEGER NOT NULL, last_used REAL NOT NULL)'
+            )
+            self._validators.execute('CREATE INDEX IF NOT EXISTS cached_bodies_last_used ON cached_bodies (last_used)')
+            self._validators.commit()
+            self.cache_bytes = self._validators.execute('SELECT COALESCE(SUM(size), 0) FROM cached_bodies').fetchone()[0]
+
+    # --- Validator store ---
+    def _body_path(self, url: str) -> str:
+        """Path of the cached body for `url`; owned by the downloader, never a caller's file."""
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.bin')
+
+    def _remove_body(self, url: str):
+        try:
+            os.remove(self._body_path(url))
+        except OSError:
+            pass
+
+    def _get_validators(self, url: str):
+        """Returns (sha256, etag, last_modified) for `url` or None, and refreshes its LRU timestamp."""
+        if self._validators is None:
+            return None
+        with self._lock:
+            row = self._validators.execute(
+                'SELECT sha256, etag, last_modified FROM cached_bodies WHERE url = ?', (url,)
+            ).fetchone()
+            if row is not None:
+                self._validators.execute('UPDATE cached_bodies SET last_used = ? WHERE url = ?', (time.time(), url))
+                self._validators.commit()
+        return row
+
+    def _set_validators(self, url: str, content: bytes, etag: str | None, last_modified: str | None):
+        """Caches `content` with its validators, or forgets `url` when the response had none."""
+        if self._validators is None:
+            return
+        if etag or last_modified:
+            self._save(self._body_path(url), content)
+        with self._lock:
+            old = self._validators.execute('SELECT size FROM cached_bodies WHERE url = ?', (url,)).fetchone()
+            if etag or last_modified:
+                self._validators.execute(
+                    'INSERT OR REPLACE INTO cached_bodies (url, sha256, etag, last_modified, size, last_used)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (url, hashlib.sha256(content).hexdigest(), etag, last_modified, len(content), time.time()),
+                )
+                self.cache_bytes += len(content) - (old[0] if old else 0)
+                self._evict()
+            elif old:
+                self._validators.execute('DELETE FROM cached_bodies WHERE url = ?', (url,))
+                self.cache_bytes -= old[0]
+                self._remove_body(url)
+            self._validators.commit()
+
+    def _evict(self):
+        while self.cache_bytes > self.cache_max_bytes:
+            rows = self._validators.execute(
+                'SELECT url, size FROM cached_bodies ORDER BY last_used LIMIT 64'
+            ).fetchall()
+            if not rows:
+                self.cache_bytes = 0
+                return
+            for url, size in rows:
+                self._validators.execute('DELETE FROM cached_bodies WHERE url = ?', (url,))
+                self._remove_body(url)
+                self.cache_bytes -= size
+                if self.cache_bytes <= self.cache_max_bytes:
+                    return
+
+    def _cached_body(self, url: str, sha256: str) -> bytes | None:
+        """Returns the cached body for `url` if it is still the one that was validated."""
+        try:
+            with open(self._body_path(url), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        return content if hashlib.sha256(content).hexdigest() == sha256 else None
+
+    # --- Downloading ---
+    def fetch(self, url, save_to: str | None = None) -> tuple[bool, str, bytes | None]:
+        """
+        Fetches an image into memory. Returns (success, message, content) where the
+        message is "Success", "Not Modified" or the reason the row failed. When `save_to`
+        is given the bytes are also written there (e.g. for UI thumbnails). Either way, a
+        response with ETag/Last-Modified is cached so the next fetch can revalidate it.
+        """
+        start = time.perf_counter()
+        success, message, content = self._fetch(url, save_to)
+        status = 'failed' if not success else 'not_modified' if message == "Not Modified" else 'ok'
+        metrics.DOWNLOAD_SECONDS.observe(time.perf_counter() - start, status=status)
+        if content is not None:
+            metrics.DOWNLOAD_BYTES.observe(len(content))
+        return success, message, content
+
+    def _fetch(self, url, save_to: str | None) -> tuple[bool, str, bytes | None]:
+        if not isinstance(url, str) or not url.strip() or url.lower() == 'null':
+            metrics.ERRORS.inc(category='download_invalid_url')
+            return False, "Invalid or empty URL", None
+
+        headers = {}
+        cached = self._get_validators(url)
+        cached_content = self._cached_body(url, cached[0]) if cached else None
+        if cached_content is not None:
+            if cached[1]:
+                headers['If-None-Match'] = cached[1]
+            if cached[2]:
+                headers['If-Modified-Since'] = cached[2]
+
+        try:
+            with self._slots:
+                with self.session.get(url, stream=True, headers=headers, timeout=self.timeout) as response:
+                    if response.status_code == 304 and cached_content is not None:
+                        if save_to:
+                            self._save(save_to, cached_content)
+                        return True, "Not Modified", cached_content
+                    response.raise_for_status()
+
+                    content_type = response.headers.get('content-type', '').lower()
+                    if not content_type.startswith('image/'):
+                        metrics.ERRORS.inc(category='download_not_image')
+                        return False, f"URL is not an image (Content-Type: {content_type})", None
+                    content = response.content
+
+            if save_to:
+                self._save(save_to, content)
+            self._set_validators(url, content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            return True, "Success", content
+        except requests.exceptions.RequestException as e:
+            metrics.ERRORS.inc(category=error_category(e))
+            return False, f"Download error: {e}", None
+        except IOError as e:
+            metrics.ERRORS.inc(category=error_category(e))
+            return False, f"File save error: {e}", None
+
+    def _save(self, path: str, content: bytes):
+        # Write to a temporary file first so an interrupted write never
+        # leaves a truncated image under the final name.
+        # The thread id keeps concurrent fetches of one URL from sharing a partial file.
+        partial_path = f'{path}.{threading.get_ident()}.part'
+        with open(partial_path, 'wb') as f:
+            f.write(content)
+        os.replace(partial_path, path)
+
+    def download(self, url, output_path: str) -> tuple[bool, str]:
+        """Downloads a single image to `output_path`. Returns (success, message)."""
+        success, message, _ = self.fetch(url, output_path)
+        return success, message
+
+    def download_many(self, jobs: Iterable[tuple[str, str]], workers: int | None = None) -> Iterator[tuple[str, str, bool, str]]:
+        """
+        Downloads (url, output_path) pairs concurrently and yields
+        (url, output_path, success, message) in input order. `jobs` is consumed
+        lazily, with at most a few downloads per worker queued at a time.
+        """
+        workers = workers or self.max_concurrency
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            for url, output_path in jobs:
+                in_flight.append((url, output_path, executor.submit(self.download, url, output_path)))
+                if len(in_flight) >= workers * 2:
+                    url, output_path, future = in_flight.popleft()
+                    yield url, output_path, *future.result()
+            while in_flight:
+                url, output_path, future = in_flight.popleft()
+                yield url, output_path, *future.result()
+
+    def close(self):
+        self.session.close()
+        if self._validators is not None:
+            with self._lock:
+                self._validators.close()
+
+_default_downloader = None
+_default_downloader_lock = threading.Lock()
+
+def get_default_downloader() -> Downloader:
+    """Returns the process-wide downloader so every caller shares one connection pool."""
+    global _default_downloader
+    with _default_downloader_lock:
+        if _default_downloader is None:
+            _default_downloader = Downloader()
+        return _default_downloader
@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the Google Vision REST API (POST /v1/images:annotate).
+# It answers text_detection / document_text_detection / batch_annotate_images
+# requests with canned text looked up by the SHA-256 of the image bytes, so the
+# pipeline can be exercised without credentials, network access or billing.
+#
+# Point the app at it with:
+#   VISION_API_ENDPOINT=http://127.0.0.1:8089 python app.py
+#
+# With `image_quota` it also enforces a quota of that many images per `quota_window`
+# seconds, answering over-quota requests the way Vision does: HTTP 429 RESOURCE_EXHAUSTED
+# for the whole request, or (quota_response='image') a per-image RESOURCE_EXHAUSTED status.
+#
+# For benchmarks it can also behave like a real, imperfect backend: every RPC takes
+# `latency` seconds plus up to `latency_jitter` more, a fraction `rpc_error_rate` of RPCs
+# fail with HTTP 503 UNAVAILABLE, and a fraction `error_rate` of images get a per-image
+# INTERNAL error. The random draws come from `seed`, so runs are reproducible.
+
+def build_annotation(text: str) -> dict:
+    """Builds a minimal AnnotateImageResponse JSON body carrying `text`."""
+    if not text:
+        return {}
+    return {
+        'textAnnotations': [{'description': text}],
+        'fullTextAnnotation': {'text': text},
+    }
+
+class FakeVisionServer:
+    """
+    Serves canned OCR results. `texts` maps image SHA-256 hex digests to the text
+    the fake should "read"; unknown images get `default_text`.
+    """
+
+    def __init__(self, texts: dict | None = None, default_text: str = '', host: str = '127.0.0.1', port: int = 0,
+                 image_quota: int | None = None, quota_window: float = 1.0, quota_response: str = 'http',
+                 latency: float = 0.0, latency_jitter: float = 0.0, error_rate: float = 0.0,
+                 rpc_error_rate: float = 0.0, seed: int | None = None):
+        self.texts = dict(texts or {})
+        self.default_text = default_text
+        self.image_quota = image_quota
+        self.quota_window = quota_window
+        self.quota_response = quota_response
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rpc_error_rate = rpc_error_rate
+        self.rpc_count = 0
+        self.image_count = 0
+        self.throttled_count = 0
+        self.error_count = 0
+        self._random = random.Random(seed)
+        self._accepted = deque()  # monotonic times of images accepted inside the quota window
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def register(self, content: bytes, text: str):
+        """Registers the text returned for an image."""
+        self.texts[hashlib.sha256(content).hexdigest()] = text
+
+    def annotate(self, request: dict) -> dict:
+        """Produces the response for one AnnotateImageRequest JSON object."""
+        content = base64.b64decode(request.get('image', {}).get('content', ''))
+        if not content:
+            return {'error': {'code': 3, 'message': 'image content is empty'}}
+        if self.error_rate and self._draw() < self.error_rate:
+            with self._lock:
+                self.error_count += 1
+            return {'error': {'code': 13, 'message': 'Internal error encountered.'}}
+        text = self.texts.get(hashlib.sha256(content).hexdigest(), self.default_text)
+        return build_annotation(text)
+
+    def _draw(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def _admit(self, count: int) -> int:
+        """Returns how many of `count` images fit in the quota right now (all of them without a quota)."""
+        if self.image_quota is None:
+            return count
+        with self._lock:
+            now = time.monotonic()
+            while self._accepted and self._accepted[0] <= now - self.quota_window:
+                self._accepted.popleft()
+            admitted = min(count, max(self.image_quota - len(self._accepted), 0))
+            if self.quota_response == 'http' and admitted < count:
+                admitted = 0
+            self._accepted.extend([now] * admitted)
+            self.throttled_count += count - admitted
+            return admitted
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not self.path.split('?')[0].endswith('/images:annotate'):
+                    self._reply(404, {'error': {'code': 5, 'message': 'not found'}})
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                requests = body.get('requests', [])
+                with server._lock:
+                    server.rpc_count += 1
+                if server.latency or server.latency_jitter:
+                    time.sleep(server.latency + server.latency_jitter * server._draw())
+                if server.rpc_error_rate and server._draw() < server.rpc_error_rate:
+                    with server._lock:
+                        server.error_count += 1
+                    self._reply(503, {'error': {'code': 503, 'status': 'UNAVAILABLE',
+                                                'message': 'The service is currently unavailable.'}})
+                    return
+                admitted = server._admit(len(requests))
+                if server.quota_response == 'http' and admitted < len(requests):
+                    self._reply(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED',
+                                                'message': 'Quota exceeded for quota metric requests per minute'}})
+                    return
+                with server._lock:
+                    server.image_count += admitted
+                quota_error = {'error': {'code': 8, 'message': 'Quota exceeded'}}
+                self._reply(200, {'responses': [server.annotate(r) if i < admitted else quota_error
+                                                for i, r in enumerate(requests)]})
+
+            def do_GET(self):
+                if self.path == '/stats':
+                    self._reply(200, {'rpc_count': server.rpc_count, 'image_count': server.image_count,
+                                      'throttled_count': server.throttled_count, 'error_count': server.error_count})
+                else:
+                    self._reply(404, {'error': {'code': 5, 'message': 'not found'}})
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Starts serving in a background thread and returns the endpoint URL."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-vision', daemon=True)
+        self._thread.start()
+        return self.endpoint
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+if __name__ == "__main__":
+    # Optional JSON file mapping image SHA-256 digests to text.
+    texts_path = os.environ.get('FAKE_VISION_TEXTS')
+    texts = json.load(open(texts_path, encoding='utf-8')) if texts_path else {}
+    quota = os.environ.get('FAKE_VISION_IMAGE_QUOTA')  # images per second
+    fake = FakeVisionServer(texts, default_text=os.environ.get('FAKE_VISION_DEFAULT_TEXT', ''),
+                            port=int(os.environ.get('FAKE_VISION_PORT', '8089')),
+                            image_quota=int(quota) if quota else None,
+                            quota_response=os.environ.get('FAKE_VISION_QUOTA_RESPONSE', 'http'),
+                            latency=float(os.environ.get('FAKE_VISION_LATENCY', '0')),
+                            latency_jitter=float(os.environ.get('FAKE_VISION_LATENCY_JITTER', '0')),
+                            error_rate=float(os.environ.get('FAKE_VISION_ERROR_RATE', '0')),
+                            rpc_error_rate=float(os.environ.get('FAKE_VISION_RPC_ERROR_RATE', '0')))
+    print(f"🧪 Fake Vision server listening on {fake.endpoint}")
+    fake.httpd.serve_forever()
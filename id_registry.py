@@ -0,0 +1,157 @@
+import hashlib
+import os
+from typing import Iterable, NamedTuple
+
+from lazy import lazy_import
+from sheet_reader import iter_sheet_rows
+
+np = lazy_import('numpy')
+
+# This file contains the registry-wide index of the sheet's nationality_ids.
+# Comparing a card's extracted ID with its own row only tells us that the two differ; when
+# users swap uploads, the extracted ID usually belongs to another row of the same sheet.
+# Every 14-digit nationality_id is packed into a sorted uint64 array (8 bytes per row) next
+# to an array of the owning rows' ids, so a lookup is a binary search (about 23 steps for
+# five million rows) and a registry built once can be saved and memory-mapped back by
+# later runs instead of being rebuilt. Near misses (one digit substituted, dropped or
+# added by OCR) are found by looking up every ID within edit distance 1 in one vectorized
+# search.
+
+ID_LENGTH = 14
+
+class Resolution(NamedTuple):
+    """
+    Who an extracted ID belongs to: `match` is 'own' (the row's own ID), 'other' (another
+    row's ID; `owners` lists those rows' ids) or 'unknown'. `distance` is 0 for an exact
+    hit and 1 for a near miss, whose registered ID is `registered_id`.
+    """
+    match: str
+    owners: tuple[str, ...] = ()
+    distance: int | None = None
+    registered_id: str | None = None
+
+UNKNOWN = Resolution('unknown')
+
+def _is_registry_id(value) -> bool:
+    return isinstance(value, str) and len(value) == ID_LENGTH and value.isdigit() and value.isascii()
+
+def near_misses(national_id: str) -> list[str]:
+    """Every 14-digit ID within edit distance 1 of `national_id` (substitution, deletion or insertion)."""
+    candidates = set()
+    for i in range(len(national_id) + 1):
+        head, tail = national_id[:i], national_id[i:]
+        if tail:
+            candidates.add(head + tail[1:])
+            candidates.update(head + digit + tail[1:] for digit in '0123456789' if digit != tail[0])
+        candidates.update(head + digit + tail for digit in '0123456789')
+    candidates.discard(national_id)
+    return sorted(c for c in candidates if _is_registry_id(c))
+
+class IdRegistry:
+    """
+    Sorted index of (nationality_id, owner id) pairs. IDs that are not 14 ASCII digits are
+    not indexed (they are counted in `skipped`); an ID registered to several rows keeps all
+    of its owners.
+    """
+
+    def __init__(self, ids: 'np.ndarray', owners: 'np.ndarray', skipped: int = 0):
+        self._ids = ids
+        self._owners = owners
+        self.skipped = skipped
+
+    def __len__(self):
+        return len(self._ids)
+
+    @classmethod
+    def build(cls, rows: Iterable[tuple[str, str]]) -> 'IdRegistry':
+        """Builds the index from (owner id, nationality_id) pairs."""
+        ids, owners, skipped = [], [], 0
+        for owner, national_id in rows:
+            if _is_registry_id(national_id):
+                ids.append(int(national_id))
+                owners.append(str(owner))
+            else:
+                skipped += 1
+        ids = np.array(ids, dtype=np.uint64)
+        order = np.argsort(ids, kind='stable')
+        return cls(ids[order], np.array(owners, dtype=str)[order] if owners else np.array([], dtype='U1'), skipped)
+
+    def owners_of(self, national_id: str) -> tuple[str, ...]:
+        """Ids of the rows registered with `national_id` (empty when it is not in the sheet)."""
+        if not _is_registry_id(national_id):
+            return ()
+        key = np.uint64(int(national_id))
+        start = int(np.searchsorted(self._ids, key, 'left'))
+        end = int(np.searchsorted(self._ids, key, 'right'))
+        return tuple(str(owner) for owner in self._owners[start:end])
+
+    def _near_owners(self, national_id: str) -> list[tuple[str, tuple[str, ...]]]:
+        """(registered ID, owners) of every indexed ID within edit distance 1 of `national_id`."""
+        candidates = near_misses(national_id)
+        if not candidates or not len(self._ids):
+            return []
+        keys = np.array([int(c) for c in candidates], dtype=np.uint64)
+        positions = np.minimum(np.searchsorted(self._ids, keys), len(self._ids) - 1)
+        return [(candidates[i], self.owners_of(candidates[i])) for i in np.nonzero(self._ids[positions] == keys)[0]]
+
+    def resolve(self, extracted_id: str | None, row_id: str, near_miss: bool = True) -> Resolution:
+        """
+        Resolves a card's extracted ID against the row it was uploaded for. Exact hits win;
+        otherwise, with `near_miss`, an ID one edit away is reported, the row's own ID first.
+        """
+        if not extracted_id:
+            return UNKNOWN
+        row_id = str(row_id)
+        owners = self.owners_of(extracted_id)
+        if owners:
+            if row_id in owners:
+                return Resolution('own', owners, 0, extracted_id)
+            return Resolution('other', owners, 0, extracted_id)
+        if not near_miss:
+            return UNKNOWN
+        others = []
+        for registered_id, owners in self._near_owners(extracted_id):
+            if row_id in owners:
+                return Resolution('own', owners, 1, registered_id)
+            others.append((registered_id, owners))
+        if others:
+            return Resolution('other', tuple(o for _, owners in others for o in owners), 1, others[0][0])
+        return UNKNOWN
+
+    def save(self, path: str):
+        """Writes the index to `path` (.npy arrays of IDs and owners), each file replaced atomically."""
+        os.makedirs(path, exist_ok=True)
+        for name, array in (('owners', self._owners), ('ids', self._ids)):
+            tmp_path = os.path.join(path, f"{name}.part.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, os.path.join(path, f"{name}.npy"))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'IdRegistry | None':
+        """Loads an index saved with `save`, memory-mapped by default; None if it does not exist."""
+        if not os.path.exists(os.path.join(path, 'ids.npy')):
+            return None
+        mode = 'r' if mmap else None
+        return cls(np.load(os.path.join(path, 'ids.npy'), mmap_mode=mode),
+                   np.load(os.path.join(path, 'owners.npy'), mmap_mode=mode))
+
+def registry_path(folder: str, sheet_path: str) -> str:
+    """Where the registry of a sheet is kept: one folder per sheet path, size and modification time."""
+    stat = os.stat(sheet_path)
+    key = hashlib.sha1(f"{os.path.abspath(sheet_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    return os.path.join(folder, key)
+
+def load_or_build(sheet_path: str, folder: str | None = None) -> IdRegistry:
+    """
+    The registry of a sheet's (id, nationality_id) columns. With a `folder`, a registry saved
+    there for the same unchanged sheet is memory-mapped instead of reading the sheet again,
+    and a newly built one is saved for the next run.
+    """
+    path = registry_path(folder, sheet_path) if folder else None
+    registry = IdRegistry.load(path) if path else None
+    if registry is None:
+        rows = iter_sheet_rows(sheet_path, columns=('id', 'nationality_id'))
+        registry = IdRegistry.build((row.id, row.nationality_id) for row in rows)
+        if path:
+            registry.save(path)
+    return registry
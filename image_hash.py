@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# This file contains the near-duplicate image index.
+# Users re-upload the same card under different URLs, so many 'back link' images are
+# re-compressed or resized copies of one photo. Each image gets two 64-bit perceptual
+# hashes (dHash and pHash) right after download; an image whose hashes are both within
+# `max_distance` bits of an indexed card reuses that card's OCR/extraction result
+# instead of being sent to Vision again. All ID card backs share one layout, so distinct
+# cards can land only a few bits apart: a match must agree on both hashes, and is then
+# re-verified pixel by pixel on a 64x48 grayscale thumbnail before its result is reused.
+
+HASH_SIZE = 8
+THUMBNAIL_SIZE = (64, 48)  # width, height
+
+# Correlation of the normalized thumbnails a hash match needs to count as a copy. On the
+# synthetic benchmark corpus rescaled, re-compressed copies score 0.98 or more and
+# distinct cards within the hash distance at most 0.91.
+MIN_CORRELATION = 0.95
+
+def _gray(content: bytes):
+    # The hashes only look at an 8x8 to 32x32 thumbnail, so a 1/4-scale decode is plenty.
+    return cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+
+def _bits_to_int(bits) -> int:
+    return int(np.packbits(bits).view('>u8')[0])
+
+def dhash(gray) -> int:
+    """Difference hash: whether each pixel of a 9x8 thumbnail is brighter than its left neighbour."""
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    return _bits_to_int((small[:, 1:] > small[:, :-1]).ravel())
+
+def phash(gray) -> int:
+    """Perceptual hash: the sign of the 8x8 lowest DCT frequencies of a 32x32 thumbnail against their median."""
+    small = cv2.resize(gray, (HASH_SIZE * 4, HASH_SIZE * 4), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:HASH_SIZE, :HASH_SIZE].ravel()
+    return _bits_to_int(low > np.median(low[1:]))
+
+def thumbnail(gray) -> bytes:
+    """The THUMBNAIL_SIZE grayscale thumbnail a hash match is re-verified on, as raw bytes."""
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).tobytes()
+
+def image_hashes(content: bytes) -> tuple[int, int, bytes] | None:
+    """Returns (dhash, phash, thumbnail) for image bytes, or None if the image cannot be decoded."""
+    gray = _gray(content) if content else None
+    if gray is None:
+        return None
+    return dhash(gray), phash(gray), thumbnail(gray)
+
+def _normalized(thumbnails):
+    """Thumbnails as zero-mean, unit-variance float rows, so a dot product is their correlation."""
+    pixels = np.asarray(thumbnails, dtype=np.float32).reshape(-1, THUMBNAIL_SIZE[0] * THUMBNAIL_SIZE[1])
+    pixels = pixels - pixels.mean(axis=1, keepdims=True)
+    return pixels / (pixels.std(axis=1, keepdims=True) + 1e-6)
+
+class ImageHashIndex:
+    """
+    In-memory index of card hashes. The dHashes and pHashes live in two uint64 NumPy
+    arrays and a lookup is a vectorized XOR + popcount over all of them, so even a few
+    hundred thousand cards are searched in about a millisecond. Each card carries a small
+    entry dict (its row id, nationality_id and extracted ID) and its thumbnail (3 KB), which
+    hash matches must correlate with by at least `min_correlation`.
+    """
+
+    def __init__(self, max_distance: int = 5, capacity: int = 1024, min_correlation: float = MIN_CORRELATION):
+        self.max_distance = max_distance
+        self.min_correlation = min_correlation
+        self._dhashes = np.zeros(capacity, dtype=np.uint64)
+        self._phashes = np.zeros(capacity, dtype=np.uint64)
+        self._thumbnails = np.zeros((capacity, THUMBNAIL_SIZE[0] * THUMBNAIL_SIZE[1]), dtype=np.uint8)
+        self._entries: list[dict] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, hashes: tuple[int, int, bytes], entry: dict):
+        with self._lock:
+            count = len(self._entries)
+            if count == len(self._dhashes):
+                self._dhashes = np.concatenate([self._dhashes, np.zeros_like(self._dhashes)])
+                self._phashes = np.concatenate([self._phashes, np.zeros_like(self._phashes)])
+                self._thumbnails = np.concatenate([self._thumbnails, np.zeros_like(self._thumbnails)])
+            self._dhashes[count], self._phashes[count] = hashes[:2]
+            self._thumbnails[count] = np.frombuffer(hashes[2], dtype=np.uint8)
+            self._entries.append(entry)
+
+    def lookup(self, hashes: tuple[int, int, bytes]) -> tuple[dict, int] | None:
+        """
+        Returns (entry, distance) of the closest indexed card within `max_distance` bits
+        whose thumbnail also correlates with this one, or None.
+        """
+        with self._lock:
+            count = len(self._entries)
+            if not count:
+                return None
+            distances = np.maximum(np.bitwise_count(self._dhashes[:count] ^ np.uint64(hashes[0])),
+                                   np.bitwise_count(self._phashes[:count] ^ np.uint64(hashes[1])))
+            near = np.flatnonzero(distances <= self.max_distance)
+            if not len(near):
+                return None
+            near = near[np.argsort(distances[near], kind='stable')]
+            correlations = _normalized(self._thumbnails[near]) @ _normalized(np.frombuffer(hashes[2], np.uint8))[0]
+            correlations /= THUMBNAIL_SIZE[0] * THUMBNAIL_SIZE[1]
+            copies = near[correlations >= self.min_correlation]
+            if not len(copies):
+                return None
+            return self._entries[copies[0]], int(distances[copies[0]])
+
+    def save(self, path: str):
+        """Writes the index to a .npz file (atomically, via a temporary file)."""
+        with self._lock:
+            count = len(self._entries)
+            tmp_path = f"{path}.part.npz"
+            np.savez(tmp_path, dhashes=self._dhashes[:count], phashes=self._phashes[:count],
+                     thumbnails=self._thumbnails[:count], entries=np.array(json.dumps(self._entries)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, max_distance: int = 5) -> 'ImageHashIndex':
+        """
+        Loads an index saved with `save`; returns an empty index if the file does not exist
+        or was saved without thumbnails (its matches could not be re-verified).
+        """
+        index = cls(max_distance)
+        if not os.path.exists(path):
+            return index
+        with np.load(path) as data:
+            if 'thumbnails' not in data:
+                return index
+            padding = np.zeros(max(len(data['dhashes']), 1024), dtype=np.uint64)
+            index._dhashes = np.concatenate([data['dhashes'], padding])
+            index._phashes = np.concatenate([data['phashes'], padding])
+            index._thumbnails = np.concatenate([data['thumbnails'], np.zeros((len(padding), data['thumbnails'].shape[1]),
+                                                                             dtype=np.uint8)])
+            index._entries = json.loads(str(data['entries']))
+        return index
@@ -0,0 +1,235 @@
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+# This file contains the background job subsystem behind the Flask app.
+# A verification run is submitted as a job, executed by a worker pool outside the
+# HTTP request, and its result rows are persisted to SQLite as they are produced,
+# so the page can poll (or stream) progress and show partial results while a long
+# run is still going.
+
+RESULT_FIELDS = ('row_number', 'excel_row_id', 'excel_nationality_id', 'extracted_id', 'is_match', 'image_path',
+                 'duplicate_of', 'suspect', 'status', 'registry_match', 'registry_owner', 'registry_distance')
+_BOOL_FIELDS = ('is_match', 'suspect')
+
+# Result filters offered by the results API, as SQL conditions on the results table
+RESULT_FILTERS = {
+    'all': '1',
+    'match': "status = 'match'",
+    'mismatch': "status = 'mismatch'",
+    'not_matched': 'is_match = 0',
+    'failed': "status = 'failed'",
+    'download_failed': "status = 'download_failed'",
+    'duplicate': 'duplicate_of IS NOT NULL',
+    'suspect': 'suspect = 1',
+    'swapped': "registry_match = 'other'",
+    'near_miss': 'registry_distance = 1',
+    'unregistered': "registry_match = 'unknown'",
+}
+
+class JobStore:
+    """SQLite-backed store for job status and incrementally written result rows."""
+
+    def __init__(self, path: str = 'jobs.sqlite3'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                sheet_path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                processed INTEGER NOT NULL DEFAULT 0,
+                matched INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                job_id TEXT NOT NULL,
+                row_number INTEGER NOT NULL,
+                excel_row_id TEXT,
+                excel_nationality_id TEXT,
+                extracted_id TEXT,
+                is_match INTEGER NOT NULL,
+                image_path TEXT,
+                duplicate_of TEXT,
+                suspect INTEGER NOT NULL DEFAULT 0,
+                status TEXT,
+                registry_match TEXT,
+                registry_owner TEXT,
+                registry_distance INTEGER,
+                PRIMARY KEY (job_id, row_number)
+            );
+        ''')
+        # Databases created before duplicate detection lack duplicate_of and suspect, those
+        # created before result filtering lack status (old rows get theirs derived from the
+        # stored extracted_id), and those created before the ID registry lack its columns.
+        columns = {row['name'] for row in self._conn.execute('PRAGMA table_info(results)')}
+        if 'duplicate_of' not in columns:
+            self._conn.execute('ALTER TABLE results ADD COLUMN duplicate_of TEXT')
+            self._conn.execute('ALTER TABLE results ADD COLUMN suspect INTEGER NOT NULL DEFAULT 0')
+        if 'status' not in columns:
+            self._conn.execute('ALTER TABLE results ADD COLUMN status TEXT')
+            self._conn.execute('''
+                UPDATE results SET status = CASE
+                    WHEN is_match THEN 'match'
+                    WHEN extracted_id LIKE 'Download Failed%' THEN 'download_failed'
+                    WHEN extracted_id IS NULL OR extracted_id = 'Extraction Failed' OR extracted_id LIKE '% error: %'
+                        THEN 'failed'
+                    ELSE 'mismatch' END
+            ''')
+        if 'registry_match' not in columns:
+            self._conn.execute('ALTER TABLE results ADD COLUMN registry_match TEXT')
+            self._conn.execute('ALTER TABLE results ADD COLUMN registry_owner TEXT')
+            self._conn.execute('ALTER TABLE results ADD COLUMN registry_distance INTEGER')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS results_by_status ON results (job_id, status, row_number)')
+        # Jobs that were running when the process stopped can never finish now.
+        self._conn.execute("UPDATE jobs SET status = 'interrupted' WHERE status IN ('queued', 'running')")
+        self._conn.commit()
+
+    def create_job(self, sheet_path: str) -> str:
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, sheet_path, status, created_at) VALUES (?, ?, 'queued', ?)",
+                (job_id, sheet_path, time.time()),
+            )
+            self._conn.commit()
+        return job_id
+
+    def set_status(self, job_id: str, status: str, error: str | None = None):
+        now = time.time()
+        with self._lock:
+            if status == 'running':
+                self._conn.execute('UPDATE jobs SET status = ?, started_at = ? WHERE id = ?', (status, now, job_id))
+            else:
+                self._conn.execute(
+                    'UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?', (status, error, now, job_id)
+                )
+            self._conn.commit()
+
+    def add_results(self, job_id: str, results: list[dict]):
+        """
+        Persists a batch of result rows and updates the job's progress counters.
+        Rows retried by a resumed run replace their earlier result without being counted twice.
+        """
+        if not results:
+            return
+        with self._lock:
+            row_numbers = [r['row_number'] for r in results]
+            previous = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(is_match), 0) FROM results WHERE job_id = ?"
+                f" AND row_number IN ({','.join('?' * len(row_numbers))})",
+                (job_id, *row_numbers),
+            ).fetchone()
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO results (job_id, {', '.join(RESULT_FIELDS)})"
+                f" VALUES (?, {', '.join('?' * len(RESULT_FIELDS))})",
+                [(job_id, *(int(bool(r.get(f))) if f in _BOOL_FIELDS else r.get(f) for f in RESULT_FIELDS))
+                 for r in results],
+            )
+            self._conn.execute(
+                'UPDATE jobs SET processed = processed + ?, matched = matched + ? WHERE id = ?',
+                (len(results) - previous[0], sum(1 for r in results if r['is_match']) - previous[1], job_id),
+            )
+            self._conn.commit()
+
+    def get_job(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def latest_job(self) -> dict | None:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT 1').fetchone()
+        return dict(row) if row else None
+
+    def get_results(self, job_id: str, page: int = 1, per_page: int = 50, filter: str = 'all') -> list[dict]:
+        """Returns one page of a job's results ordered by spreadsheet row, restricted to one of RESULT_FILTERS."""
+        offset = (max(page, 1) - 1) * per_page
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT * FROM results WHERE job_id = ? AND {RESULT_FILTERS[filter]} ORDER BY row_number LIMIT ? OFFSET ?',
+                (job_id, per_page, offset),
+            ).fetchall()
+        return [_result_dict(row) for row in rows]
+
+    def count_results(self, job_id: str) -> dict[str, int]:
+        """Number of a job's results matching each of RESULT_FILTERS."""
+        columns = ', '.join(f'COALESCE(SUM({condition}), 0)' for condition in RESULT_FILTERS.values())
+        with self._lock:
+            row = self._conn.execute(f'SELECT {columns} FROM results WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(zip(RESULT_FILTERS, row))
+
+    def get_results_since(self, job_id: str, since: int = 0, limit: int = 500) -> list[dict]:
+        """Returns results written after sequence number `since`, in write order (for live updates)."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT rowid AS seq, * FROM results WHERE job_id = ? AND rowid > ? ORDER BY rowid LIMIT ?',
+                (job_id, since, limit),
+            ).fetchall()
+        return [dict(_result_dict(row), seq=row['seq']) for row in rows]
+
+def _result_dict(row) -> dict:
+    return {f: (bool(row[f]) if f in _BOOL_FIELDS else row[f]) for f in RESULT_FIELDS}
+
+class JobManager:
+    """
+    Runs submitted jobs on a worker pool. `run_fn(job_id, sheet_path)` must return an
+    iterable of result dicts; they are written to the store in batches of `flush_rows`
+    or every `flush_interval` seconds, whichever comes first. `on_persisted(job_id, results)`
+    is called after each batch is committed (e.g. to journal those rows as done).
+    """
+
+    def __init__(self, store: JobStore, run_fn: Callable, max_workers: int = 1,
+                 flush_rows: int = 50, flush_interval: float = 1.0, on_persisted: Callable | None = None):
+        self.store = store
+        self.run_fn = run_fn
+        self.on_persisted = on_persisted
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-worker')
+
+    def submit(self, sheet_path: str) -> str:
+        job_id = self.store.create_job(sheet_path)
+        self._executor.submit(self._execute, job_id, sheet_path)
+        return job_id
+
+    def resume(self, job_id: str) -> bool:
+        """Re-queues an interrupted or failed job under the same id so it continues where it stopped."""
+        job = self.store.get_job(job_id)
+        if job is None or job['status'] in ('queued', 'running'):
+            return False
+        self.store.set_status(job_id, 'queued')
+        self._executor.submit(self._execute, job_id, job['sheet_path'])
+        return True
+
+    def _persist(self, job_id: str, results: list[dict]):
+        self.store.add_results(job_id, results)
+        if results and self.on_persisted is not None:
+            self.on_persisted(job_id, results)
+
+    def _execute(self, job_id: str, sheet_path: str):
+        self.store.set_status(job_id, 'running')
+        pending = []
+        last_flush = time.monotonic()
+        try:
+            for result in self.run_fn(job_id, sheet_path):
+                pending.append(result)
+                if len(pending) >= self.flush_rows or time.monotonic() - last_flush >= self.flush_interval:
+                    self._persist(job_id, pending)
+                    pending = []
+                    last_flush = time.monotonic()
+            self._persist(job_id, pending)
+            self.store.set_status(job_id, 'done')
+        except Exception as e:
+            self._persist(job_id, pending)
+            print(f"❌ Job {job_id} failed: {e}")
+            self.store.set_status(job_id, 'failed', str(e))
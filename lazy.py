@@ -0,0 +1,33 @@
+import importlib
+
+# This file contains the lazy module loader used for the heavy backends (OpenCV, NumPy,
+# Google Vision). Importing them costs most of a script's startup, while the extraction
+# core (national_id.py, the extract_national_id helpers) needs none of them; with
+#   cv2 = lazy_import('cv2')
+# a module can be imported with only the standard library loaded, and OpenCV is imported
+# the first time one of its attributes is used.
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is first used. The module is then
+    imported and its namespace copied onto the proxy, so later lookups cost the same as
+    on the module itself.
+    """
+
+    def __init__(self, name: str):
+        self.__dict__['_lazy_name'] = name
+
+    def __getattr__(self, attr):
+        # Only called for names not copied yet: the first access, or attributes the module adds later.
+        module = importlib.import_module(self._lazy_name)
+        if '_lazy_module' not in self.__dict__:
+            self.__dict__.update(module.__dict__)
+            self.__dict__['_lazy_module'] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._lazy_name}'{' (loaded)' if '_lazy_module' in self.__dict__ else ''}>"
+
+def lazy_import(name: str) -> LazyModule:
+    """A proxy for module `name` that imports it on first attribute access."""
+    return LazyModule(name)
@@ -0,0 +1,231 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# This file contains the in-process metrics used to see where a run spends its time:
+# labelled counters and histograms recorded by the pipeline stages, the downloader, the
+# Vision wrappers, the OCR cache and the extractor. app.py serves them on /metrics in the
+# Prometheus text format, and the CLI scripts print REGISTRY.summary() when they finish.
+# Everything is stdlib-only and thread-safe; recording a value costs one lock round trip.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+class Counter(_Metric):
+    """A monotonically increasing count per label combination."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[tuple[tuple, float]]:
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}"
+                for key, value in self.samples()]
+
+class Histogram(_Metric):
+    """Observations bucketed by upper bound, with their sum and count per label combination."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the wall time of the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[tuple[tuple, list, float, int]]:
+        """(label values, per-bucket counts, sum, count) per label combination."""
+        with self._lock:
+            return sorted((key, list(counts), total, count) for key, (counts, total, count) in self._values.items())
+
+    def quantile(self, q: float, counts: list, count: int) -> float:
+        """Estimates a quantile from bucket counts, interpolating linearly inside the bucket."""
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower  # Above the last bound; the best estimate is that bound.
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return 0.0
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, counts, total, count in self.samples():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else _format_number(bound)
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Gauge(_Metric):
+    """A value read from a callback at collection time (e.g. a queue depth or the current rate limit)."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, fn):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [] if value is None else [f"{self.name} {_format_number(value)}"]
+
+class Registry:
+    """A named set of metrics, rendered together."""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, Gauge):
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, fn) -> Gauge:
+        """Registers (or replaces) a gauge whose value is `fn()` at collection time."""
+        return self._register(Gauge(name, help, fn))
+
+    def metrics(self) -> list[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics():
+            samples = metric.render()
+            if samples:
+                lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}", *samples]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """A human-readable digest for the end of a CLI run: counters, and count/mean/p50/p99 per histogram."""
+        lines = []
+        for metric in self.metrics():
+            if isinstance(metric, Counter):
+                for key, value in metric.samples():
+                    lines.append(f"  {metric.name}{_format_labels(metric.labelnames, key)}: {_format_number(value)}")
+            elif isinstance(metric, Histogram):
+                for key, counts, total, count in metric.samples():
+                    lines.append(
+                        f"  {metric.name}{_format_labels(metric.labelnames, key)}: n={count} mean={total / count:.3g} "
+                        f"p50={metric.quantile(0.5, counts, count):.3g} p99={metric.quantile(0.99, counts, count):.3g}")
+        return '\n'.join(["📈 Metrics:", *lines]) if lines else "📈 Metrics: nothing recorded."
+
+    def reset(self):
+        for metric in self.metrics():
+            metric.reset()
+
+REGISTRY = Registry()
+
+# --- Metrics recorded across the project ---
+STAGE_SECONDS = REGISTRY.histogram(
+    'pipeline_stage_seconds', 'Time a row spends in each pipeline stage.', ('stage',))
+PIPELINE_ROWS = REGISTRY.counter(
+    'pipeline_rows_total', 'Rows finished by the pipeline: match, mismatch, duplicate or failed.', ('outcome',))
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    'download_seconds', 'Image download latency: ok, not_modified (304) or failed.', ('status',))
+DOWNLOAD_BYTES = REGISTRY.histogram(
+    'download_bytes', 'Size of downloaded images.', buckets=SIZE_BUCKETS)
+ROTATIONS = REGISTRY.counter(
+    'rotation_decisions_total',
+    'Orientation found per image, by path: exif (tag applied), local (estimated on the CPU, or low_confidence), '
+    'text_detection (Vision call before OCR) or document (read from the OCR response itself).',
+    ('path', 'decision'))
+VISION_REQUEST_SECONDS = REGISTRY.histogram(
+    'vision_request_seconds', 'Latency of one image\'s Vision call as seen by the caller (including batching).',
+    ('feature',))
+VISION_BATCH_SECONDS = REGISTRY.histogram(
+    'vision_batch_rpc_seconds', 'Latency of batch_annotate_images RPCs: ok, quota or error.', ('outcome',))
+VISION_IMAGES = REGISTRY.counter(
+    'vision_batch_images_total', 'Images sent in batch RPCs, by per-image outcome: ok, quota or error.', ('outcome',))
+OCR_CACHE_REQUESTS = REGISTRY.counter(
+    'ocr_cache_requests_total', 'OCR cache lookups: hit or miss.', ('feature', 'result'))
+OCR_CASCADE = REGISTRY.counter(
+    'ocr_cascade_total', 'Cascade OCR decisions: local (accepted) or vision (escalated).', ('decision',))
+ID_REGISTRY_LOOKUPS = REGISTRY.counter(
+    'id_registry_lookups_total',
+    'Extracted IDs resolved against the whole sheet: own, other (another row\'s ID) or unknown; '
+    'own_near_miss and other_near_miss when the ID is one digit off a registered one.', ('match',))
+EXTRACTION_STRATEGY = REGISTRY.counter(
+    'extraction_strategy_total', 'Strategy that produced the National ID (none when no ID was found).', ('strategy',))
+ERRORS = REGISTRY.counter(
+    'errors_total', 'Errors by category (download_*, vision_*, ocr_no_text, stage_*).', ('category',))
@@ -0,0 +1,162 @@
+import datetime
+import operator
+import re
+from typing import Iterator, NamedTuple
+
+# This file contains the structural rules of the 14-digit Egyptian National ID.
+# It only uses the standard library so it can be imported anywhere cheaply.
+# It also holds the shared extractor that finds the ID in raw OCR text.
+#
+# Layout: C YYMMDD GG SSSS K
+#   C    century of birth (2 = 1900s, 3 = 2000s)
+#   YYMMDD  birth date
+#   GG   governorate of birth
+#   SSSS serial number (the last of these digits is odd for males, even for females)
+#   K    check digit
+
+CENTURIES = {'2': 1900, '3': 2000}
+
+GOVERNORATES = {
+    '01': 'Cairo', '02': 'Alexandria', '03': 'Port Said', '04': 'Suez',
+    '11': 'Damietta', '12': 'Dakahlia', '13': 'Sharqia', '14': 'Qalyubia', '15': 'Kafr El Sheikh',
+    '16': 'Gharbia', '17': 'Monufia', '18': 'Beheira', '19': 'Ismailia',
+    '21': 'Giza', '22': 'Beni Suef', '23': 'Fayoum', '24': 'Minya', '25': 'Asyut',
+    '26': 'Sohag', '27': 'Qena', '28': 'Aswan', '29': 'Luxor',
+    '31': 'Red Sea', '32': 'New Valley', '33': 'Matrouh', '34': 'North Sinai', '35': 'South Sinai',
+    '88': 'Born abroad',
+}
+
+CHECK_WEIGHTS = (2, 7, 6, 5, 4, 3, 2, 7, 6, 5, 4, 3, 2)
+
+def check_digit(first13: str) -> int:
+    """Computes the check digit for the first 13 digits of a National ID."""
+    total = sum(map(operator.mul, map(int, first13), CHECK_WEIGHTS))
+    return (11 - total % 11) % 10
+
+def birth_date(national_id: str) -> datetime.date | None:
+    """Returns the birth date encoded in the ID, or None if it is not a real date."""
+    century = CENTURIES.get(national_id[:1])
+    if century is None:
+        return None
+    try:
+        return datetime.date(century + int(national_id[1:3]), int(national_id[3:5]), int(national_id[5:7]))
+    except ValueError:
+        return None
+
+def validation_errors(national_id: str, today: datetime.date | None = None) -> list[str]:
+    """Returns the list of structural rules the ID breaks (empty when it is valid)."""
+    if not national_id or len(national_id) != 14 or not national_id.isdigit() or not national_id.isascii():
+        return ['format']
+    errors = []
+    if national_id[0] not in CENTURIES:
+        errors.append('century')
+    born = birth_date(national_id)
+    if born is None or born > (today or datetime.date.today()):
+        errors.append('birth_date')
+    if national_id[7:9] not in GOVERNORATES:
+        errors.append('governorate')
+    if check_digit(national_id[:13]) != int(national_id[13]):
+        errors.append('check_digit')
+    return errors
+
+def is_valid_national_id(national_id: str) -> bool:
+    """True when the ID has a valid century, birth date, governorate and check digit."""
+    return not validation_errors(national_id)
+
+def parse_national_id(national_id: str) -> dict | None:
+    """Decodes a valid ID into its birth date, governorate and gender; None if invalid."""
+    if validation_errors(national_id):
+        return None
+    return {
+        'birth_date': birth_date(national_id),
+        'governorate': GOVERNORATES[national_id[7:9]],
+        'gender': 'male' if int(national_id[12]) % 2 else 'female',
+    }
+
+# --- Extraction from OCR text ---
+# Eastern Arabic (٠-٩) and Persian/Urdu (۰-۹) numerals both map to Western digits.
+DIGIT_TABLE = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+
+# A single pass over the raw text picks out digit runs in any of the three numeral sets;
+# only those short runs are translated. Standalone dates (issue/expiry dates such as
+# 2021/08) are consumed so their digits never join a candidate, and line breaks are kept.
+_DIGIT = '[0-9٠-٩۰-۹]'
+_TOKEN_RE = re.compile(
+    rf'(?P<date>(?<!{_DIGIT}){_DIGIT}{{4}}/{_DIGIT}{{1,2}}(?:/{_DIGIT}{{1,2}})?(?!{_DIGIT}))'
+    rf'|(?P<digits>{_DIGIT}+)|(?P<newline>\n)'
+)
+
+# How far each way of assembling a candidate is trusted before the structural checks:
+#   contiguous - one run of exactly 14 digits
+#   line       - the digit runs of one line add up to 14 digits ("2960 4190 1009 46")
+#   split      - two adjacent 7-digit runs (the number wrapped or was cut in two)
+#   embedded   - a 14-digit window inside a longer run (OCR merged the ID with a date)
+STRATEGY_WEIGHTS = {'contiguous': 1.0, 'line': 0.9, 'split': 0.85, 'embedded': 0.7}
+
+# Share of the confidence lost when a structural rule is broken.
+RULE_PENALTIES = {'century': 0.15, 'birth_date': 0.25, 'governorate': 0.2, 'check_digit': 0.4}
+
+class NationalIdMatch(NamedTuple):
+    """The best ID candidate found in a text, how it was assembled and the rules it breaks."""
+    national_id: str
+    confidence: float
+    strategy: str
+    errors: tuple[str, ...]
+
+def normalize_digits(text: str) -> str:
+    """Converts all known variants of Arabic-Indic numerals to Western digits."""
+    return text.translate(DIGIT_TABLE) if text else ""
+
+def _candidates(text: str) -> Iterator[tuple[str, str]]:
+    """Yields (candidate, strategy) for every way the text can form an ID, in text order."""
+    line_runs = []
+    previous = ''
+    for match in _TOKEN_RE.finditer(text):
+        kind = match.lastgroup
+        if kind == 'newline':
+            if len(line_runs) > 1 and sum(map(len, line_runs)) == 14 and line_runs[0][0] in '23':
+                yield ''.join(line_runs), 'line'
+            line_runs = []
+            continue
+        if kind == 'date':
+            continue
+        digits = match.group().translate(DIGIT_TABLE)
+        line_runs.append(digits)
+        length = len(digits)
+        if length == 14:
+            if digits[0] in '23':
+                yield digits, 'contiguous'
+        elif length == 7:
+            if len(previous) == 7 and previous[0] in '23':
+                yield previous + digits, 'split'
+        elif length > 14:
+            for start in range(length - 13):
+                if digits[start] in '23':
+                    yield digits[start:start + 14], 'embedded'
+        previous = digits
+    if len(line_runs) > 1 and sum(map(len, line_runs)) == 14 and line_runs[0][0] in '23':
+        yield ''.join(line_runs), 'line'
+
+def find_national_id(text: str, today: datetime.date | None = None) -> NationalIdMatch | None:
+    """
+    Finds the most plausible National ID in OCR text. Every candidate is scored by how it
+    was assembled and by the structural rules it passes; the highest score wins and ties
+    go to the candidate that appears first. Returns None when the text has no candidate.
+    """
+    if not text:
+        return None
+    today = today or datetime.date.today()
+    best = None
+    for national_id, strategy in _candidates(text):
+        errors = tuple(validation_errors(national_id, today))
+        confidence = round(STRATEGY_WEIGHTS[strategy] * (1 - sum(RULE_PENALTIES[e] for e in errors)), 3)
+        if best is None or confidence > best.confidence:
+            best = NationalIdMatch(national_id, confidence, strategy, errors)
+            if confidence == 1.0:
+                break  # A valid contiguous ID cannot be beaten.
+    return best
+
+def extract_national_id(text: str) -> str | None:
+    """Returns the most plausible 14-digit National ID in the text, or None."""
+    match = find_national_id(text)
+    return match.national_id if match else None
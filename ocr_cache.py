@@ -0,0 +1,165 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from lazy import lazy_import
+from vision_batch import is_quota_status
+
+vision = lazy_import('google.cloud.vision')
+
+# This file contains a persistent, content-addressed cache of Vision responses.
+# Entries are keyed by the SHA-256 of the image bytes plus the Vision feature, and
+# hold the full serialized AnnotateImageResponse (not just the text), so changes to
+# the extraction logic can be replayed offline without any API calls.
+
+DEFAULT_CACHE_PATH = os.environ.get('OCR_CACHE_PATH', 'ocr_cache.sqlite3')
+DEFAULT_MAX_BYTES = int(float(os.environ.get('OCR_CACHE_MAX_MB', '512')) * 1024 * 1024)
+CACHE_ENABLED = os.environ.get('OCR_CACHE', '1') != '0'
+
+def image_digest(content: bytes) -> str:
+    """Returns the SHA-256 hex digest used as the cache key for an image."""
+    return hashlib.sha256(content).hexdigest()
+
+class OCRCache:
+    """SQLite-backed response cache with size-based LRU eviction and hit/miss counters."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' digest TEXT NOT NULL, feature TEXT NOT NULL, size INTEGER NOT NULL,'
+            ' last_used REAL NOT NULL, payload BLOB NOT NULL,'
+            ' PRIMARY KEY (digest, feature))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self._conn.commit()
+        self.total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, digest: str, feature: str):
+        """Returns the cached AnnotateImageResponse or None, and refreshes its LRU timestamp."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT payload FROM responses WHERE digest = ? AND feature = ?', (digest, feature)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.OCR_CACHE_REQUESTS.inc(feature=feature, result='miss')
+                return None
+            self.hits += 1
+            metrics.OCR_CACHE_REQUESTS.inc(feature=feature, result='hit')
+            self._conn.execute(
+                'UPDATE responses SET last_used = ? WHERE digest = ? AND feature = ?', (time.time(), digest, feature)
+            )
+            self._conn.commit()
+        return vision.AnnotateImageResponse.deserialize(row[0])
+
+    def put(self, digest: str, feature: str, response):
+        """Stores a response, evicting least recently used entries if the cache grows past max_bytes."""
+        payload = vision.AnnotateImageResponse.serialize(response)
+        with self._lock:
+            old = self._conn.execute(
+                'SELECT size FROM responses WHERE digest = ? AND feature = ?', (digest, feature)
+            ).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (digest, feature, size, last_used, payload) VALUES (?, ?, ?, ?, ?)',
+                (digest, feature, len(payload), time.time(), payload),
+            )
+            self.total_bytes += len(payload) - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                'SELECT digest, feature, size FROM responses ORDER BY last_used LIMIT 64'
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            for digest, feature, size in rows:
+                self._conn.execute('DELETE FROM responses WHERE digest = ? AND feature = ?', (digest, feature))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    return
+
+    def iter_responses(self, feature: str = 'document_text_detection'):
+        """Yields (digest, response) for every cached response of a feature."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT digest, payload FROM responses WHERE feature = ? ORDER BY digest', (feature,)
+            ).fetchall()
+        for digest, payload in rows:
+            yield digest, vision.AnnotateImageResponse.deserialize(payload)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self.total_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache() -> OCRCache | None:
+    """Returns the process-wide cache, or None when disabled with OCR_CACHE=0."""
+    global _default_cache
+    if not CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = OCRCache()
+        return _default_cache
+
+def cached_annotate(client, content: bytes, feature: str, cache: OCRCache | None = None):
+    """
+    Calls `client.<feature>` (text_detection or document_text_detection) for the image
+    bytes, serving the response from the cache when the same image was seen before.
+    Responses carrying an API error are not cached.
+    """
+    cache = cache or get_default_cache()
+    digest = image_digest(content) if cache else None
+    if cache:
+        response = cache.get(digest, feature)
+        if response is not None:
+            return response
+
+    start = time.perf_counter()
+    try:
+        response = getattr(client, feature)(image=vision.Image(content=content))
+    except Exception:
+        metrics.ERRORS.inc(category='vision_rpc')
+        raise
+    finally:
+        metrics.VISION_REQUEST_SECONDS.observe(time.perf_counter() - start, feature=feature)
+    if response.error.message:
+        metrics.ERRORS.inc(category='vision_quota' if is_quota_status(response.error) else 'vision_api')
+    if cache and not response.error.message:
+        cache.put(digest, feature, response)
+    return response
+
+if __name__ == "__main__":
+    # Replays the current extraction logic over every cached OCR response, with zero API calls.
+    import process_logic
+
+    cache = get_default_cache() or OCRCache()
+    found = 0
+    total = 0
+    for digest, response in cache.iter_responses():
+        total += 1
+        text = process_logic.text_from_document_response(response)
+        national_id = process_logic.extract_national_id(text) if text else None
+        found += national_id is not None
+        print(f"{digest[:12]}  {national_id or 'Not Found'}")
+    print(f"\n📦 Replayed {total} cached responses: {found} IDs extracted. Cache stats: {cache.stats()}")
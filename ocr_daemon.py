@@ -0,0 +1,243 @@
+import argparse
+import importlib
+import os
+import secrets
+import stat
+import sys
+import threading
+from contextlib import closing
+from multiprocessing.connection import Client, Listener
+from typing import Iterator
+
+import metrics
+import process
+import process_logic
+from cpu_pool import CpuPool
+from ocr_cache import get_default_cache
+from preprocess import PREPROCESS_MODE
+from rate_limit import AdaptiveRateLimiter
+from run_journal import RunJournal
+from vision_batch import BatchingVisionClient
+
+# This file contains the long-lived OCR worker behind process.py.
+# A one-off scan pays for its setup on every run: importing OpenCV, NumPy and the Vision
+# library, authenticating the Vision client, starting the image worker processes and
+# opening the OCR cache and run journal. The daemon does all of that once and then takes
+# folders over a local socket, so a re-run of process.py starts processing right away:
+#
+#   python ocr_daemon.py serve       (leave it running)
+#   python process.py                (sends IMAGE_FOLDER to the daemon when it answers)
+#   python ocr_daemon.py status | stop
+#
+# The address is 'host:port' for TCP (the default, which works on every platform) or, on
+# POSIX, the path of a Unix socket. Messages are pickled, so every connection must
+# authenticate: with OCR_DAEMON_KEY when it is set, otherwise with a random key the daemon
+# writes to KEY_FILE (readable by its owner only) on first start and process.py reads.
+# Each scan request names the client's run journal, which the client and the daemon then
+# share (the client marks images done once their records are stored). The OCR cache path
+# is resolved in the daemon's folder. A scan stops submitting images once its client
+# disconnects, so a cancelled scan does not keep paying for Vision calls.
+
+DAEMON_ADDRESS = os.environ.get('OCR_DAEMON_ADDRESS', '127.0.0.1:8765')
+KEY_FILE = os.environ.get('OCR_DAEMON_KEY_FILE',
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), '.ocr_daemon_key'))
+
+KEY_PATH = os.environ.get('VISION_KEY_PATH', r"D:\National Id Scan\Key.json")
+VISION_RATE_LIMIT = 25
+CPU_WORKERS = None  # None: one per core (see cpu_pool.py)
+
+# Imported up front so the first folder does not pay for them
+WARM_MODULES = ('numpy', 'cv2', 'google.cloud.vision')
+
+def _address(address: str):
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        return host, int(port)
+    return address
+
+def auth_key(create: bool = False) -> bytes | None:
+    """
+    The connection key: OCR_DAEMON_KEY, else the contents of KEY_FILE. With `create`, a
+    missing key file is generated with a random key. A key file other users can read is refused.
+    """
+    if os.environ.get('OCR_DAEMON_KEY'):
+        return os.environ['OCR_DAEMON_KEY'].encode()
+    if create and not os.path.exists(KEY_FILE):
+        try:
+            fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass  # another daemon created it first
+        else:
+            with os.fdopen(fd, 'w') as key_file:
+                key_file.write(secrets.token_hex(32))
+    try:
+        if os.name == 'posix' and os.stat(KEY_FILE).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            raise PermissionError(f"{KEY_FILE} is accessible by other users; chmod 600 it or set OCR_DAEMON_KEY")
+        with open(KEY_FILE, encoding='ascii') as key_file:
+            return key_file.read().strip().encode() or None
+    except FileNotFoundError:
+        return None
+
+def connect(address: str = DAEMON_ADDRESS):
+    key = auth_key()
+    if key is None:
+        raise ConnectionRefusedError(f"No OCR daemon key: set OCR_DAEMON_KEY or start the daemon to create {KEY_FILE}")
+    return Client(_address(address), authkey=key)
+
+class OcrDaemon:
+    """
+    Serves scan requests with one warm Vision client and CPU pool, and the run journals
+    the requests name (each opened once). Each connection is handled on its own thread;
+    concurrent scans share the Vision batches and the rate limiter.
+    """
+
+    def __init__(self, vision_client, cpu_workers: int | None = CPU_WORKERS, rate_limit: float = VISION_RATE_LIMIT):
+        for name in WARM_MODULES:
+            importlib.import_module(name)
+        self.cpu_pool = CpuPool(cpu_workers)
+        self.client = BatchingVisionClient(vision_client, rate_limiter=AdaptiveRateLimiter(rate=rate_limit))
+        self._journals: dict[str, RunJournal] = {}
+        self._journals_lock = threading.Lock()
+        get_default_cache()
+        self._stopping = threading.Event()
+
+    def journal(self, path: str) -> RunJournal:
+        """The run journal at `path`. Every mark is committed at once, since the client writes to it too."""
+        path = os.path.abspath(path)
+        with self._journals_lock:
+            if path not in self._journals:
+                self._journals[path] = RunJournal(path, commit_every=1)
+            return self._journals[path]
+
+    def serve_forever(self, address: str = DAEMON_ADDRESS):
+        self.address = address
+        listener = Listener(_address(address), authkey=auth_key(create=True))
+        print(f"🟢 OCR daemon {os.getpid()} listening on {address} ({self.cpu_pool.workers} image workers)")
+        try:
+            while not self._stopping.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError) as e:
+                    print(f"⚠️ Rejected a connection: {e}")  # e.g. a wrong OCR_DAEMON_KEY
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            self.close()
+
+    def handle(self, conn):
+        try:
+            with conn:
+                request = conn.recv()
+                command = request.get('command')
+                if command == 'ping':
+                    conn.send({'ok': True, 'pid': os.getpid()})
+                elif command == 'scan':
+                    self._scan(conn, request)
+                elif command == 'stop':
+                    conn.send({'ok': True})
+                    self._stopping.set()
+                    connect(self.address).close()  # wakes up the accept loop
+                else:
+                    conn.send({'error': f"Unknown command: {command}"})
+        except (EOFError, OSError):
+            pass  # the client went away mid-request
+
+    def _scan(self, conn, request: dict):
+        run_id = request['run_id']
+        journal = self.journal(request['journal'])
+        print(f"📂 Scanning {request['folder']} (run '{run_id}', journal {journal.path})")
+        records = process.process_folder(self.client, self.cpu_pool, request['folder'], run_id, journal,
+                                         request.get('preprocess') or PREPROCESS_MODE, request.get('ocr_workers', 16))
+        try:
+            with closing(records):
+                for record in records:
+                    conn.send({'record': record})
+        except (EOFError, OSError) as e:
+            # Usually the client disconnecting: closing the records above cancelled the images
+            # not started yet; handle() drops the connection.
+            print(f"⏹️ Scan of {request['folder']} stopped: {e}")
+            raise
+        except Exception as e:
+            print(f"❌ Scan of {request['folder']} failed: {e}")
+            conn.send({'error': str(e)})
+            return
+        finally:
+            journal.flush()
+        conn.send({'done': {'run': journal.summary(run_id), 'vision': self.client.stats()}})
+
+    def close(self):
+        self.client.close()
+        self.cpu_pool.close()
+        with self._journals_lock:
+            for journal in self._journals.values():
+                journal.close()
+        print(f"\n{metrics.REGISTRY.summary()}")
+
+# --- Client side ---
+def is_running(address: str = DAEMON_ADDRESS) -> bool:
+    """Whether a daemon answers at `address`."""
+    try:
+        with connect(address) as conn:
+            conn.send({'command': 'ping'})
+            return bool(conn.recv().get('ok'))
+    except Exception:
+        return False
+
+def scan(folder: str, run_id: str, journal_path: str, preprocess_mode: str | None = None, ocr_workers: int = 16,
+         address: str = DAEMON_ADDRESS) -> Iterator[dict]:
+    """
+    Has the daemon scan `folder`, journaling under `run_id` in the run journal at
+    `journal_path`, and yields its messages as they arrive: {'record': ...} per image in
+    file order (see process.process_folder), then {'done': summary}. Closing the generator
+    early disconnects, which stops the scan.
+    """
+    with connect(address) as conn:
+        conn.send({'command': 'scan', 'folder': os.path.abspath(folder), 'run_id': run_id,
+                   'journal': os.path.abspath(journal_path), 'preprocess': preprocess_mode,
+                   'ocr_workers': ocr_workers})
+        while True:
+            message = conn.recv()
+            if 'error' in message:
+                raise RuntimeError(f"OCR daemon: {message['error']}")
+            yield message
+            if 'done' in message:
+                return
+
+def stop(address: str = DAEMON_ADDRESS) -> bool:
+    try:
+        with connect(address) as conn:
+            conn.send({'command': 'stop'})
+            return bool(conn.recv().get('ok'))
+    except Exception:
+        return False
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Long-lived OCR worker for process.py.")
+    parser.add_argument('--address', default=DAEMON_ADDRESS, help="host:port or socket path (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="start the daemon in the foreground")
+    serve.add_argument('--cpu-workers', type=int, default=CPU_WORKERS)
+    commands.add_parser('status', help="check whether a daemon answers")
+    commands.add_parser('stop', help="stop a running daemon")
+    args = parser.parse_args(argv)
+
+    if args.command == 'status':
+        running = is_running(args.address)
+        print(f"OCR daemon at {args.address}: {'running' if running else 'not running'}")
+        return 0 if running else 1
+    if args.command == 'stop':
+        return 0 if stop(args.address) else 1
+
+    if is_running(args.address):
+        print(f"An OCR daemon is already running at {args.address}.")
+        return 1
+    vision_client = process_logic.setup_vision_client(KEY_PATH)
+    if not vision_client:
+        print("Could not start. Please check the Google Vision API key path.")
+        return 1
+    OcrDaemon(vision_client, args.cpu_workers).serve_forever(args.address)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
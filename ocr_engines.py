@@ -0,0 +1,167 @@
+import metrics
+import process_logic
+from lazy import lazy_import
+from national_id import find_national_id
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# This file contains the pluggable OCR engines behind detect_text_from_image.
+# Every engine turns image bytes into text. VisionEngine wraps the Google Vision
+# path, LocalEngine runs on the CPU with OpenCV preprocessing and a digit-focused
+# Tesseract pass, and CascadeEngine tries the local engine first and only escalates
+# to Vision when the local result does not yield a structurally valid National ID.
+
+DIGIT_WHITELIST = '0123456789٠١٢٣٤٥٦٧٨٩'
+
+class OCREngine:
+    """Base class: `detect_text(content, label)` returns the text found in the image, or None."""
+    name = 'base'
+
+    def detect_text(self, content: bytes, label: str = 'image') -> str | None:
+        raise NotImplementedError
+
+class VisionEngine(OCREngine):
+    """Google Vision OCR (single-call or two-call path, see process_logic.SINGLE_CALL_OCR)."""
+    name = 'vision'
+
+    def __init__(self, client, single_call: bool | None = None):
+        self.client = client
+        self.single_call = single_call
+
+    def detect_text(self, content: bytes, label: str = 'image') -> str | None:
+        return process_logic.detect_text_from_bytes(self.client, content, label, self.single_call)
+
+class LocalEngine(OCREngine):
+    """
+    CPU-only OCR. The card is normalised with OpenCV (grayscale, resize, contrast
+    equalisation), the widest text lines are located with morphological filtering, and
+    each line is read by Tesseract restricted to Western and Arabic-Indic digits.
+    Needs the optional `pytesseract` package and the tesseract binary with 'ara' data.
+    """
+    name = 'local'
+
+    def __init__(self, lang: str = 'ara+eng', max_lines: int = 6, tesseract_cmd: str | None = None):
+        try:
+            import pytesseract
+        except ImportError as e:
+            raise RuntimeError("Local OCR needs the 'pytesseract' package and the tesseract binary.") from e
+        if tesseract_cmd:
+            pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+        pytesseract.get_tesseract_version()  # Fails fast when the binary is missing.
+        self._tesseract = pytesseract
+        self.lang = lang
+        self.max_lines = max_lines
+
+    @staticmethod
+    def preprocess(content: bytes, target_height: int = 1000):
+        """Decodes the image to grayscale, scales it to a fixed height and equalises contrast."""
+        gray = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return None
+        scale = target_height / gray.shape[0]
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+        gray = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(gray)
+        return cv2.GaussianBlur(gray, (3, 3), 0)
+
+    @staticmethod
+    def _line_boxes(gray) -> list:
+        """
+        Locates horizontal text lines: a black-hat filter isolates dark print on the light
+        card, horizontal gradients are closed into line-shaped blobs and thresholded with Otsu.
+        """
+        height, width = gray.shape
+        blackhat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 7)))
+        gradient = np.absolute(cv2.Sobel(blackhat, cv2.CV_32F, 1, 0, ksize=3))
+        gradient = cv2.normalize(gradient, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+        gradient = cv2.morphologyEx(gradient, cv2.MORPH_CLOSE,
+                                    cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 30, 9), 3)))
+        _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        binary = cv2.dilate(cv2.erode(binary, None, iterations=2), None, iterations=2)
+        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        boxes = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if w >= 4 * h and h >= 0.01 * height:
+                boxes.append((w, x, y, h))
+        return sorted(boxes, reverse=True)
+
+    def find_text_lines(self, gray) -> list:
+        """
+        Returns crops of the widest text lines, where the 14-digit ID number is printed.
+        Cards photographed sideways are handled by also searching the image turned 90 degrees
+        and keeping the orientation with more line-shaped regions.
+        """
+        turned = cv2.rotate(gray, cv2.ROTATE_90_CLOCKWISE)
+        upright_boxes, turned_boxes = self._line_boxes(gray), self._line_boxes(turned)
+        if len(turned_boxes) > len(upright_boxes):
+            gray, boxes = turned, turned_boxes
+        else:
+            boxes = upright_boxes
+
+        crops = []
+        for w, x, y, h in boxes[:self.max_lines]:
+            pad = max(h // 4, 2)
+            crops.append(gray[max(y - pad, 0):y + h + pad, max(x - pad, 0):x + w + pad])
+        return crops
+
+    def detect_text(self, content: bytes, label: str = 'image') -> str | None:
+        try:
+            gray = self.preprocess(content)
+            if gray is None:
+                print(f"❌ Local OCR could not decode {label}.")
+                return None
+            config = f'--psm 7 -c tessedit_char_whitelist={DIGIT_WHITELIST}'
+            lines = []
+            for crop in self.find_text_lines(gray):
+                text = self._tesseract.image_to_string(crop, lang=self.lang, config=config).strip()
+                if text:
+                    lines.append(text)
+            return '\n'.join(lines) or None
+        except Exception as e:
+            print(f"❌ Local OCR error for {label}: {str(e)}")
+            return None
+
+class CascadeEngine(OCREngine):
+    """
+    Local-first OCR. The local text is accepted when it yields a National ID that passes
+    the structural checks (century, birth date, governorate, check digit); otherwise the
+    card escalates to the cloud engine. Counts how often each path was taken.
+    """
+    name = 'cascade'
+
+    def __init__(self, local: OCREngine, cloud: OCREngine):
+        self.local = local
+        self.cloud = cloud
+        self.local_accepted = 0
+        self.escalated = 0
+
+    def detect_text(self, content: bytes, label: str = 'image') -> str | None:
+        text = self.local.detect_text(content, label)
+        match = find_national_id(text)
+        if match is not None and not match.errors:
+            self.local_accepted += 1
+            metrics.OCR_CASCADE.inc(decision='local')
+            return text
+        self.escalated += 1
+        metrics.OCR_CASCADE.inc(decision='vision')
+        return self.cloud.detect_text(content, label)
+
+def build_engine(name: str, vision_client=None, single_call: bool | None = None) -> OCREngine:
+    """
+    Builds the engine named 'vision', 'local' or 'cascade'. A cascade whose local
+    backend is unavailable falls back to Vision only.
+    """
+    if name == 'vision':
+        return VisionEngine(vision_client, single_call)
+    if name == 'local':
+        return LocalEngine()
+    if name == 'cascade':
+        try:
+            local = LocalEngine()
+        except Exception as e:
+            print(f"⚠️ Warning: local OCR unavailable ({e}). Using Google Vision only.")
+            return VisionEngine(vision_client, single_call)
+        return CascadeEngine(local, VisionEngine(vision_client, single_call))
+    raise ValueError(f"Unknown OCR engine: {name}")
@@ -0,0 +1,219 @@
+from dataclasses import dataclass
+
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# This file contains the local orientation check that runs before any Vision call.
+# Reading the angle of the first text box from a text_detection call costs a full API
+# request per card, while most cards can be turned upright on the CPU in milliseconds:
+#   - EXIF: phone photos carry an Orientation tag; decoding with OpenCV applies it, and the
+#     re-encoded image no longer depends on whether the reader honours the tag.
+#   - Axis: text lines are wide, flat blobs of ink. Comparing how much line-shaped ink the
+#     image has as it is and turned a quarter turn tells landscape text from portrait text.
+#   - Direction: printed Arabic (and Latin) text is heaviest along its baseline, which sits
+#     in the lower half of the line, so the row with the most ink falls below the middle of
+#     upright lines and above it in upside-down ones. Each line votes; lines without a clear
+#     peak (bars, blocks) abstain.
+#   - Skew: the residual tilt of the line blobs, undone when it is small.
+# The result comes with a confidence; callers fall back to Vision when it is low.
+
+# Longer side of the copy the estimate works on
+ANALYSIS_SIDE = 800
+
+# Lines needed before the direction vote counts. A card back has two digit lines (the ID
+# number and the expiry date), and Arabic-Indic digits are top-heavy, so they vote wrong.
+MIN_VOTING_LINES = 4
+
+# A line votes when its densest row is this far (as a fraction of the line height) from the middle
+PEAK_OFFSET = 0.1
+
+# Tilts below MIN_SKEW degrees are left alone, and above MAX_SKEW are not trusted
+MIN_SKEW = 0.5
+MAX_SKEW = 15.0
+
+@dataclass
+class Orientation:
+    """
+    Local orientation estimate. `angle` is the direction the text runs in, in the same
+    convention as the Vision path (0 upright, 90 reading downwards, -90 reading upwards,
+    180 upside down); `skew` is the remaining tilt in degrees (positive: clockwise);
+    `confidence` is 0-1; `exif` is the image's EXIF Orientation tag (1 when absent).
+    """
+    angle: int
+    skew: float
+    confidence: float
+    exif: int = 1
+
+def exif_orientation(content: bytes) -> int:
+    """The EXIF Orientation tag (1-8) of a JPEG, read from the header without decoding; 1 when absent."""
+    data = bytes(content[:1 << 16])
+    if data[:2] != b'\xff\xd8':
+        return 1
+    i = 2
+    while i + 4 <= len(data) and data[i] == 0xFF:
+        marker, length = data[i + 1], int.from_bytes(data[i + 2:i + 4], 'big')
+        if marker == 0xE1 and data[i + 4:i + 10] == b'Exif\x00\x00':
+            tiff = data[i + 10:i + 2 + length]
+            order = 'little' if tiff[:2] == b'II' else 'big'
+            ifd = int.from_bytes(tiff[4:8], order)
+            for k in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+                entry = tiff[ifd + 2 + 12 * k:ifd + 14 + 12 * k]
+                if len(entry) == 12 and int.from_bytes(entry[:2], order) == 0x0112:
+                    value = int.from_bytes(entry[8:10], order)
+                    return value if 1 <= value <= 8 else 1
+            return 1
+        if marker in (0xD9, 0xDA):  # end of image / start of scan: no more metadata
+            break
+        i += 2 + length
+    return 1
+
+def _ink(gray):
+    """Mask of dark print on a light card. The square kernel makes it the same for any quarter turn."""
+    blackhat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, cv2.getStructuringElement(cv2.MORPH_RECT, (25, 25)))
+    return cv2.threshold(blackhat, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+
+def _line_blobs(ink) -> list:
+    """The line-shaped blobs (x, y, w, h, component mask) of an ink mask."""
+    height, width = ink.shape
+    closed = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 40, 9), 1)))
+    closed = cv2.morphologyEx(closed, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3)))
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(closed)
+    blobs = []
+    for i in range(1, count):
+        x, y, w, h, _ = stats[i]
+        if w >= 3 * h and h >= 0.008 * height and w >= 0.05 * width:
+            blobs.append((x, y, w, h, labels[y:y + h, x:x + w] == i))
+    return blobs
+
+def _line_area(blobs) -> int:
+    return sum(int(w) * int(h) for _, _, w, h, _ in blobs)
+
+def _direction_votes(ink, blobs) -> tuple[int, int]:
+    """
+    (upright, upside-down) votes of the text lines whose densest row is clearly off-centre.
+    Blobs sharing rows (words of one line) add up to a single vote.
+    """
+    lines = []  # [top, bottom, summed offset]
+    for x, y, w, h, _ in sorted(blobs, key=lambda blob: blob[1]):
+        if h < 8:
+            continue
+        profile = ink[y:y + h, x:x + w].sum(axis=1, dtype=np.float32)
+        profile = cv2.GaussianBlur(profile.reshape(-1, 1), (1, 5), 0).ravel()
+        if profile.max() < 1.25 * profile.mean():
+            continue  # Flat profile: a solid bar or block, no baseline to read.
+        offset = int(profile.argmax()) / (h - 1) - 0.5
+        if lines and y < lines[-1][1] - h / 2:
+            lines[-1][1] = max(lines[-1][1], y + h)
+            lines[-1][2] += offset
+        else:
+            lines.append([y, y + h, offset])
+    upright = sum(1 for _, _, offset in lines if offset > PEAK_OFFSET)
+    flipped = sum(1 for _, _, offset in lines if offset < -PEAK_OFFSET)
+    return upright, flipped
+
+def _skew(blobs) -> float:
+    """Median tilt (degrees, positive clockwise) of the wide line blobs; 0.0 without any."""
+    angles, weights = [], []
+    for x, y, w, h, mask in blobs:
+        if w < 5 * h:
+            continue
+        ys, xs = np.nonzero(mask)
+        (_, _), (rect_w, rect_h), angle = cv2.minAreaRect(np.column_stack((xs, ys)).astype(np.float32))
+        if rect_w < rect_h:
+            angle -= 90
+        angle = (angle + 45) % 90 - 45
+        angles.append(angle)
+        weights.append(w)
+    if not angles:
+        return 0.0
+    order = np.argsort(angles)
+    cumulative = np.cumsum(np.asarray(weights, dtype=np.float64)[order])
+    return float(np.asarray(angles)[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+
+def turn_upright(image, angle: int):
+    """Turns an image whose text runs at `angle` so that the text is upright."""
+    if angle == 90:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if angle == -90:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if angle == 180:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    return image
+
+def estimate_orientation(content: bytes) -> Orientation | None:
+    """Estimates the text orientation of an image; None when the bytes cannot be decoded."""
+    exif = exif_orientation(content)
+    buffer = np.frombuffer(content, np.uint8)
+    # Large photos are decoded at half size straight from the JPEG data; both modes apply the EXIF tag.
+    gray = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None or max(gray.shape) < 0.75 * ANALYSIS_SIDE:
+        gray = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    return _estimate(gray, exif)
+
+def estimate_image_orientation(image) -> Orientation:
+    """estimate_orientation for an image that is already decoded (a BGR array, no EXIF tag)."""
+    return _estimate(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 1)
+
+def _estimate(gray, exif: int) -> Orientation:
+    scale = ANALYSIS_SIDE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    ink = _ink(gray)
+    turned_ink = cv2.rotate(ink, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    blobs, turned_blobs = _line_blobs(ink), _line_blobs(turned_ink)
+    area, turned_area = _line_area(blobs), _line_area(turned_blobs)
+    if not max(area, turned_area):
+        return Orientation(0, 0.0, 0.0, exif)
+    axis_confidence = 1 - min(area, turned_area) / max(area, turned_area)
+
+    # Landscape text reads at 0 or 180; portrait text, once turned counter-clockwise, at 0
+    # (it was reading downwards, 90) or 180 (reading upwards, -90). A half turn does not
+    # change which way a line tilts, so the skew holds for every angle.
+    portrait = turned_area > area
+    ink, blobs = (turned_ink, turned_blobs) if portrait else (ink, blobs)
+    skew = _skew(blobs)
+    if MIN_SKEW <= abs(skew) <= MAX_SKEW:
+        # Tilted lines have their densest row off-centre for geometric reasons; vote level.
+        height, width = ink.shape
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1.0)
+        ink = cv2.warpAffine(ink, matrix, (width, height), flags=cv2.INTER_NEAREST)
+        blobs = _line_blobs(ink)
+    upright, flipped = _direction_votes(ink, blobs)
+    voters = upright + flipped
+    direction_confidence = abs(upright - flipped) / voters if voters >= MIN_VOTING_LINES else 0.0
+    if portrait:
+        angle = 90 if upright >= flipped else -90
+    else:
+        angle = 0 if upright >= flipped else 180
+    return Orientation(angle, round(skew, 2), round(min(axis_confidence, direction_confidence), 3), exif)
+
+def apply_orientation(content: bytes, angle: int, skew: float = 0.0, exif: int = 1, jpeg_quality: int = 90) -> bytes:
+    """
+    Returns the image turned so that text running at `angle` is upright and, when the tilt is
+    between MIN_SKEW and MAX_SKEW degrees, deskewed. The original bytes are returned when
+    there is nothing to do; otherwise the image is re-encoded (PNGs stay PNG) with the EXIF
+    orientation already applied to the pixels.
+    """
+    deskew = MIN_SKEW <= abs(skew) <= MAX_SKEW
+    if angle == 0 and not deskew and exif == 1:
+        return content
+    image = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("image could not be decoded")
+    image = turn_upright(image, angle)
+    if deskew:
+        height, width = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1.0)
+        image = cv2.warpAffine(image, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    if bytes(content[:8]) == b'\x89PNG\r\n\x1a\n':
+        ok, encoded = cv2.imencode('.png', image)
+    else:
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    if not ok:
+        raise ValueError("oriented image could not be encoded")
+    return encoded.tobytes()
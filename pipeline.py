@@ -0,0 +1,356 @@
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator
+
+import process_logic
+import preprocess
+import metrics
+from cpu_pool import CpuPool
+
+# This file contains the concurrent batch engine used by app.py.
+# Each stage runs in its own pool of worker threads, and stages are connected by
+# bounded queues so a slow stage (usually the Vision calls) applies backpressure
+# upstream instead of letting downloaded images pile up in memory. The CPU-bound image
+# steps (hashing, preprocessing, rotation re-encode) are handed to a process pool (see
+# cpu_pool.py) so they neither hold the GIL nor slow down the I/O-bound stages.
+
+_DONE = object()
+
+# How often a thread blocked on a full or empty queue checks whether the run was cancelled
+_POLL_INTERVAL = 0.1  # seconds
+
+# Fields of a verification result and their types (see result_sink.py)
+RESULT_COLUMNS = {
+    'row_number': int, 'excel_row_id': str, 'excel_nationality_id': str, 'extracted_id': str, 'is_match': bool,
+    'image_path': str, 'duplicate_of': str, 'suspect': bool, 'status': str,
+    'registry_match': str, 'registry_owner': str, 'registry_distance': int,
+}
+
+# Result statuses that finish a row; the others (failed, download_failed) are retried on resume
+DONE_STATUSES = ('match', 'mismatch')
+
+@dataclass
+class PipelineConfig:
+    """Worker counts per stage and the size of the queues between stages."""
+    download_workers: int = 8
+    preprocess_workers: int = 4
+    rotation_workers: int = 4
+    ocr_workers: int = 8
+    extract_workers: int = 2
+    queue_size: int = 32
+    single_call: bool | None = None
+    preprocess: str | None = None  # see preprocess.PREPROCESS_MODES; None uses OCR_PREPROCESS
+    preprocess_max_side: int = 1600
+    cpu_workers: int | None = None  # image-step processes; None: one per core, 0: run in the stage threads
+
+@dataclass
+class Stage:
+    """
+    A named pipeline step. `fn` receives the row dict and returns it (possibly updated).
+    Rows marked as failed (or resolved early) skip every stage that is not `always` run.
+    """
+    name: str
+    fn: Callable[[dict], dict]
+    workers: int = 1
+    always: bool = False
+
+def _put(q: queue.Queue, item, cancelled: threading.Event) -> bool:
+    """Puts `item` on `q`, waiting for room until the run is cancelled. Returns whether it was put."""
+    while not cancelled.is_set():
+        try:
+            q.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q: queue.Queue, cancelled: threading.Event):
+    """Takes the next item from `q`; _DONE once the run is cancelled."""
+    while not cancelled.is_set():
+        try:
+            return q.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def _drain(q: queue.Queue):
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+def _run_stage(stage: Stage, inbox: queue.Queue, outbox: queue.Queue, state: dict, cancelled: threading.Event):
+    """Worker loop: pulls rows from `inbox`, applies the stage and pushes them to `outbox`, until done or cancelled."""
+    while True:
+        item = _get(inbox, cancelled)
+        if item is _DONE:
+            _put(inbox, _DONE, cancelled)  # Let sibling workers see the sentinel too.
+            with state['lock']:
+                state['remaining'] -= 1
+                last_worker = state['remaining'] == 0
+            if last_worker:
+                _put(outbox, _DONE, cancelled)
+            return
+
+        if stage.always or not (item.get('failed') or item.get('resolved')):
+            start = time.perf_counter()
+            try:
+                item = stage.fn(item)
+            except Exception as e:
+                print(f"❌ Stage '{stage.name}' failed for row {item.get('row_number')}: {e}")
+                metrics.ERRORS.inc(category=f"stage_{stage.name}")
+                item['failed'] = True
+                item['failed_stage'] = stage.name
+                item['error'] = f"{stage.name} error: {e}"
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage.name)
+        if not _put(outbox, item, cancelled):
+            return
+
+def run_stages(items: Iterable[dict], stages: list[Stage], queue_size: int = 32) -> Iterator[dict]:
+    """
+    Pushes `items` through `stages` concurrently and yields each row once it has
+    passed the last stage. Rows are yielded in completion order, not input order.
+    If iterating `items` raises, the rows already fed are drained and the error is re-raised.
+    If the consumer stops early (the generator is closed or raises), the run is cancelled:
+    the feed and stage threads exit and the rows in flight are dropped.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    cancelled = threading.Event()
+    threads = []
+    feed_error = []
+
+    def feed():
+        try:
+            for item in items:
+                if not _put(queues[0], item, cancelled):
+                    return
+        except BaseException as e:
+            feed_error.append(e)
+        finally:
+            _put(queues[0], _DONE, cancelled)
+
+    threads.append(threading.Thread(target=feed, name='pipeline-feed', daemon=True))
+    for i, stage in enumerate(stages):
+        state = {'lock': threading.Lock(), 'remaining': max(stage.workers, 1)}
+        for n in range(max(stage.workers, 1)):
+            threads.append(threading.Thread(
+                target=_run_stage, args=(stage, queues[i], queues[i + 1], state, cancelled),
+                name=f'pipeline-{stage.name}-{n}', daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            yield item
+        for thread in threads:
+            thread.join()
+    finally:
+        # After a full run this is a no-op; after an early stop it releases every thread
+        # blocked on a queue (a stage busy with a row exits once that row is done).
+        cancelled.set()
+        for q in queues:
+            _drain(q)
+    if feed_error:
+        raise feed_error[0]
+
+# --- Excel verification stages ---
+def build_verification_stages(vision_client, fetch_fn, config: PipelineConfig, thumbnail_folder: str | None = None,
+                              journal=None, run_id: str | None = None, engine=None, hash_index=None,
+                              cpu_pool: CpuPool | None = None, registry=None, near_miss: bool = True) -> list[Stage]:
+    """
+    Builds the download -> [dedupe] -> preprocess -> rotation -> OCR -> extract/compare stages used to verify
+    the 'back link' image of every Excel row against its 'nationality_id'.
+
+    Images travel between stages as in-memory bytes. `fetch_fn(url, save_to)` must return
+    (success, message, content); when `thumbnail_folder` is set each image is also written
+    there as row_N.jpg for the UI, but no stage reads it back. Before OCR the card is
+    cropped, deskewed and downscaled (see preprocess.py) so less data is uploaded.
+    Every result carries a `status`: match, mismatch, failed (no ID could be read) or
+    download_failed, which the results page filters on.
+
+    Orientation is checked locally first (see orientation.py); the two-call Vision path
+    falls back to text_detection when that check is unsure, and with an OCR `engine` (see
+    ocr_engines.py) only confident local results are applied before the engine runs.
+    With a RunJournal, each row's progress (downloaded, ocr_done, extracted or failed)
+    is recorded under `run_id` so an interrupted run can be resumed. Rows only become
+    'matched' once the caller has stored their results (see journal_persisted).
+
+    With an ImageHashIndex (see image_hash.py), each downloaded image is looked up right
+    away: a near-duplicate of an already verified card reuses that card's extracted ID
+    without any OCR, and is flagged as a suspect when that card belongs to a different
+    nationality_id. Newly verified cards are added to the index.
+
+    With an IdRegistry (see id_registry.py) of the whole sheet, every extracted ID is also
+    resolved to the row it belongs to: the row's own, another row's (a swapped upload) or
+    none; with `near_miss`, IDs one OCR slip away from a registered ID count too.
+
+    With a CpuPool, hashing, preprocessing and the rotation re-encode run in its worker
+    processes, and those stages get at least one thread per process to keep them busy.
+    """
+    images = cpu_pool if cpu_pool is not None else CpuPool(0)
+    cpu_workers = max(config.preprocess_workers, images.workers)
+    single_call = process_logic.SINGLE_CALL_OCR if config.single_call is None else config.single_call
+    preprocess_mode = preprocess.PREPROCESS_MODE if config.preprocess is None else config.preprocess
+
+    def mark(item, state, error=None):
+        if journal is not None:
+            journal.mark(run_id, item['row_number'], state, error)
+
+    def download(item):
+        local_filename = f"row_{item['row_number']}.jpg"
+        save_to = os.path.join(thumbnail_folder, local_filename) if thumbnail_folder else None
+        success, message, content = fetch_fn(item['image_url'], save_to)
+        if success:
+            item['content'] = content
+            item['image_path'] = local_filename if save_to else None
+            mark(item, 'downloaded')
+        else:
+            item['failed'] = True
+            item['failed_stage'] = 'download'
+            item['error'] = f"Download Failed: {message}"
+        return item
+
+    def dedupe(item):
+        item['image_hash'] = images.image_hashes(item['content'])
+        found = hash_index.lookup(item['image_hash']) if item['image_hash'] else None
+        if found:
+            entry, distance = found
+            item['resolved'] = True
+            item['duplicate_of'] = entry['excel_row_id']
+            item['extracted_id'] = entry['extracted_id']
+            item['suspect'] = entry['excel_nationality_id'] != item['excel_nationality_id']
+            del item['content']
+            print(f"♻️ Row {item['row_number']} is a copy of the card for ID {entry['excel_row_id']} "
+                  f"(distance {distance}){', registered to a different nationality_id' if item['suspect'] else ''}.")
+        return item
+
+    def prepare(item):
+        item['content'] = images.prepare_for_ocr(item['content'], preprocess_mode, config.preprocess_max_side)
+        return item
+
+    def rotate(item):
+        if engine is None and not single_call:
+            item['content'] = process_logic.correct_rotation(vision_client, item['content'], f"row {item['row_number']}",
+                                                             images)
+        elif engine is not None:
+            # Engines handle orientation themselves, but a card the local check can turn
+            # upright spares the local OCR its sideways search.
+            item['content'] = process_logic.correct_rotation(None, item['content'], f"row {item['row_number']}", images)
+        return item
+
+    def ocr(item):
+        print(f"Processing downloaded image for row {item['row_number']}...")
+        label = f"row {item['row_number']}"
+        content = item.pop('content')
+        if engine is not None:
+            item['text'] = engine.detect_text(content, label)
+        elif single_call:
+            item['text'] = process_logic.detect_text_single_call(vision_client, content, label)
+        else:
+            item['text'] = process_logic.document_text(vision_client, content, label)
+        if item['text'] is None:
+            metrics.ERRORS.inc(category='ocr_no_text')
+            mark(item, 'failed', 'OCR returned no text')
+        else:
+            mark(item, 'ocr_done')
+        return item
+
+    def extract(item):
+        if item.get('resolved'):
+            extracted_id = item['extracted_id']
+        elif item.get('failed'):
+            extracted_id = item.get('error') or "Extraction Failed"
+        else:
+            text = item.get('text')
+            extracted_id = process_logic.extract_national_id(text) if text else "Extraction Failed"
+            if hash_index is not None and item.get('image_hash') and text and extracted_id \
+                    and hash_index.lookup(item['image_hash']) is None:
+                hash_index.add(item['image_hash'], {
+                    'excel_row_id': item['excel_row_id'],
+                    'excel_nationality_id': item['excel_nationality_id'],
+                    'extracted_id': extracted_id,
+                })
+        is_match = extracted_id == item['excel_nationality_id']
+        metrics.PIPELINE_ROWS.inc(outcome='duplicate' if item.get('resolved') else 'failed' if item.get('failed')
+                                  else 'match' if is_match else 'mismatch')
+        if item.get('failed'):
+            status = 'download_failed' if item.get('failed_stage') == 'download' else 'failed'
+        elif is_match:
+            status = 'match'
+        else:
+            status = 'mismatch' if extracted_id and extracted_id != "Extraction Failed" else 'failed'
+        if status in DONE_STATUSES:
+            mark(item, 'extracted')
+        elif item.get('failed'):
+            mark(item, 'failed', extracted_id)
+        elif item.get('text') is not None:
+            mark(item, 'failed', 'No National ID found')
+        resolution = None
+        if registry is not None and status in ('match', 'mismatch'):
+            resolution = registry.resolve(extracted_id, item['excel_row_id'], near_miss)
+            metrics.ID_REGISTRY_LOOKUPS.inc(match=f"{resolution.match}_near_miss" if resolution.distance else resolution.match)
+            if resolution.match == 'other':
+                print(f"🔀 Row {item['row_number']}: the card's ID{' (one digit off)' if resolution.distance else ''} "
+                      f"is registered to ID {', '.join(resolution.owners)}.")
+        return {
+            'row_number': item['row_number'],
+            'excel_row_id': item['excel_row_id'],
+            'excel_nationality_id': item['excel_nationality_id'],
+            'extracted_id': extracted_id,
+            'is_match': is_match,
+            'image_path': item.get('image_path'),
+            'duplicate_of': item.get('duplicate_of'),
+            'suspect': item.get('suspect', False),
+            'status': status,
+            'registry_match': resolution.match if resolution else None,
+            'registry_owner': ', '.join(resolution.owners) if resolution and resolution.match == 'other' else None,
+            'registry_distance': resolution.distance if resolution else None,
+        }
+
+    return [
+        Stage('download', download, config.download_workers),
+        *([Stage('dedupe', dedupe, cpu_workers)] if hash_index is not None else []),
+        Stage('preprocess', prepare, cpu_workers),
+        Stage('rotation', rotate, max(config.rotation_workers, images.workers)),
+        Stage('ocr', ocr, config.ocr_workers),
+        Stage('extract', extract, config.extract_workers, always=True),
+    ]
+
+def journal_persisted(journal, run_id: str, results: list[dict]):
+    """Marks the rows of stored `results` that need no retry as done ('matched') in the journal."""
+    journal.complete(run_id, [r['row_number'] for r in results if r['status'] in DONE_STATUSES])
+
+def verify_rows(rows: Iterable[dict], vision_client, fetch_fn, config: PipelineConfig | None = None,
+                thumbnail_folder: str | None = None, journal=None, run_id: str | None = None,
+                engine=None, hash_index=None, registry=None, near_miss: bool = True,
+                cpu_pool: CpuPool | None = None) -> Iterator[dict]:
+    """
+    Runs the verification pipeline over `rows` (dicts with 'row_number', 'excel_row_id',
+    'excel_nationality_id' and 'image_url') and yields one result dict per row.
+    With a `journal`, rows already completed under `run_id` are skipped (and not yielded);
+    call journal_persisted once yielded results have been stored to complete them.
+    With a `hash_index`, near-duplicate images reuse earlier results, and with a `registry`
+    extracted IDs are matched against the whole sheet (see build_verification_stages).
+    The image steps run in `cpu_pool` when given (a pool shared across runs, left open), or
+    else in a CpuPool of `config.cpu_workers` processes that lives for this run.
+    """
+    config = config or PipelineConfig()
+    with nullcontext(cpu_pool) if cpu_pool is not None else CpuPool(config.cpu_workers) as cpu_pool:
+        stages = build_verification_stages(vision_client, fetch_fn, config, thumbnail_folder, journal, run_id, engine,
+                                           hash_index, cpu_pool, registry, near_miss)
+        if journal is None:
+            yield from run_stages(rows, stages, config.queue_size)
+            return
+        try:
+            yield from run_stages(journal.pending(run_id, rows, key=lambda r: r['row_number']), stages, config.queue_size)
+        finally:
+            journal.flush()
@@ -0,0 +1,169 @@
+import os
+
+import orientation
+from lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# This file contains the pre-upload image preparation stage.
+# Phone photos of ID cards are often multi-megabyte shots where the card fills a
+# fraction of the frame. Before OCR the card boundary is detected, the card is
+# deskewed with a perspective warp, optionally cropped to the ID-number band, and
+# downscaled to a capped resolution, which cuts upload bytes and per-call latency.
+# The band can only be located on an upright card, so 'band' first turns the card with
+# the local orientation check (see orientation.py) and keeps it whole when that is unsure.
+
+# ID-1 card aspect ratio (85.60 x 53.98 mm)
+CARD_ASPECT = 85.60 / 53.98
+
+# On the back of an upright card the 14-digit number is printed along the top edge.
+ID_BAND = (0.0, 0.35)
+
+# Confidence the local orientation check needs before a card is cropped to its band
+# (the same setting process_logic uses to trust it over Vision)
+BAND_MIN_ORIENTATION_CONFIDENCE = float(os.environ.get('LOCAL_ORIENTATION_MIN_CONFIDENCE', '0.6'))
+
+PREPROCESS_MODES = ('none', 'resize', 'card', 'band')
+
+# Default mode for the pipeline and process.py; set OCR_PREPROCESS=none to upload originals.
+PREPROCESS_MODE = os.environ.get('OCR_PREPROCESS', 'card')
+
+def decode_image(content: bytes):
+    """Decodes image bytes to a BGR array, or None if the bytes are not a readable image."""
+    if not content:
+        return None
+    return cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+
+def downscale(image, max_side: int):
+    """Shrinks the image so its longer side is at most `max_side` pixels (never enlarges)."""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+def _order_corners(points):
+    """Orders four points as top-left, top-right, bottom-right, bottom-left."""
+    points = points.reshape(4, 2).astype(np.float32)
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array([points[np.argmin(sums)], points[np.argmin(diffs)],
+                     points[np.argmax(sums)], points[np.argmax(diffs)]], dtype=np.float32)
+
+def find_card(image, min_area_ratio: float = 0.08):
+    """
+    Returns the four corners of the card, or None when no card-shaped quadrilateral is found.
+    Works on a reduced copy for speed; corners are returned in full-resolution coordinates.
+    """
+    small = downscale(image, 800)
+    ratio = image.shape[1] / small.shape[1]
+    gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+    edges = cv2.Canny(gray, 50, 150)
+    edges = cv2.dilate(edges, cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5)))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    min_area = min_area_ratio * small.shape[0] * small.shape[1]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(contour) < min_area:
+            break
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            quad = approx
+        else:
+            # Rounded corners and glare often break the polygon; fall back to the rotated box.
+            quad = cv2.boxPoints(cv2.minAreaRect(contour)).astype(np.int32)
+        (_, _), (w, h), _ = cv2.minAreaRect(quad)
+        aspect = max(w, h) / max(min(w, h), 1)
+        if abs(aspect - CARD_ASPECT) / CARD_ASPECT <= 0.25:
+            return _order_corners(quad) * ratio
+    return None
+
+def warp_card(image, corners):
+    """Perspective-warps the card to a flat, deskewed rectangle, keeping its orientation."""
+    tl, tr, br, bl = corners
+    width = int(max(np.linalg.norm(tr - tl), np.linalg.norm(br - bl)))
+    height = int(max(np.linalg.norm(bl - tl), np.linalg.norm(br - tr)))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(corners.astype(np.float32), target)
+    return cv2.warpPerspective(image, matrix, (width, height))
+
+def crop_id_band(card, band=ID_BAND):
+    """
+    Crops the ID-number band of a landscape card. Portrait (sideways) cards are returned
+    whole, because which edge carries the number is not known before OCR.
+    """
+    height, width = card.shape[:2]
+    if height > width:
+        return card
+    return card[int(band[0] * height):int(band[1] * height), :]
+
+def upright_id_band(card, band=ID_BAND, min_confidence: float = BAND_MIN_ORIENTATION_CONFIDENCE):
+    """
+    Turns a deskewed card upright with the local orientation check and crops its ID-number
+    band. A card whose orientation is not known with `min_confidence` is returned whole,
+    since the band cannot be located on it; the rotation stage then turns it as usual.
+    """
+    found = orientation.estimate_image_orientation(card)
+    if found.confidence < min_confidence:
+        return card
+    return crop_id_band(orientation.turn_upright(card, found.angle), band)
+
+def prepare_for_ocr(content: bytes, mode: str = 'card', max_side: int = 1600, jpeg_quality: int = 90) -> bytes:
+    """
+    Returns the bytes to upload for OCR.
+      'none'   - the original bytes
+      'resize' - the whole photo downscaled to `max_side`
+      'card'   - the detected card, deskewed and downscaled (whole photo if no card is found)
+      'band'   - like 'card', turned upright and cropped to the ID-number band when its
+                 orientation is known (see upright_id_band)
+    The original bytes are kept whenever preparation fails or would not make the upload smaller.
+    """
+    if mode == 'none':
+        return content
+    if mode not in PREPROCESS_MODES:
+        raise ValueError(f"Unknown preprocess mode: {mode}")
+    try:
+        image = decode_image(content)
+        if image is None:
+            return content
+        if mode in ('card', 'band'):
+            corners = find_card(image)
+            if corners is not None:
+                image = warp_card(image, corners)
+                if mode == 'band':
+                    image = upright_id_band(image)
+        image = downscale(image, max_side)
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        if not ok or len(encoded) >= len(content):
+            return content
+        return encoded.tobytes()
+    except Exception as e:
+        print(f"⚠️ Warning: preprocessing failed, uploading the original image. Error: {e}")
+        return content
+
+def make_thumbnail(content: bytes, max_side: int = 320, jpeg_quality: int = 75) -> bytes | None:
+    """A small JPEG preview of the image for the results page, or None if it cannot be decoded."""
+    image = decode_image(content)
+    if image is None:
+        return None
+    ok, encoded = cv2.imencode('.jpg', downscale(image, max_side), [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    return encoded.tobytes() if ok else None
+
+def rotate_upright(content: bytes, angle: float, jpeg_quality: int = 90) -> bytes:
+    """
+    Turns the image a quarter turn to undo a text angle read by Vision (see
+    process_logic.correct_rotation): clockwise for a positive angle, counter-clockwise
+    otherwise. Like the PIL code it replaces, EXIF orientation is ignored, and PNGs stay PNG.
+    """
+    image = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError("image could not be decoded")
+    image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE if angle > 0 else cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if bytes(content[:8]) == b'\x89PNG\r\n\x1a\n':
+        ok, encoded = cv2.imencode('.png', image)
+    else:
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    if not ok:
+        raise ValueError("rotated image could not be encoded")
+    return encoded.tobytes()
@@ -1,127 +1,149 @@
-import re
 import io
 import os
-import cv2
-import numpy as np
-import pandas as pd
-from PIL import Image as PILImage
-from google.cloud import vision
-from google.oauth2 import service_account
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+from vision_batch import BatchingVisionClient
+from rate_limit import AdaptiveRateLimiter
+from ocr_cache import cached_annotate, get_default_cache
+from run_journal import RunJournal
+import national_id
+import process_logic
+import metrics
+from preprocess import PREPROCESS_MODE
+from cpu_pool import CpuPool
+from result_sink import open_sink
 
 # --- Google Vision API Setup ---
 def setup_vision_client(key_path: str):
     """Initializes and returns a Google Vision API client."""
     try:
+        from google.cloud import vision
+        from google.oauth2 import service_account
+
         credentials = service_account.Credentials.from_service_account_file(key_path)
         return vision.ImageAnnotatorClient(credentials=credentials)
     except Exception as e:
         print(f"❌ Critical Error: Could not setup Google Vision client. Check your key path. Error: {e}")
         return None
 
-def detect_rotation_and_correct_image(client, image_path: str) -> str:
-    """Detects image rotation and corrects it."""
-    try:
-        with io.open(image_path, 'rb') as image_file:
-            content = image_file.read()
-        image = vision.Image(content=content)
-        response = client.text_detection(image=image)
-        if response.text_annotations:
-            vertices = response.text_annotations[0].bounding_poly.vertices
-            if vertices:
-                dy = vertices[1].y - vertices[0].y
-                dx = vertices[1].x - vertices[0].x
-                angle = np.arctan2(dy, dx) * 180 / np.pi
-                if abs(angle) > 45:
-                    with PILImage.open(image_path) as img:
-                        img = img.convert('RGB')
-                        img = img.rotate(270 if angle > 0 else 90, expand=True)
-                        corrected_path = image_path.replace('.jpg', '_corrected.jpg')
-                        img.save(corrected_path)
-                        print(f"🔄 Image rotated and saved as: {corrected_path}")
-                        return corrected_path
-        return image_path
-    except Exception as e:
-        print(f"❌ Error correcting image rotation {image_path}: {str(e)}")
-        return image_path
+def correct_rotation(client, content: bytes, image_path: str, cpu_pool: CpuPool | None = None) -> bytes:
+    """Detects image rotation (locally when possible) and returns upright image bytes, re-encoding in memory only when rotated."""
+    rotated = process_logic.correct_rotation(client, content, image_path, cpu_pool)
+    if rotated is not content:
+        print(f"🔄 Image rotated in memory: {image_path}")
+    return rotated
 
-def detect_text_from_image(client, image_path: str) -> str | None:
-    """Detects and extracts text from an image file after rotation correction."""
-    corrected_path = detect_rotation_and_correct_image(client, image_path)
+def detect_text_from_image(client, image_path: str, preprocess_mode: str = PREPROCESS_MODE, cpu_pool: CpuPool | None = None) -> str | None:
+    """
+    Detects and extracts text from an image file after cropping and rotation correction.
+    The image work runs in `cpu_pool`'s worker processes (inline without one).
+    """
+    cpu_pool = cpu_pool or CpuPool(0)
     try:
-        with io.open(corrected_path, 'rb') as image_file:
+        with io.open(image_path, 'rb') as image_file:
             content = image_file.read()
     except Exception as e:
-        print(f"❌ Error reading image file {corrected_path}: {str(e)}")
+        print(f"❌ Error reading image file {image_path}: {str(e)}")
         return None
-    image = vision.Image(content=content)
-    response = client.document_text_detection(image=image)
+    content = cpu_pool.prepare_for_ocr(content, preprocess_mode)
+    content = correct_rotation(client, content, image_path, cpu_pool)
+    response = cached_annotate(client, content, 'document_text_detection')
     if response.error.message:
-        print(f"❌ Vision API error for {corrected_path}: {response.error.message}")
+        print(f"❌ Vision API error for {image_path}: {response.error.message}")
         return None
-    text = response.text_annotations[0].description if response.text_annotations else None
-    # Clean up temporary corrected file if it was created
-    if corrected_path != image_path and os.path.exists(corrected_path):
-        os.remove(corrected_path)
-    return text
+    return response.text_annotations[0].description if response.text_annotations else None
 
 # --- Information Extraction Logic ---
 def normalize_digits(text: str) -> str:
     """
-    (IMPROVED) Converts all known variants of Arabic-Indic numerals to Western digits.
+    Converts all known variants of Arabic-Indic numerals to Western digits.
     """
-    if not text:
-        return ""
-    # Mapping for both Eastern Arabic and Persian/Urdu numerals
-    numeral_map = {
-        '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4', '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
-        '۰': '0', '۱': '1', '۲': '2', '۳': '3', '۴': '4', '۵': '5', '۶': '6', '۷': '7', '۸': '8', '۹': '9'
-    }
-    translation_table = str.maketrans(numeral_map)
-    return text.translate(translation_table)
+    return national_id.normalize_digits(text)
 
 def extract_national_id(text: str) -> str | None:
     """
-    (IMPROVED) Extracts the 14-digit Egyptian National ID using a more robust and safe logic.
+    Extracts the 14-digit Egyptian National ID with the shared scored extractor
+    (see national_id.find_national_id) and reports how the ID was found.
     """
-    if not text:
+    match = national_id.find_national_id(text)
+    metrics.EXTRACTION_STRATEGY.inc(strategy=match.strategy if match else 'none')
+    if match is None:
         return None
+    if match.errors:
+        print(f"⚠️ Found ID via '{match.strategy}' (confidence {match.confidence}), breaks: {', '.join(match.errors)}")
+    else:
+        print(f"✅ Found ID via '{match.strategy}' (confidence {match.confidence}).")
+    return match.national_id
 
-    # Step 1: Normalize all numeral variants to Western digits. This is the most critical fix.
-    processed_text = normalize_digits(text)
-
-    # Step 2: Create a "clean" version of the text by removing all date patterns to avoid confusion.
-    # This regex removes YYYY/MM/DD, YYYY/MM, and similar formats.
-    cleaned_text = re.sub(r'\b\d{4}/\d{1,2}(/\d{1,2})?\b', '', processed_text)
-
-    # Strategy 1: Find a clean, contiguous 14-digit ID in the cleaned text.
-    # The ID must start with a '2' or '3'.
-    match = re.search(r'\b([23]\d{13})\b', cleaned_text)
-    if match:
-        print("✅ Strategy 1 Success: Found a contiguous 14-digit ID.")
-        return match.group(1)
-
-    # Strategy 2: Find two adjacent 7-digit numbers in the cleaned text.
-    all_numbers = re.findall(r'\d+', cleaned_text)
-    for i in range(len(all_numbers) - 1):
-        if len(all_numbers[i]) == 7 and len(all_numbers[i+1]) == 7:
-            national_id = all_numbers[i] + all_numbers[i+1]
-            if national_id.startswith(('2', '3')):
-                print("✅ Strategy 2 Success: Found two adjacent 7-digit groups.")
-                return national_id
-
-    # Strategy 3 (Smarter & Safer Fallback): Look for a 14-digit ID inside longer number sequences.
-    # This specifically targets cases where a date was merged with the ID by OCR.
-    all_numbers_original = re.findall(r'\d+', processed_text) # Use original text with dates for this check
-    for num_seq in all_numbers_original:
-        if len(num_seq) > 14:
-            # Search for a valid ID embedded within the long number
-            embedded_match = re.search(r'([23]\d{13})', num_seq)
-            if embedded_match:
-                print("⚠️ Strategy 3 (Smarter Fallback) Success: Found embedded ID.")
-                return embedded_match.group(1)
-    
-    # If all else fails, return nothing. This prevents creating bad data.
-    return None
+# --- Folder Scan ---
+RESULT_COLUMNS = {'run_id': str, 'filename': str, 'status': str, 'national_id': str, 'text': str}
+
+def process_folder(client, cpu_pool: CpuPool, image_folder: str, run_id: str, journal: RunJournal,
+                   preprocess_mode: str = PREPROCESS_MODE, ocr_workers: int = 16) -> Iterator[dict]:
+    """
+    OCRs the images of `image_folder` that have not finished under `run_id` and yields one
+    record per image, in file order (see RESULT_COLUMNS). OCR runs on a thread pool so the
+    Vision calls can be grouped into batch_annotate_images requests. Images only become
+    'extracted' once the caller has stored their records (see journal_persisted).
+    Only a few images per thread are submitted ahead of the consumer; when it stops
+    early (e.g. a daemon client disconnects), the images not started yet are never OCR'd.
+    """
+    # Sort files to process them in a consistent order (e.g., image_1, image_2...)
+    files = [f for f in sorted(os.listdir(image_folder)) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    files = list(journal.pending(run_id, files, key=lambda f: f, done_state='extracted'))
+    workers = max(ocr_workers, cpu_pool.workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        try:
+            for filename in files:
+                in_flight.append((filename, executor.submit(
+                    detect_text_from_image, client, os.path.join(image_folder, filename), preprocess_mode, cpu_pool)))
+                if len(in_flight) >= workers * 2:
+                    filename, future = in_flight.popleft()
+                    yield _record(journal, run_id, filename, future.result())
+            while in_flight:
+                filename, future = in_flight.popleft()
+                yield _record(journal, run_id, filename, future.result())
+        finally:
+            for _, future in in_flight:
+                future.cancel()
+
+def _record(journal: RunJournal, run_id: str, filename: str, original_text: str | None) -> dict:
+    national_id_found = None
+    if original_text:
+        journal.mark(run_id, filename, 'ocr_done')
+        national_id_found = extract_national_id(original_text)
+        if not national_id_found:
+            journal.mark(run_id, filename, 'failed', 'No National ID found')
+    else:
+        journal.mark(run_id, filename, 'failed', 'No text extracted')
+    return {'run_id': run_id, 'filename': filename,
+            'status': 'extracted' if national_id_found else 'no_id' if original_text else 'no_text',
+            'national_id': national_id_found, 'text': original_text}
+
+def journal_persisted(journal: RunJournal, records: list[dict]):
+    """Marks the images of stored `records` whose ID was found as done ('extracted') in the journal."""
+    for run_id in {r['run_id'] for r in records}:
+        journal.complete(run_id, [r['filename'] for r in records if r['run_id'] == run_id and r['status'] == 'extracted'],
+                         state='extracted')
+
+def print_record(record: dict):
+    """Prints one image's outcome the way the scan reports it."""
+    print(f"\n\n========================================")
+    print(f"🔎 Processing Image: {record['filename']}")
+    print(f"========================================")
+    if record['text']:
+        print("\n--- Extracted Original Text ---")
+        print(record['text'])
+        print("-------------------------------\n")
+        if record['national_id']:
+            print(f"🎉 SUCCESS: Detected National ID is {record['national_id']}")
+        else:
+            print(f"❌ FAILED: Could not detect a National ID in {record['filename']}.")
+    else:
+        print(f"Could not extract any text from {record['filename']}.")
 
 # --- MAIN EXECUTION BLOCK ---
 if __name__ == "__main__":
@@ -131,36 +153,76 @@ if __name__ == "__main__":
     
     # 2. Path to the folder containing your ID images
     IMAGE_FOLDER = r"D:\National Id Scan\national_id_images"
+
+    # Number of images OCR'd concurrently (Vision calls are sent in batches of up to 16)
+    OCR_WORKERS = 16
+
+    # Crop/deskew the card before upload: 'card', 'band', 'resize' or 'none' (see preprocess.py)
+    PREPROCESS = PREPROCESS_MODE
+
+    # Initial Vision rate in images/s; it adapts to the project's quota (see rate_limit.py)
+    VISION_RATE_LIMIT = 25
+
+    # Processes for decoding, cropping and rotating images (None: one per core, 0: in the OCR threads)
+    CPU_WORKERS = None
+
+    # Re-running with the same RUN_ID skips images that already finished and retries failures
+    RUN_ID = os.environ.get('RUN_ID', os.path.basename(os.path.normpath(IMAGE_FOLDER)))
+
+    # Per-image progress of every run (also used by the OCR daemon, which is sent this path)
+    JOURNAL_PATH = os.path.abspath(os.environ.get('RUN_JOURNAL_PATH', 'run_journal.sqlite3'))
+
+    # Every image's outcome and OCR text is appended here as it finishes (.csv, .sqlite3 or .parquet)
+    RESULTS_FILE = os.environ.get('RESULTS_FILE', 'process_results.csv')
+
+    # Hand the folder to a running OCR daemon (python ocr_daemon.py serve) when there is one;
+    # its Vision client, worker processes and caches are already warm. Set OCR_DAEMON=0 to always run here.
+    USE_DAEMON = os.environ.get('OCR_DAEMON', '1') != '0'
     # ---------------------------------------------------
 
     print("--- Starting ID Scan Process ---")
+    import ocr_daemon
+
+    if USE_DAEMON and os.path.isdir(IMAGE_FOLDER) and ocr_daemon.is_running():
+        print(f"⚡ Sending the folder to the OCR daemon at {ocr_daemon.DAEMON_ADDRESS}")
+        # Images are journaled as done here, once their records are in the results file.
+        journal = RunJournal(JOURNAL_PATH)
+        with open_sink(RESULTS_FILE, RESULT_COLUMNS, key=('run_id', 'filename'),
+                       on_persisted=lambda records: journal_persisted(journal, records)) as results:
+            for message in ocr_daemon.scan(IMAGE_FOLDER, RUN_ID, JOURNAL_PATH, PREPROCESS, OCR_WORKERS):
+                if 'record' in message:
+                    print_record(message['record'])
+                    results.write(message['record'])
+                else:
+                    summary = message['done']
+        print(f"\n📒 Run '{RUN_ID}': {journal.summary(RUN_ID)}")
+        print(f"💾 {results.written} results written to {results.path}")
+        print(f"🚦 Vision calls: {summary['vision']}")
+        journal.close()
+        sys.exit(0)
+
     vision_client = setup_vision_client(KEY_PATH)
     
     if vision_client and os.path.isdir(IMAGE_FOLDER):
-        # Sort files to process them in a consistent order (e.g., image_1, image_2...)
-        files_to_process = sorted(os.listdir(IMAGE_FOLDER))
-        for filename in files_to_process:
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                image_path = os.path.join(IMAGE_FOLDER, filename)
-                print(f"\n\n========================================")
-                print(f"🔎 Processing Image: {filename}")
-                print(f"========================================")
-                
-                original_text = detect_text_from_image(vision_client, image_path)
-                
-                if original_text:
-                    print("\n--- Extracted Original Text ---")
-                    print(original_text)
-                    print("-------------------------------\n")
-
-                    national_id_found = extract_national_id(original_text)
-                    
-                    if national_id_found:
-                        print(f"🎉 SUCCESS: Detected National ID is {national_id_found}")
-                    else:
-                        print(f"❌ FAILED: Could not detect a National ID in {filename}.")
-                else:
-                    print(f"Could not extract any text from {filename}.")
+        journal = RunJournal(JOURNAL_PATH)
+        limiter = AdaptiveRateLimiter(rate=VISION_RATE_LIMIT)
+        # Images are journaled as done once their records are in the results file.
+        results = open_sink(RESULTS_FILE, RESULT_COLUMNS, key=('run_id', 'filename'),
+                            on_persisted=lambda records: journal_persisted(journal, records))
+        with CpuPool(CPU_WORKERS) as cpu_pool, BatchingVisionClient(vision_client, rate_limiter=limiter) as batching_client, results:
+            for record in process_folder(batching_client, cpu_pool, IMAGE_FOLDER, RUN_ID, journal, PREPROCESS, OCR_WORKERS):
+                print_record(record)
+                results.write(record)
+
+        print(f"\n📒 Run '{RUN_ID}': {journal.summary(RUN_ID)}")
+        print(f"💾 {results.written} results written to {results.path}")
+        print(f"🚦 Vision calls: {batching_client.stats()}")
+        journal.close()
+
+        cache = get_default_cache()
+        if cache:
+            print(f"\n📦 OCR cache: {cache.stats()}")
+        print(f"\n{metrics.REGISTRY.summary()}")
     elif not vision_client:
         print("Could not start. Please check the Google Vision API key path.")
     else:
@@ -1,37 +1,94 @@
 import re
 import io
 import os
-import cv2
 import math
-from PIL import Image as PILImage
-from google.cloud import vision
-from google.oauth2 import service_account
+from ocr_cache import cached_annotate
+import national_id
+import metrics
+from cpu_pool import CpuPool
 
 # This file contains the core logic for image processing and text extraction.
 # It's imported by the main app.py file.
 
-def setup_vision_client(key_path: str):
-    """Initializes and returns a Google Vision API client."""
+# Set VISION_API_ENDPOINT (e.g. http://127.0.0.1:8089) to talk to a local fake Vision server.
+VISION_API_ENDPOINT = os.environ.get('VISION_API_ENDPOINT')
+
+# Orientation is first estimated locally from EXIF and the text lines (see orientation.py);
+# the text_detection call is only made when the local estimate is less confident than this.
+# Set LOCAL_ORIENTATION=0 to always ask Vision.
+LOCAL_ORIENTATION = os.environ.get('LOCAL_ORIENTATION', '1') != '0'
+LOCAL_ORIENTATION_MIN_CONFIDENCE = float(os.environ.get('LOCAL_ORIENTATION_MIN_CONFIDENCE', '0.6'))
+
+def setup_vision_client(key_path: str, api_endpoint: str | None = None):
+    """
+    Initializes and returns a Google Vision API client. When `api_endpoint`
+    (or VISION_API_ENDPOINT) is set, an anonymous REST client for that endpoint is returned.
+    """
+    api_endpoint = api_endpoint or VISION_API_ENDPOINT
     try:
+        from google.cloud import vision
+        from google.auth.credentials import AnonymousCredentials
+        from google.oauth2 import service_account
+
+        if api_endpoint:
+            return vision.ImageAnnotatorClient(
+                credentials=AnonymousCredentials(),
+                transport='rest',
+                client_options={'api_endpoint': api_endpoint},
+            )
         credentials = service_account.Credentials.from_service_account_file(key_path)
         return vision.ImageAnnotatorClient(credentials=credentials)
     except Exception as e:
         print(f"❌ Critical Error: Could not setup Google Vision client. Check key path. Error: {e}")
         return None
 
-def detect_rotation_and_correct_image(client, image_path: str) -> str:
-    """Detects image rotation and corrects it."""
+def _read_image_file(image_path: str) -> bytes | None:
+    """Reads an image file once; returns None (and logs) if it cannot be read."""
     try:
         with io.open(image_path, 'rb') as image_file:
-            content = image_file.read()
-        
+            return image_file.read()
+    except Exception as e:
+        print(f"❌ Error reading image file {image_path}: {str(e)}")
+        return None
+
+def _rotation_decision(angle: float) -> str:
+    """rotation_decisions_total label for a text angle: 'upright', 'text_90', 'text_-90' or 'text_180'."""
+    quadrant = int(round(angle / 90.0)) * 90
+    quadrant = 180 if quadrant == -180 else quadrant
+    return 'upright' if quadrant == 0 else f'text_{quadrant}'
+
+def correct_rotation(client, content: bytes, label: str = 'image', images: CpuPool | None = None) -> bytes:
+    """
+    Returns the upright image bytes. The orientation is estimated locally first (EXIF
+    tag, text-line geometry, small-angle skew); only when that estimate is not confident
+    is the angle read from a text_detection call. The image is only decoded and
+    re-encoded (in memory) when it has to be turned; otherwise the original bytes are
+    returned untouched. The image work runs in `images` (a CpuPool; inline without one).
+    With no `client`, low-confidence images are returned as they are.
+    """
+    images = images or CpuPool(0)
+    try:
         # ‼️ FIX: Check if the image content is empty before making an API call.
         if not content:
-            print(f"⚠️ Warning: Content for rotation check is empty for {image_path}. Skipping rotation.")
-            return image_path
+            print(f"⚠️ Warning: Content for rotation check is empty for {label}. Skipping rotation.")
+            metrics.ROTATIONS.inc(path='text_detection', decision='empty')
+            return content
+
+        if LOCAL_ORIENTATION:
+            found = images.estimate_orientation(content)
+            if found is not None:
+                if found.exif != 1:
+                    metrics.ROTATIONS.inc(path='exif', decision=f'exif_{found.exif}')
+                if found.confidence >= LOCAL_ORIENTATION_MIN_CONFIDENCE:
+                    metrics.ROTATIONS.inc(path='local', decision=_rotation_decision(found.angle))
+                    return images.apply_orientation(content, found.angle, found.skew, found.exif)
+                metrics.ROTATIONS.inc(path='local', decision='low_confidence')
+                # Whatever happens next works on the pixels as displayed.
+                content = images.apply_orientation(content, 0, 0.0, found.exif)
+        if client is None:
+            return content
 
-        image = vision.Image(content=content)
-        response = client.text_detection(image=image)
+        response = cached_annotate(client, content, 'text_detection')
         if response.text_annotations:
             vertices = response.text_annotations[0].bounding_poly.vertices
             if vertices:
@@ -39,76 +96,183 @@ def detect_rotation_and_correct_image(client, image_path: str) -> str:
                 dx = vertices[1].x - vertices[0].x
                 angle = (180 / 3.14159) * math.atan2(dy, dx)
                 if abs(angle) > 45:
-                    with PILImage.open(image_path) as img:
-                        img = img.convert('RGB')
-                        img = img.rotate(270 if angle > 0 else 90, expand=True)
-                        corrected_path = image_path.replace('.jpg', '_corrected.jpg').replace('.png', '_corrected.png')
-                        img.save(corrected_path)
-                        return corrected_path
-        return image_path
+                    rotated = images.rotate_upright(content, angle)
+                    metrics.ROTATIONS.inc(path='text_detection', decision=_rotation_decision(angle))
+                    return rotated
+                metrics.ROTATIONS.inc(path='text_detection', decision='upright')
+                return content
+        metrics.ROTATIONS.inc(path='text_detection', decision='no_text')
+        return content
     except Exception as e:
-        print(f"❌ Error correcting image rotation {image_path}: {str(e)}")
+        print(f"❌ Error correcting image rotation {label}: {str(e)}")
+        metrics.ROTATIONS.inc(path='text_detection', decision='error')
+        return content
+
+def detect_rotation_and_correct_image(client, image_path: str) -> str:
+    """
+    Detects image rotation and corrects it. File-based wrapper around correct_rotation:
+    returns the path of a `_corrected` copy when the image had to be rotated.
+    """
+    content = _read_image_file(image_path)
+    if content is None:
         return image_path
+    corrected = correct_rotation(client, content, image_path)
+    if corrected is content:
+        return image_path
+    corrected_path = image_path.replace('.jpg', '_corrected.jpg').replace('.png', '_corrected.png')
+    with io.open(corrected_path, 'wb') as corrected_file:
+        corrected_file.write(corrected)
+    return corrected_path
 
-def detect_text_from_image(client, image_path: str) -> str | None:
-    """Detects and extracts text from an image file after rotation correction."""
-    corrected_path = detect_rotation_and_correct_image(client, image_path)
-    try:
-        with io.open(corrected_path, 'rb') as image_file:
-            content = image_file.read()
-    except Exception as e:
-        print(f"❌ Error reading image file {corrected_path}: {str(e)}")
+# --- Single-call OCR ---
+# When enabled, each card costs one document_text_detection call: the page
+# orientation is read from the returned block geometry and the text is rebuilt
+# in reading order from the word annotations. Set OCR_SINGLE_CALL=0 to use the
+# original two-call path (text_detection for rotation, then OCR on the corrected image).
+SINGLE_CALL_OCR = os.environ.get('OCR_SINGLE_CALL', '1') != '0'
+
+ARABIC_LETTER_RE = re.compile(r'[\u0621-\u064A]')
+
+def _box_angle(vertices) -> float | None:
+    """Returns the angle in degrees of the top edge (vertex 0 -> 1) of a bounding box."""
+    if len(vertices) < 2:
+        return None
+    dy = vertices[1].y - vertices[0].y
+    dx = vertices[1].x - vertices[0].x
+    if dx == 0 and dy == 0:
         return None
+    return math.degrees(math.atan2(dy, dx))
 
+def detect_orientation(annotation) -> int:
+    """
+    Returns the dominant text orientation (0, 90, 180 or -90 degrees) of a
+    full_text_annotation. Vision reports block vertices starting at the top-left
+    corner in the text's natural reading orientation, so the top edge of each
+    block points along its text direction. Blocks vote weighted by symbol count.
+    """
+    votes = {0: 0, 90: 0, 180: 0, -90: 0}
+    for page in annotation.pages:
+        for block in page.blocks:
+            angle = _box_angle(block.bounding_box.vertices)
+            if angle is None:
+                continue
+            quadrant = int(round(angle / 90.0)) * 90
+            quadrant = 180 if quadrant == -180 else quadrant
+            weight = sum(len(word.symbols) for paragraph in block.paragraphs for word in paragraph.words)
+            votes[quadrant] += max(weight, 1)
+    return max(votes, key=votes.get) if any(votes.values()) else 0
+
+def reading_order_text(annotation, angle: float) -> str:
+    """
+    Rebuilds the page text in reading order after undoing a rotation of `angle` degrees.
+    Words are grouped into lines by their upright vertical position; lines containing
+    Arabic letters read right-to-left, digit-only lines (such as the ID number) left-to-right.
+    """
+    theta = math.radians(angle)
+    cos_t, sin_t = math.cos(theta), math.sin(theta)
+    words = []
+    for page in annotation.pages:
+        for block in page.blocks:
+            for paragraph in block.paragraphs:
+                for word in paragraph.words:
+                    vertices = word.bounding_box.vertices
+                    if not vertices:
+                        continue
+                    text = ''.join(symbol.text for symbol in word.symbols)
+                    cx = sum(v.x for v in vertices) / len(vertices)
+                    cy = sum(v.y for v in vertices) / len(vertices)
+                    u = cx * cos_t + cy * sin_t
+                    v = -cx * sin_t + cy * cos_t
+                    vs = [-p.x * sin_t + p.y * cos_t for p in vertices]
+                    words.append((v, u, max(vs) - min(vs), text))
+    if not words:
+        return ""
+
+    words.sort()
+    heights = sorted(w[2] for w in words)
+    tolerance = max(heights[len(heights) // 2] / 2.0, 1.0)
+    lines, current, line_v = [], [], None
+    for word in words:
+        if line_v is not None and word[0] - line_v > tolerance:
+            lines.append(current)
+            current = []
+        if not current:
+            line_v = word[0]
+        current.append(word)
+    lines.append(current)
+
+    output = []
+    for line in lines:
+        rtl = any(ARABIC_LETTER_RE.search(w[3]) for w in line)
+        line.sort(key=lambda w: w[1], reverse=rtl)
+        output.append(' '.join(w[3] for w in line))
+    return '\n'.join(output)
+
+def detect_text_single_call(client, content: bytes, label: str = 'image') -> str | None:
+    """Detects text with one document_text_detection call, correcting orientation from the response."""
+    if not content:
+        print(f"❌ Error: Image content is empty for {label}. Skipping main text detection.")
+        return None
+
+    response = cached_annotate(client, content, 'document_text_detection')
+    if response.error.message:
+        print(f"❌ Vision API error for {label}: {response.error.message}")
+        return None
+    return text_from_document_response(response)
+
+def text_from_document_response(response) -> str | None:
+    """Returns the reading-order text of a document_text_detection response, undoing page rotation."""
+    if not response.text_annotations:
+        metrics.ROTATIONS.inc(path='document', decision='no_text')
+        return None
+    angle = detect_orientation(response.full_text_annotation)
+    metrics.ROTATIONS.inc(path='document', decision=_rotation_decision(angle))
+    if angle == 0:
+        return response.text_annotations[0].description
+    return reading_order_text(response.full_text_annotation, angle) or response.text_annotations[0].description
+
+def document_text(client, content: bytes, label: str = 'image') -> str | None:
+    """Runs document_text_detection on image bytes that are already rotation-corrected."""
     # ‼️ FIX: Check if the image content is empty before making the main API call.
     if not content:
-        print(f"❌ Error: Image content is empty for {corrected_path}. Skipping main text detection.")
+        print(f"❌ Error: Image content is empty for {label}. Skipping main text detection.")
         return None
 
-    image = vision.Image(content=content)
-    response = client.document_text_detection(image=image)
+    response = cached_annotate(client, content, 'document_text_detection')
     if response.error.message:
-        print(f"❌ Vision API error for {corrected_path}: {response.error.message}")
+        print(f"❌ Vision API error for {label}: {response.error.message}")
         return None
-    text = response.text_annotations[0].description if response.text_annotations else None
-    if corrected_path != image_path and os.path.exists(corrected_path):
-        os.remove(corrected_path)
-    return text
+    return response.text_annotations[0].description if response.text_annotations else None
+
+def detect_text_from_bytes(client, content: bytes, label: str = 'image', single_call: bool | None = None) -> str | None:
+    """
+    Detects and extracts text from in-memory image bytes after rotation correction.
+    Uses the single-call path unless `single_call` (or SINGLE_CALL_OCR) is False.
+    """
+    if single_call is None:
+        single_call = SINGLE_CALL_OCR
+    if single_call:
+        return detect_text_single_call(client, content, label)
+    return document_text(client, correct_rotation(client, content, label), label)
+
+def detect_text_from_image(client, image_path: str, single_call: bool | None = None, engine=None) -> str | None:
+    """
+    Detects and extracts text from an image file after rotation correction.
+    When an OCR `engine` (see ocr_engines.py) is given it is used instead of calling Vision directly.
+    """
+    content = _read_image_file(image_path)
+    if content is None:
+        return None
+    if engine is not None:
+        return engine.detect_text(content, image_path)
+    return detect_text_from_bytes(client, content, image_path, single_call)
 
 def normalize_digits(text: str) -> str:
     """Converts all known variants of Arabic-Indic numerals to Western digits."""
-    if not text:
-        return ""
-    numeral_map = {
-        '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4', '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
-        '۰': '0', '۱': '1', '۲': '2', '۳': '3', '۴': '4', '۵': '5', '۶': '6', '۷': '7', '۸': '8', '۹': '9'
-    }
-    translation_table = str.maketrans(numeral_map)
-    return text.translate(translation_table)
+    return national_id.normalize_digits(text)
 
 def extract_national_id(text: str) -> str | None:
-    """Extracts the 14-digit Egyptian National ID using a robust, multi-step strategy."""
-    if not text:
-        return None
-    processed_text = normalize_digits(text)
-    cleaned_text = re.sub(r'\b\d{4}/\d{1,2}(/\d{1,2})?\b', '', processed_text)
-    
-    match = re.search(r'\b([23]\d{13})\b', cleaned_text)
-    if match:
-        return match.group(1)
-
-    all_numbers = re.findall(r'\d+', cleaned_text)
-    for i in range(len(all_numbers) - 1):
-        if len(all_numbers[i]) == 7 and len(all_numbers[i+1]) == 7:
-            national_id = all_numbers[i] + all_numbers[i+1]
-            if national_id.startswith(('2', '3')):
-                return national_id
-
-    all_numbers_original = re.findall(r'\d+', processed_text)
-    for num_seq in all_numbers_original:
-        if len(num_seq) > 14:
-            embedded_match = re.search(r'([23]\d{13})', num_seq)
-            if embedded_match:
-                return embedded_match.group(1)
-    
-    return None
+    """Extracts the 14-digit Egyptian National ID (see national_id.find_national_id)."""
+    match = national_id.find_national_id(text)
+    metrics.EXTRACTION_STRATEGY.inc(strategy=match.strategy if match else 'none')
+    return match.national_id if match else None
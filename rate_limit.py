@@ -0,0 +1,107 @@
+import random
+import threading
+import time
+
+# This file contains the adaptive rate limiter placed in front of all Vision calls.
+# It is a token bucket whose refill rate follows AIMD (additive increase, multiplicative
+# decrease): every successful image nudges the rate up, and every quota error
+# (HTTP 429 / RESOURCE_EXHAUSTED) cuts it down and pauses all callers for an exponential,
+# jittered backoff. Until the first quota error the rate grows quickly (slow start), so a
+# project with a generous quota is not held at the initial rate for minutes. The rate at the
+# last quota error is remembered as the ceiling: after a backoff the rate climbs quickly back
+# to `recover` x that ceiling and only then probes upward additively, so it settles just
+# under the project's quota instead of alternating between bursts and storms of errors.
+
+class AdaptiveRateLimiter:
+    """
+    Thread-safe token bucket measured in images per second. `acquire(n)` blocks until the
+    bucket is non-negative and then takes `n` tokens (it may go into debt, so a full batch
+    never waits for more tokens than the bucket can hold). Call `on_success(n)` after
+    accepted images and `on_throttle()` after a quota error.
+    """
+
+    def __init__(self, rate: float = 25.0, min_rate: float = 1.0, max_rate: float = 1000.0,
+                 burst: float | None = None, increase: float = 1.0, decrease: float = 0.5,
+                 recover: float = 0.9, base_backoff: float = 1.0, max_backoff: float = 60.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.recover = recover
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.waiting = 0
+        self.throttled = 0
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._resume_at = 0.0
+        self._consecutive_throttles = 0
+        self._ceiling = None
+        self._cond = threading.Condition()
+
+    def _capacity(self) -> float:
+        return self.burst if self.burst is not None else max(self.rate, 1.0)
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(self._capacity(), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self, tokens: int = 1):
+        """Blocks until `tokens` images may be sent."""
+        with self._cond:
+            self.waiting += tokens
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self._resume_at and self._tokens >= 0:
+                        self._tokens -= tokens
+                        return
+                    delay = max(self._resume_at - now, -self._tokens / self.rate, 0.001)
+                    self._cond.wait(delay)
+            finally:
+                self.waiting -= tokens
+
+    def on_success(self, tokens: int = 1):
+        """
+        Before any quota error, and below `recover` x the last ceiling, the rate grows by half of
+        every accepted batch (about x1.5 per second); otherwise, additive increase of roughly
+        +`increase` images/s per second.
+        """
+        with self._cond:
+            self._consecutive_throttles = 0
+            if self._ceiling is None:
+                self.rate = min(self.max_rate, self.rate + 0.5 * tokens)
+            elif self.rate < self._ceiling * self.recover:
+                self.rate = min(self._ceiling * self.recover, self.rate + 0.5 * tokens)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase * tokens / self.rate)
+
+    def on_throttle(self):
+        """Multiplicative decrease plus a pause; errors from calls already in flight during the pause are ignored."""
+        with self._cond:
+            now = time.monotonic()
+            if now < self._resume_at:
+                return
+            self.throttled += 1
+            self._consecutive_throttles += 1
+            self._ceiling = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self._consecutive_throttles - 1))
+            self._resume_at = now + backoff * random.uniform(0.5, 1.0)
+            self._tokens = 0.0
+            self._updated = self._resume_at
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """Current rate (images/s), images waiting for tokens, quota errors seen and remaining pause."""
+        with self._cond:
+            return {
+                'rate': round(self.rate, 2),
+                'waiting': self.waiting,
+                'throttled': self.throttled,
+                'backoff': round(max(self._resume_at - time.monotonic(), 0.0), 2),
+            }
@@ -0,0 +1,283 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, Iterator
+
+# This file contains the streaming output stage for result records.
+# Instead of collecting a run's results in a list, the caller writes each record to a sink
+# as soon as it is produced; the sink buffers them and writes a whole batch at once (one
+# executemany per SQLite transaction, one Parquet row group, one block of CSV lines) every
+# `batch_size` records or `flush_interval` seconds, whichever comes first (a background
+# timer flushes records that wait longer, however slowly they arrive). Memory stays flat
+# however long the run is, and SQLite and CSV outputs can be read while it is still going.
+#
+# The format follows the file extension: .sqlite3 / .sqlite / .db, .parquet or .csv.
+# Columns are given as {name: type} with type one of str, int, float or bool; without them
+# they are taken from the first record.
+
+DEFAULT_BATCH_SIZE = int(os.environ.get('RESULTS_BATCH_SIZE', '500'))
+DEFAULT_FLUSH_INTERVAL = float(os.environ.get('RESULTS_FLUSH_INTERVAL', '1.0'))  # seconds
+
+_SQLITE_TYPES = {str: 'TEXT', int: 'INTEGER', float: 'REAL', bool: 'INTEGER'}
+
+class ResultSink:
+    """
+    Base class of the batching sinks. `write(record)` is thread-safe; subclasses implement
+    `_open(columns)` (called with the columns before the first batch) and `_write_batch(records)`.
+    A timer thread, started with the first record, writes buffered records once they are
+    `flush_interval` seconds old. `on_persisted(records)` is called with every batch once it
+    is stored (e.g. to journal those rows as done). Use as a context manager, or call
+    `close()`, so the last partial batch is written.
+    """
+
+    def __init__(self, path: str, columns: dict | None = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, on_persisted: Callable | None = None):
+        self.path = path
+        self.columns = dict(columns) if columns else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_persisted = on_persisted
+        self.written = 0
+        self._pending = []
+        self._opened = False
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._timer = None
+
+    def write(self, record: dict):
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._flush_periodically, name='result-sink-flush', daemon=True)
+                self._timer.start()
+
+    def _flush_periodically(self):
+        while not self._closing.wait(self.flush_interval):
+            with self._lock:
+                if not self._pending or time.monotonic() - self._last_flush < self.flush_interval:
+                    continue
+                try:
+                    self._flush()
+                except Exception as e:
+                    # The records stay buffered; the next write or flush retries them.
+                    print(f"⚠️ Could not write results to {self.path}: {e}")
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        if not self._opened:
+            if self.columns is None:
+                self.columns = {name: type(value) if isinstance(value, (str, int, float, bool)) else str
+                                for name, value in self._pending[0].items()}
+            self._open(self.columns)
+            self._opened = True
+        self._write_batch(self._pending)
+        self.written += len(self._pending)
+        records, self._pending = self._pending, []
+        self._persisted(records)
+
+    def _persisted(self, records: list[dict]):
+        """Reports a stored batch to `on_persisted`."""
+        if self.on_persisted is not None:
+            self.on_persisted(records)
+
+    def close(self):
+        self._closing.set()
+        if self._timer is not None:
+            self._timer.join()
+        with self._lock:
+            self._flush()
+            if self._opened:
+                self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self, columns: dict):
+        raise NotImplementedError
+
+    def _write_batch(self, records: list[dict]):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+class SqliteSink(ResultSink):
+    """
+    Appends records to `table` of a SQLite database, one transaction per batch, in WAL mode
+    so readers can query it during the run. With `key` columns, a record replaces the earlier
+    one with the same key (a retried row of a resumed run) instead of being added twice.
+    """
+
+    def __init__(self, path: str, columns: dict | None = None, table: str = 'results', key: tuple = (), **kwargs):
+        super().__init__(path, columns, **kwargs)
+        self.table = table
+        self.key = tuple(key)
+
+    def _open(self, columns: dict):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        definitions = [f'"{name}" {_SQLITE_TYPES.get(kind, "TEXT")}' for name, kind in columns.items()]
+        if self.key:
+            definitions.append(f"PRIMARY KEY ({', '.join(self.key)})")
+        self._conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table}" ({", ".join(definitions)})')
+        self._conn.commit()
+        names = ', '.join(f'"{name}"' for name in columns)
+        self._insert = (f'INSERT {"OR REPLACE " if self.key else ""}INTO "{self.table}" ({names})'
+                        f' VALUES ({", ".join("?" * len(columns))})')
+
+    def _write_batch(self, records: list[dict]):
+        with self._conn:
+            self._conn.executemany(self._insert, [tuple(map(record.get, self.columns)) for record in records])
+
+    def _close(self):
+        self._conn.close()
+
+class CsvSink(ResultSink):
+    """
+    Appends records to a UTF-8 CSV file (the header is written when the file is new) and
+    flushes the file after every batch, so the rows written so far can be opened at any time.
+    With `key` columns, records are appended as they come, and on close one pass over the
+    file checks for keys written more than once (retried rows of a resumed run); if there
+    are any, the file is rewritten keeping only the last record of each key.
+    """
+
+    def __init__(self, path: str, columns: dict | None = None, key: tuple = (), **kwargs):
+        super().__init__(path, columns, **kwargs)
+        self.key = tuple(key)
+
+    def _key(self, record: dict) -> tuple:
+        # As written to and read back from the file: None becomes ''.
+        return tuple('' if record.get(name) is None else str(record.get(name)) for name in self.key)
+
+    def _open(self, columns: dict):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, 'a', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=list(columns), extrasaction='ignore')
+        if new_file:
+            self._writer.writeheader()
+
+    def _write_batch(self, records: list[dict]):
+        self._writer.writerows(records)
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+        if self.key:
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrites the file keeping the last record of every key, in file order, when a key
+        repeats. The last line of each key is tracked in a temporary SQLite database, which
+        spills to disk, so memory stays flat however large the file is.
+        """
+        index = sqlite3.connect('')
+        try:
+            names = ', '.join(f'k{i}' for i in range(len(self.key)))
+            index.execute(f'CREATE TABLE last ({names}, line INTEGER NOT NULL, PRIMARY KEY ({names}))')
+            with open(self.path, newline='', encoding='utf-8') as source:
+                index.executemany(f'INSERT OR REPLACE INTO last VALUES ({", ".join("?" * (len(self.key) + 1))})',
+                                  ((*self._key(row), line) for line, row in enumerate(csv.DictReader(source))))
+            # The file's last line is always kept, so it also gives the number of lines.
+            keys, last_line = index.execute('SELECT COUNT(*), MAX(line) FROM last').fetchone()
+            if not keys or keys == last_line + 1:
+                return
+            kept = (line for line, in index.execute('SELECT line FROM last ORDER BY line'))
+            partial_path = self.path + '.part'
+            with open(self.path, newline='', encoding='utf-8') as source, \
+                    open(partial_path, 'w', newline='', encoding='utf-8') as target:
+                reader = csv.DictReader(source)
+                writer = csv.DictWriter(target, fieldnames=reader.fieldnames)
+                writer.writeheader()
+                next_kept = next(kept, None)
+                for line, row in enumerate(reader):
+                    if line == next_kept:
+                        writer.writerow(row)
+                        next_kept = next(kept, None)
+            os.replace(partial_path, self.path)
+        finally:
+            index.close()
+
+class ParquetSink(ResultSink):
+    """
+    Writes every batch as a row group of a Parquet file (needs pyarrow). A Parquet file is
+    only readable once closed, and it cannot be appended to: when `path` already exists
+    (e.g. a resumed run), the records go to a numbered sibling (results.1.parquet, ...) so
+    that pyarrow.dataset can read all of them together. Since the file is only complete
+    once closed, `on_persisted` is called once, on close, with every record written.
+    """
+
+    def __init__(self, path: str, columns: dict | None = None, **kwargs):
+        super().__init__(path, columns, **kwargs)
+        self._unreported = []
+
+    def _open(self, columns: dict):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_()}
+        self._schema = pa.schema([(name, types.get(kind, pa.string())) for name, kind in columns.items()])
+        stem, ext = os.path.splitext(self.path)
+        number = 0
+        while os.path.exists(self.path):
+            number += 1
+            self.path = f"{stem}.{number}{ext}"
+        self._pa = pa
+        self._writer = pq.ParquetWriter(self.path, self._schema)
+
+    def _write_batch(self, records: list[dict]):
+        self._writer.write_table(self._pa.Table.from_pylist(records, schema=self._schema))
+
+    def _persisted(self, records: list[dict]):
+        if self.on_persisted is not None:
+            self._unreported.extend(records)
+
+    def _close(self):
+        self._writer.close()
+        records, self._unreported = self._unreported, []
+        super()._persisted(records)
+
+SINKS = {'.sqlite3': SqliteSink, '.sqlite': SqliteSink, '.db': SqliteSink, '.parquet': ParquetSink, '.csv': CsvSink}
+
+def open_sink(path: str, columns: dict | None = None, key: tuple = (), batch_size: int = DEFAULT_BATCH_SIZE,
+              flush_interval: float = DEFAULT_FLUSH_INTERVAL, on_persisted: Callable | None = None) -> ResultSink:
+    """
+    Opens the sink for `path` by its extension, creating parent folders as needed. `key`
+    applies to SQLite and CSV (see SqliteSink and CsvSink); Parquet keeps every record.
+    `on_persisted(records)` is called with the records once they are stored (see ResultSink).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in SINKS:
+        raise ValueError(f"Unsupported results format: {ext}")
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    if SINKS[ext] in (SqliteSink, CsvSink):
+        return SINKS[ext](path, columns, key=key, batch_size=batch_size, flush_interval=flush_interval,
+                          on_persisted=on_persisted)
+    return SINKS[ext](path, columns, batch_size=batch_size, flush_interval=flush_interval, on_persisted=on_persisted)
+
+def tee(records: Iterable[dict], sink: ResultSink | None) -> Iterator[dict]:
+    """Writes every record to `sink` on its way through; the sink is closed when the records end or the consumer stops."""
+    if sink is None:
+        yield from records
+        return
+    with sink:
+        for record in records:
+            sink.write(record)
+            yield record
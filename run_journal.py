@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator
+
+# This file contains the durable run journal used to resume interrupted batch runs.
+# Every row of a run moves through the states below and each transition is recorded
+# in SQLite, so re-running with the same run ID skips rows that already finished and
+# only retries rows that failed or never got to the end. A row only reaches its final
+# state once its result has been stored (see `complete`), so a crash never leaves a row
+# marked as done without a result.
+
+STATES = ('pending', 'downloaded', 'ocr_done', 'extracted', 'matched', 'failed')
+
+class RunJournal:
+    """
+    Per-row state journal. Writes are committed in groups (every `commit_every` updates
+    or `commit_interval` seconds) so journaling does not slow the pipeline down; a crash
+    loses at most the last uncommitted group, and those rows are simply redone.
+    """
+
+    def __init__(self, path: str = 'run_journal.sqlite3', commit_every: int = 200, commit_interval: float = 1.0):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS row_state ('
+            ' run_id TEXT NOT NULL, row_key TEXT NOT NULL, state TEXT NOT NULL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (run_id, row_key))'
+        )
+        self._conn.commit()
+
+    def mark(self, run_id: str, row_key, state: str, error: str | None = None):
+        """Records that a row reached `state` (or failed with `error`)."""
+        if state not in STATES:
+            raise ValueError(f"Unknown row state: {state}")
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO row_state (run_id, row_key, state, attempts, error, updated_at) VALUES (?, ?, ?, 1, ?, ?)'
+                ' ON CONFLICT (run_id, row_key) DO UPDATE SET state = excluded.state, error = excluded.error,'
+                ' updated_at = excluded.updated_at,'
+                " attempts = row_state.attempts + (CASE WHEN excluded.state = 'downloaded' THEN 1 ELSE 0 END)",
+                (run_id, str(row_key), state, error, time.time()),
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+                self._commit()
+
+    def complete(self, run_id: str, row_keys: Iterable, state: str = 'matched'):
+        """Marks rows whose results have been persisted as done, and commits right away."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT INTO row_state (run_id, row_key, state, attempts, error, updated_at) VALUES (?, ?, ?, 1, NULL, ?)'
+                ' ON CONFLICT (run_id, row_key) DO UPDATE SET state = excluded.state, error = NULL,'
+                ' updated_at = excluded.updated_at',
+                [(run_id, str(key), state, now) for key in row_keys],
+            )
+            self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def completed_keys(self, run_id: str, done_state: str = 'matched') -> set[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT row_key FROM row_state WHERE run_id = ? AND state = ?', (run_id, done_state)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def pending(self, run_id: str, items: Iterable, key, done_state: str = 'matched') -> Iterator:
+        """
+        Filters `items` down to the ones this run has not finished yet. `key(item)` returns
+        the row key; rows whose journaled state is `done_state` are skipped.
+        """
+        done = self.completed_keys(run_id, done_state)
+        skipped = 0
+        for item in items:
+            if str(key(item)) in done:
+                skipped += 1
+                continue
+            yield item
+        if skipped:
+            print(f"⏭️ Run {run_id}: skipped {skipped} rows already completed.")
+
+    def summary(self, run_id: str) -> dict:
+        """Returns the number of rows in each state for a run."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, COUNT(*) FROM row_state WHERE run_id = ? GROUP BY state', (run_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
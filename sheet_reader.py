@@ -0,0 +1,119 @@
+import csv
+import os
+from typing import Iterator, NamedTuple
+
+# This file contains the row-streaming input layer for the ID sheets.
+# Rows are yielded lazily in constant memory and only the three columns the
+# pipeline needs are read, so a multi-hundred-thousand-row export starts feeding
+# the pipeline as soon as its first row is parsed instead of after a full
+# pd.read_excel. Supports .xlsx (openpyxl read-only streaming), .csv and .parquet.
+
+REQUIRED_COLUMNS = ('id', 'nationality_id', 'back link')
+
+# Cell values pandas treats as missing by default; kept so results match pd.read_excel.
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+class SheetRow(NamedTuple):
+    row_number: int  # Spreadsheet row number (the header is row 1)
+    id: str
+    nationality_id: str
+    back_link: str | None
+
+def _cell_to_str(value) -> str:
+    """Formats a cell like pandas' str() would, without the '.0' of integral floats."""
+    if value is None or (isinstance(value, str) and value.strip() in NA_VALUES):
+        return 'nan'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+def _link_or_none(value) -> str | None:
+    return value if isinstance(value, str) and value.strip() not in NA_VALUES else None
+
+def _make_row(row_number: int, values, columns) -> SheetRow:
+    cells = dict(zip(columns, values))
+    return SheetRow(row_number, _cell_to_str(cells.get('id')), _cell_to_str(cells.get('nationality_id')),
+                    _link_or_none(cells.get('back link')))
+
+def _column_indexes(header, columns) -> list[int]:
+    header = [str(h).strip() if h is not None else '' for h in header]
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise ValueError(f"One or more required columns ({', '.join(repr(c) for c in missing)}) not found.")
+    return [header.index(c) for c in columns]
+
+def _iter_xlsx(path: str, columns) -> Iterator[SheetRow]:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    rows = workbook.active.iter_rows(values_only=True)
+    try:
+        header = next(rows)
+    except StopIteration:
+        workbook.close()
+        raise ValueError("The sheet is empty.")
+    indexes = _column_indexes(header, columns)
+
+    def generate():
+        try:
+            for row_number, row in enumerate(rows, start=2):
+                values = [row[i] if i < len(row) else None for i in indexes]
+                if all(v is None for v in values):
+                    continue
+                yield _make_row(row_number, values, columns)
+        finally:
+            workbook.close()
+    return generate()
+
+def _iter_csv(path: str, columns) -> Iterator[SheetRow]:
+    f = open(path, newline='', encoding='utf-8-sig')
+    reader = csv.reader(f)
+    try:
+        header = next(reader)
+    except StopIteration:
+        f.close()
+        raise ValueError("The sheet is empty.")
+    indexes = _column_indexes(header, columns)
+
+    def generate():
+        with f:
+            for row_number, row in enumerate(reader, start=2):
+                values = [row[i] if i < len(row) and row[i] != '' else None for i in indexes]
+                if all(v is None for v in values):
+                    continue
+                yield _make_row(row_number, values, columns)
+    return generate()
+
+def _iter_parquet(path: str, columns, batch_size: int) -> Iterator[SheetRow]:
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    _column_indexes(parquet_file.schema_arrow.names, columns)
+
+    def generate():
+        row_number = 1
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=list(columns)):
+            data = batch.to_pydict()
+            for values in zip(*(data[c] for c in columns)):
+                row_number += 1
+                yield _make_row(row_number, values, columns)
+    return generate()
+
+def iter_sheet_rows(path: str, columns=REQUIRED_COLUMNS, batch_size: int = 10000) -> Iterator[SheetRow]:
+    """
+    Opens an ID sheet and returns a lazy iterator of SheetRow(row_number, id, nationality_id, back_link).
+    Only `columns` are read; fields for columns that were not requested are left empty.
+    The header is validated eagerly: a missing file raises FileNotFoundError and
+    missing columns raise ValueError before any row is consumed.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.xlsx', '.xlsm'):
+        return _iter_xlsx(path, columns)
+    if ext == '.csv':
+        return _iter_csv(path, columns)
+    if ext == '.parquet':
+        return _iter_parquet(path, columns, batch_size)
+    raise ValueError(f"Unsupported sheet format: {ext}")
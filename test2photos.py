@@ -1,12 +1,17 @@
 import re
 import os
 import io
-from google.cloud import vision
-from google.oauth2 import service_account
+from ocr_cache import cached_annotate, get_default_cache
+import national_id
+import metrics
+from result_sink import open_sink
 
 # --- Google Vision API Setup ---
 def setup_vision_client(key_path: str):
     """Initializes and returns a Google Vision API client."""
+    from google.cloud import vision
+    from google.oauth2 import service_account
+
     credentials = service_account.Credentials.from_service_account_file(key_path)
     return vision.ImageAnnotatorClient(credentials=credentials)
 
@@ -19,8 +24,7 @@ def detect_text_from_image(client, image_path: str) -> str | None:
         print(f"❌ Error reading image file {image_path}: {str(e)}")
         return None
     
-    image = vision.Image(content=content)
-    response = client.text_detection(image=image)
+    response = cached_annotate(client, content, 'text_detection')
     
     if response.error.message:
         print(f"❌ Vision API error for {image_path}: {response.error.message}")
@@ -32,8 +36,8 @@ def detect_text_from_image(client, image_path: str) -> str | None:
 # --- Information Extraction Logic ---
 def extract_national_id(text: str) -> str | None:
     """
-    Extracts the 14-digit Egyptian National ID by searching line-by-line
-    and using a comprehensive numeral conversion map.
+    Extracts the 14-digit Egyptian National ID with the shared extractor, which
+    also reassembles IDs split across groups on one line.
 
     Args:
         text: The raw text extracted from the ID card.
@@ -41,28 +45,7 @@ def extract_national_id(text: str) -> str | None:
     Returns:
         The 14-digit National ID as a string, or None if not found.
     """
-    if not text:
-        return None
-    
-    # This map now includes both standard AND Eastern Arabic-Indic numerals.
-    arabic_to_western_map = str.maketrans(
-        '٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', 
-        '01234567890123456789'
-    )
-    
-    # Search for the ID line by line to avoid mixing numbers from different fields.
-    for line in text.split('\n'):
-        # Normalize the digits in the current line
-        normalized_line = line.translate(arabic_to_western_map)
-        
-        # Find all digits in the line and join them
-        digits_in_line = "".join(re.findall(r'\d+', normalized_line))
-        
-        # Check if this line contains the 14-digit ID
-        if len(digits_in_line) == 14 and digits_in_line.startswith(('2', '3')):
-            return digits_in_line
-            
-    return None
+    return national_id.extract_national_id(text)
 
 def extract_full_name(text: str) -> str | None:
     """
@@ -105,6 +88,8 @@ def main():
     # --- Configuration ---
     key_path = r"D:\National Id Scan\Key.json" 
     image_directory = r"D:\National Id Scan\static\national_id_images"
+    # Each image's name and ID are appended here as they are read (.csv, .sqlite3 or .parquet)
+    results_file = os.environ.get('RESULTS_FILE', 'test2photos_results.csv')
 
     if not os.path.exists(key_path) or not os.path.isdir(image_directory):
         print("❌ CRITICAL ERROR: Check your key_path and image_directory.")
@@ -117,23 +102,33 @@ def main():
         print("🤷 No image files found in the specified directory.")
         return
 
-    for image_path in image_files:
-        print(f"\n📄 Processing Image: {os.path.basename(image_path)}")
-        original_text = detect_text_from_image(client, image_path)
-        
-        if original_text:
-            print("\n--- Original Extracted Text ---")
-            print(original_text)
-            print("-----------------------------\n")
-
-            full_name = extract_full_name(original_text)
-            national_id = extract_national_id(original_text)
-            
-            print(f"  ✅ Extracted Name: {full_name or 'Not Found'}")
-            print(f"  ✅ Extracted National ID: {national_id or 'Not Found'}")
-        else:
-            print("  - Could not extract text from this image.")
-        print("-" * 50)
+    with open_sink(results_file, {'filename': str, 'full_name': str, 'national_id': str, 'text': str}) as results:
+        for image_path in image_files:
+            print(f"\n📄 Processing Image: {os.path.basename(image_path)}")
+            original_text = detect_text_from_image(client, image_path)
+            full_name = national_id = None
+
+            if original_text:
+                print("\n--- Original Extracted Text ---")
+                print(original_text)
+                print("-----------------------------\n")
+
+                full_name = extract_full_name(original_text)
+                national_id = extract_national_id(original_text)
+
+                print(f"  ✅ Extracted Name: {full_name or 'Not Found'}")
+                print(f"  ✅ Extracted National ID: {national_id or 'Not Found'}")
+            else:
+                print("  - Could not extract text from this image.")
+            results.write({'filename': os.path.basename(image_path), 'full_name': full_name,
+                           'national_id': national_id, 'text': original_text})
+            print("-" * 50)
+    print(f"💾 {results.written} results written to {results.path}")
+
+    cache = get_default_cache()
+    if cache:
+        print(f"📦 OCR cache: {cache.stats()}")
+    print(metrics.REGISTRY.summary())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,248 @@
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, TimeoutError
+
+import metrics
+from lazy import lazy_import
+
+api_exceptions = lazy_import('google.api_core.exceptions')
+vision = lazy_import('google.cloud.vision')
+
+# This file contains a drop-in wrapper around the Vision client that collects
+# single-image calls from many threads and sends them as one batch_annotate_images
+# request. Callers still use client.document_text_detection(image=...) and get back
+# the same AnnotateImageResponse, so the extraction code does not change.
+
+# The Vision API accepts at most 16 images per batch_annotate_images request.
+MAX_BATCH_SIZE = 16
+
+# google.rpc.Code.RESOURCE_EXHAUSTED, as carried in a per-image response.error
+RESOURCE_EXHAUSTED = 8
+
+# Longest a caller waits for its image's response (batching, rate-limit waits and retries included)
+RESULT_TIMEOUT = 300  # seconds
+
+def is_quota_error(error: Exception) -> bool:
+    """True when a Vision call failed with HTTP 429 / RESOURCE_EXHAUSTED."""
+    return isinstance(error, api_exceptions.TooManyRequests)  # ResourceExhausted is a subclass
+
+def is_quota_status(status) -> bool:
+    """True when a per-image response.error reports RESOURCE_EXHAUSTED."""
+    return status.code == RESOURCE_EXHAUSTED
+
+class BatchingVisionClient:
+    """
+    Wraps an ImageAnnotatorClient and batches text_detection / document_text_detection calls.
+    A batch is flushed as soon as it holds `batch_size` images, or when the oldest
+    pending image has waited `max_wait` seconds. Up to `max_in_flight` batches are
+    sent concurrently.
+
+    With a `rate_limiter` (see rate_limit.py) every batch waits for its tokens first, and
+    images rejected with a quota error are put back at the front of the queue and retried
+    after the limiter's backoff (up to `max_retries` times) instead of failing the row.
+
+    A caller waits at most `result_timeout` seconds for its response. If a batch fails in
+    an unexpected way, or the flusher thread dies, every affected caller gets the error.
+    """
+
+    def __init__(self, client, batch_size: int = MAX_BATCH_SIZE, max_wait: float = 0.05, max_in_flight: int = 4,
+                 rate_limiter=None, max_retries: int = 8, result_timeout: float = RESULT_TIMEOUT):
+        self.client = client
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.max_wait = max_wait
+        self.result_timeout = result_timeout
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.batches_sent = 0
+        self.images_sent = 0
+        self.requeued = 0
+        self._pending = []
+        self._oldest = None
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._senders = ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix='vision-batch')
+        self._flusher = threading.Thread(target=self._run, name='vision-batch-flusher', daemon=True)
+        self._flusher.start()
+
+    # --- Single-image API, same shape as ImageAnnotatorClient ---
+    def text_detection(self, image, **kwargs):
+        return self._annotate(image, vision.Feature.Type.TEXT_DETECTION)
+
+    def document_text_detection(self, image, **kwargs):
+        return self._annotate(image, vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+
+    def batch_annotate_images(self, *args, **kwargs):
+        return self.client.batch_annotate_images(*args, **kwargs)
+
+    def _annotate(self, image, feature_type):
+        request = vision.AnnotateImageRequest(image=image, features=[vision.Feature(type_=feature_type)])
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchingVisionClient is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((request, future, 0))
+            self._cond.notify()
+        try:
+            return future.result(timeout=self.result_timeout)
+        except TimeoutError:
+            # Drop the image if it is still queued, so it is not sent for nobody.
+            future.cancel()
+            with self._cond:
+                self._pending = [item for item in self._pending if item[1] is not future]
+            raise TimeoutError(f"No Vision response within {self.result_timeout} s") from None
+
+    @property
+    def queue_depth(self) -> int:
+        """Images waiting to be batched plus images waiting for rate-limit tokens."""
+        with self._cond:
+            pending = len(self._pending)
+        return pending + (self.rate_limiter.waiting if self.rate_limiter else 0)
+
+    def stats(self) -> dict:
+        stats = {'batches_sent': self.batches_sent, 'images_sent': self.images_sent,
+                 'requeued': self.requeued, 'queue_depth': self.queue_depth}
+        if self.rate_limiter is not None:
+            stats.update(self.rate_limiter.stats())
+        return stats
+
+    # --- Flushing ---
+    def _take_batch(self) -> list:
+        """Waits until a batch is due and removes it from the pending list. Returns [] on close."""
+        with self._cond:
+            while True:
+                if len(self._pending) >= self.batch_size:
+                    break
+                if self._pending:
+                    remaining = self._oldest + self.max_wait - time.monotonic()
+                    if remaining <= 0 or self._closed:
+                        break
+                    self._cond.wait(remaining)
+                elif self._closed and not self._in_flight:
+                    return []  # Nothing left, and no batch in flight that could be re-queued.
+                else:
+                    self._cond.wait()
+            batch = self._pending[:self.batch_size]
+            self._pending = self._pending[self.batch_size:]
+            self._oldest = time.monotonic() if self._pending else None
+            self._in_flight += 1
+            return batch
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return
+                self._senders.submit(self._send, batch)
+        except BaseException as e:
+            # Nothing would send the queued images any more: fail them and refuse new ones.
+            with self._cond:
+                self._closed = True
+                pending, self._pending = self._pending, []
+            for _, future, _ in pending:
+                _set_exception(future, e)
+            raise
+
+    def _send(self, batch: list):
+        """Sends one batch and resolves each caller's future with its own response."""
+        try:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(len(batch))
+            start = time.perf_counter()
+            try:
+                response = self.client.batch_annotate_images(requests=[request for request, _, _ in batch])
+                with self._cond:
+                    self.batches_sent += 1
+                    self.images_sent += len(batch)
+            except Exception as e:
+                outcome = 'quota' if is_quota_error(e) else 'error'
+                metrics.VISION_BATCH_SECONDS.observe(time.perf_counter() - start, outcome=outcome)
+                metrics.VISION_IMAGES.inc(len(batch), outcome=outcome)
+                failed = self._requeue(batch) if is_quota_error(e) else batch
+                for _, future, _ in failed:
+                    _set_exception(future, e)
+                return
+
+            metrics.VISION_BATCH_SECONDS.observe(time.perf_counter() - start, outcome='ok')
+            responses = list(response.responses)
+            throttled = {}
+            for i, (request, future, attempts) in enumerate(batch):
+                if i >= len(responses):
+                    _set_exception(future, RuntimeError("Vision batch returned fewer responses than requests"))
+                elif is_quota_status(responses[i].error):
+                    metrics.VISION_IMAGES.inc(outcome='quota')
+                    throttled[future] = ((request, future, attempts), responses[i])
+                else:
+                    metrics.VISION_IMAGES.inc(outcome='error' if responses[i].error.message else 'ok')
+                    _set_result(future, responses[i])
+            if throttled:
+                # Images that cannot be retried get their error response, as without a limiter.
+                for _, future, _ in self._requeue([item for item, _ in throttled.values()]):
+                    _set_result(future, throttled[future][1])
+            elif self.rate_limiter is not None:
+                self.rate_limiter.on_success(len(batch))
+        except BaseException as e:
+            # e.g. the rate limiter raised: fail every caller of the batch that is not queued again.
+            with self._cond:
+                queued = {future for _, future, _ in self._pending}
+            for _, future, _ in batch:
+                if future not in queued:
+                    _set_exception(future, e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _requeue(self, items: list) -> list:
+        """
+        Backs the limiter off after a quota error and puts the images back at the front of
+        the queue. Returns the items that cannot be retried (no limiter, or out of retries).
+        """
+        if self.rate_limiter is None:
+            return items
+        self.rate_limiter.on_throttle()
+        retry, exhausted = [], []
+        for request, future, attempts in items:
+            if attempts < self.max_retries:
+                retry.append((request, future, attempts + 1))
+            else:
+                exhausted.append((request, future, attempts))
+        with self._cond:
+            self._pending[:0] = retry
+            if retry:
+                self._oldest = time.monotonic()
+            self.requeued += len(retry)
+            self._cond.notify_all()
+        return exhausted
+
+    def close(self):
+        """Flushes pending images and stops the background flusher."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        self._senders.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _set_result(future: Future, result):
+    # A caller that timed out has cancelled its future.
+    try:
+        future.set_result(result)
+    except InvalidStateError:
+        pass
+
+def _set_exception(future: Future, error: BaseException):
+    try:
+        future.set_exception(error)
+    except InvalidStateError:
+        pass
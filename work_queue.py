@@ -0,0 +1,242 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterable, Iterator, NamedTuple
+
+# This file contains the durable work queue behind sharded runs (see distributed.py).
+# A coordinator splits a sheet's rows into shards and submits them; workers on any number
+# of processes or machines lease one shard at a time, keep the lease alive with heartbeats
+# while they work on it, and hand back the shard's results. A lease that is not renewed
+# in time (the worker crashed, hung or lost its connection) expires and the shard goes to
+# the next worker that asks; every lease carries a token, so a late worker cannot complete
+# a shard that has since been given to someone else. Shards that keep failing are parked
+# as 'failed' after `max_attempts` leases.
+#
+# Queues are opened by URL through open_queue; SQLite (a file shared by the processes of
+# one machine, or on a network share) is built in, and other backends register in BACKENDS.
+
+STATES = ('pending', 'leased', 'done', 'failed')
+
+class Shard(NamedTuple):
+    job_id: str
+    number: int
+    rows: list
+    lease_id: str
+    attempts: int
+
+class WorkQueue:
+    """
+    Backend interface. Jobs are submitted once as numbered shards of JSON-serialisable rows;
+    `lease` hands out the next pending (or expired) shard, and `heartbeat`, `complete` and
+    `fail` return False when the caller no longer holds the shard's lease.
+    """
+
+    def submit(self, job_id: str, shards: Iterable[list], meta: dict | None = None) -> int:
+        """Adds a job's shards (ignored if the job was already submitted); returns the job's shard count."""
+        raise NotImplementedError
+
+    def job(self, job_id: str) -> dict | None:
+        """The job's `meta` dict as submitted, or None for an unknown job."""
+        raise NotImplementedError
+
+    def lease(self, worker_id: str, lease_seconds: float) -> Shard | None:
+        raise NotImplementedError
+
+    def heartbeat(self, shard: Shard, lease_seconds: float) -> bool:
+        raise NotImplementedError
+
+    def complete(self, shard: Shard, results: list) -> bool:
+        raise NotImplementedError
+
+    def fail(self, shard: Shard, error: str) -> bool:
+        """Gives the shard back for another attempt (or parks it as failed after `max_attempts`)."""
+        raise NotImplementedError
+
+    def progress(self, job_id: str | None = None) -> dict:
+        """Shard count per state, for one job or all of them."""
+        raise NotImplementedError
+
+    def results(self, job_id: str) -> Iterator[dict]:
+        """The results of a job's completed shards, in shard order."""
+        raise NotImplementedError
+
+    def errors(self, job_id: str) -> list[tuple[int, str]]:
+        """(shard number, last error) of the job's failed shards."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class SqliteWorkQueue(WorkQueue):
+    """
+    Work queue in one SQLite file. Every lease is a single IMMEDIATE transaction, so any
+    number of processes can share the file; WAL mode keeps readers (progress, results)
+    from blocking the workers.
+    """
+
+    def __init__(self, path: str = 'work_queue.sqlite3', max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                meta TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shards (
+                job_id TEXT NOT NULL,
+                number INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                rows TEXT NOT NULL,
+                results TEXT,
+                worker_id TEXT,
+                lease_id TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (job_id, number)
+            );
+            CREATE INDEX IF NOT EXISTS shards_by_state ON shards (state, lease_expires);
+        ''')
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT: takes the write lock up front so two workers never lease one shard."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def submit(self, job_id: str, shards: Iterable[list], meta: dict | None = None) -> int:
+        now = time.time()
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM jobs WHERE job_id = ?', (job_id,)).fetchone() is None:
+                conn.execute('INSERT INTO jobs (job_id, meta, created_at) VALUES (?, ?, ?)',
+                             (job_id, json.dumps(meta or {}), now))
+                conn.executemany(
+                    "INSERT INTO shards (job_id, number, state, rows, updated_at) VALUES (?, ?, 'pending', ?, ?)",
+                    ((job_id, number, json.dumps(rows), now) for number, rows in enumerate(shards)))
+            return conn.execute('SELECT COUNT(*) FROM shards WHERE job_id = ?', (job_id,)).fetchone()[0]
+
+    def job(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute('SELECT meta FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return json.loads(row['meta']) if row else None
+
+    def lease(self, worker_id: str, lease_seconds: float) -> Shard | None:
+        now = time.time()
+        with self._transaction() as conn:
+            # Expired leases of shards that used up their attempts are not handed out again.
+            conn.execute(
+                "UPDATE shards SET state = 'failed', error = COALESCE(error, 'lease expired'), updated_at = ?"
+                " WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+            row = conn.execute(
+                "SELECT job_id, number, rows, attempts FROM shards"
+                " WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)"
+                " ORDER BY attempts, job_id, number LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            lease_id = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE shards SET state = 'leased', worker_id = ?, lease_id = ?, lease_expires = ?,"
+                " attempts = attempts + 1, updated_at = ? WHERE job_id = ? AND number = ?",
+                (worker_id, lease_id, now + lease_seconds, now, row['job_id'], row['number']))
+        return Shard(row['job_id'], row['number'], json.loads(row['rows']), lease_id, row['attempts'] + 1)
+
+    def _update_leased(self, shard: Shard, assignments: str, values: tuple) -> bool:
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE shards SET {assignments}, updated_at = ?"
+                " WHERE job_id = ? AND number = ? AND state = 'leased' AND lease_id = ?",
+                (*values, time.time(), shard.job_id, shard.number, shard.lease_id))
+            return cursor.rowcount == 1
+
+    def heartbeat(self, shard: Shard, lease_seconds: float) -> bool:
+        return self._update_leased(shard, 'lease_expires = ?', (time.time() + lease_seconds,))
+
+    def complete(self, shard: Shard, results: list) -> bool:
+        return self._update_leased(shard, "state = 'done', results = ?, lease_expires = NULL, error = NULL",
+                                   (json.dumps(results),))
+
+    def fail(self, shard: Shard, error: str) -> bool:
+        state = 'failed' if shard.attempts >= self.max_attempts else 'pending'
+        return self._update_leased(shard, 'state = ?, error = ?, lease_expires = NULL', (state, error))
+
+    def progress(self, job_id: str | None = None) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, COUNT(*) AS count FROM shards WHERE ? IS NULL OR job_id = ? GROUP BY state',
+                (job_id, job_id)).fetchall()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update({row['state']: row['count'] for row in rows})
+        return counts
+
+    def results(self, job_id: str) -> Iterator[dict]:
+        number = -1
+        while True:
+            # One shard per query, so a large job is never loaded at once.
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT number, results FROM shards WHERE job_id = ? AND state = 'done' AND number > ?"
+                    " ORDER BY number LIMIT 1", (job_id, number)).fetchone()
+            if row is None:
+                return
+            number = row['number']
+            yield from json.loads(row['results'])
+
+    def errors(self, job_id: str) -> list[tuple[int, str]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT number, error FROM shards WHERE job_id = ? AND state = 'failed' ORDER BY number",
+                (job_id,)).fetchall()
+        return [(row['number'], row['error']) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+BACKENDS = {'sqlite': SqliteWorkQueue}
+
+def open_queue(url: str, **kwargs) -> WorkQueue:
+    """
+    Opens a work queue by URL: a plain file path or 'sqlite:///queue.sqlite3' (relative;
+    four slashes for an absolute path) for SQLite, or 'name://...' for BACKENDS[name],
+    which is given the rest of the URL.
+    """
+    scheme, separator, rest = url.partition('://')
+    if not separator:
+        scheme, rest = 'sqlite', url
+    elif scheme == 'sqlite':
+        rest = rest[1:] if rest.startswith('/') else rest
+    if scheme not in BACKENDS:
+        raise ValueError(f"Unknown work queue backend: {scheme}")
+    if scheme == 'sqlite':
+        folder = os.path.dirname(rest)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+    return BACKENDS[scheme](rest, **kwargs)
+
+def shard_rows(rows: Iterable, shard_size: int) -> Iterator[list]:
+    """Groups rows into lists of `shard_size` without holding more than one shard in memory."""
+    shard = []
+    for row in rows:
+        shard.append(row)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard